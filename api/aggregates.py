@@ -0,0 +1,221 @@
+from collections import Counter
+from sqlalchemy import select, delete, func, tuple_, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from api.models import engine, Base, Response, Completion, ResponseCount, ClusterResponseCount
+import logging
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+upsert_dialects = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+response_by_value = {
+    -2: 'Strongly Disagree',
+    -1: 'Disagree',
+    1: 'Agree',
+    2: 'Strongly Agree'
+}
+
+# Keeps IN lists and multi-row inserts under sqlite's limit on bound parameters
+chunk_size = 500
+# First key of the postgres advisory locks taken per user, the second is the user_fid
+user_lock_namespace = 1
+
+
+def chunks(items, size=chunk_size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def upsert_counts(connection, model, deltas):
+    """
+    Adds deltas, given as { (task_id, *primary key): delta }, to the counts of a count table.
+    """
+    table = model.__table__
+    primary_key = [column.name for column in table.primary_key.columns]
+    rows = [
+        dict(zip(['task_id'] + primary_key, key), count=delta)
+        for key, delta in deltas.items()
+        if delta != 0
+    ]
+    insert = upsert_dialects[connection.dialect.name]
+    for chunk in chunks(rows):
+        stmt = insert(table).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=primary_key,
+            set_={'count': table.c.count + stmt.excluded['count']}
+        )
+        connection.execute(stmt)
+
+
+def latest_clusters(connection, user_fids):
+    """
+    Returns { (task_id, user_fid): cluster_id } of each user's latest completion.
+    """
+    clusters = {}
+    for chunk in chunks(list(user_fids)):
+        stmt = select(Completion.task_id, Completion.user_fid, Completion.cluster_id) \
+            .where(Completion.user_fid.in_(chunk)) \
+            .order_by(Completion.completion_id)
+        for task_id, user_fid, cluster_id in connection.execute(stmt):
+            clusters[(task_id, user_fid)] = cluster_id
+    return clusters
+
+
+def lock_users(connection, user_fids):
+    """
+    Holds off other transactions counting the same users' responses until this one ends. Deltas are computed
+    from the values stored before the write, so two workers reading the same old values would count a change
+    twice. Postgres takes an advisory lock per user, in order so that two batches can't deadlock, which also
+    covers responses that don't exist yet. sqlite takes its one write lock, unless the transaction holds it.
+    """
+    if connection.dialect.name == 'postgresql':
+        fids = sorted({user_fid for user_fid in user_fids if user_fid is not None})
+        connection.execute(text(
+            'SELECT pg_advisory_xact_lock(:namespace, fid) FROM (SELECT unnest(CAST(:fids AS integer[])) AS fid '
+            'ORDER BY fid) AS fids'
+        ), {'namespace': user_lock_namespace, 'fids': fids})
+    elif connection.dialect.name == 'sqlite' and not connection.connection.driver_connection.in_transaction:
+        # pysqlite reads outside of a transaction until the first write, so the reads below would not be
+        # guarded by the write lock the upserts take
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def apply_response_deltas(connection, rows):
+    """
+    Updates the counts for a batch of responses that is about to be upserted, in the same transaction.
+    Must run before the upsert, since it compares the batch with the values currently stored.
+    """
+    lock_users(connection, [row['user_fid'] for row in rows])
+    existing = {}
+    for chunk in chunks([(row['user_fid'], row['question_id']) for row in rows]):
+        # sqlite can't search an index for a tuple IN list, the user_fid IN list narrows it down through one
+        stmt = select(Response.user_fid, Response.question_id, Response.value) \
+            .where(Response.user_fid.in_({user_fid for user_fid, _ in chunk})) \
+            .where(tuple_(Response.user_fid, Response.question_id).in_(chunk))
+        for user_fid, question_id, value in connection.execute(stmt):
+            existing[(user_fid, question_id)] = value
+    clusters = latest_clusters(connection, {row['user_fid'] for row in rows})
+
+    counts = Counter()
+    cluster_counts = Counter()
+    for row in rows:
+        task_id, question_id, value = row['task_id'], row['question_id'], row['value']
+        previous = existing.get((row['user_fid'], question_id))
+        if previous == value:
+            continue
+        cluster_id = clusters.get((task_id, row['user_fid']))
+        if previous is not None:
+            counts[(task_id, question_id, previous)] -= 1
+            if cluster_id is not None:
+                cluster_counts[(task_id, cluster_id, question_id, previous)] -= 1
+        counts[(task_id, question_id, value)] += 1
+        if cluster_id is not None:
+            cluster_counts[(task_id, cluster_id, question_id, value)] += 1
+
+    upsert_counts(connection, ResponseCount, counts)
+    upsert_counts(connection, ClusterResponseCount, cluster_counts)
+
+
+def apply_completion_deltas(connection, task_id, user_fid, cluster_id):
+    """
+    Counts a user's responses towards the cluster of the completion that is about to be added.
+    Must run before the completion is inserted, and after the user's buffered responses were flushed.
+    """
+    lock_users(connection, [user_fid])
+    previous = latest_clusters(connection, [user_fid]).get((task_id, user_fid))
+    # a user has few responses, so they are filtered by task here rather than letting the task_id index
+    # be picked over the user's
+    stmt = select(Response.task_id, Response.question_id, Response.value).where(Response.user_fid == user_fid)
+    cluster_counts = Counter()
+    for response_task_id, question_id, value in connection.execute(stmt):
+        if response_task_id != task_id:
+            continue
+        # a user completing twice (only the test fid can) moves from their previous cluster
+        if previous is not None:
+            cluster_counts[(task_id, previous, question_id, value)] -= 1
+        cluster_counts[(task_id, cluster_id, question_id, value)] += 1
+    upsert_counts(connection, ClusterResponseCount, cluster_counts)
+
+
+def cluster_counts_query(task_id):
+    """
+    Counts the task's responses per cluster, question and value, each user in the cluster of their latest completion.
+    """
+    # joined from each user's latest completion to their responses. Written as completion_id IN (latest),
+    # sqlite probes the whole list for every response
+    latest = select(Completion.user_fid, func.max(Completion.completion_id).label('completion_id')) \
+        .where(Completion.task_id == task_id) \
+        .group_by(Completion.user_fid) \
+        .subquery()
+    return select(Completion.cluster_id, Response.question_id, Response.value, Response.task_id, func.count()) \
+        .select_from(latest) \
+        .join(Completion, Completion.completion_id == latest.c.completion_id) \
+        .join(Response, (Response.user_fid == latest.c.user_fid) & (Response.task_id == task_id)) \
+        .group_by(Completion.cluster_id, Response.question_id, Response.value, Response.task_id)
+
+
+def rebuild_counts(connection, task_id):
+    """
+    Recounts a task's count tables from its responses and completions.
+    """
+    connection.execute(delete(ResponseCount).where(ResponseCount.task_id == task_id))
+    connection.execute(delete(ClusterResponseCount).where(ClusterResponseCount.task_id == task_id))
+
+    connection.execute(ResponseCount.__table__.insert().from_select(
+        ['question_id', 'value', 'task_id', 'count'],
+        select(Response.question_id, Response.value, Response.task_id, func.count())
+        .where(Response.task_id == task_id)
+        .group_by(Response.question_id, Response.value, Response.task_id)
+    ))
+
+    connection.execute(ClusterResponseCount.__table__.insert().from_select(
+        ['cluster_id', 'question_id', 'value', 'task_id', 'count'], cluster_counts_query(task_id)
+    ))
+    logger.info('Rebuilt response counts of task {}'.format(task_id))
+
+
+def ensure_counts(bind=engine):
+    """
+    Creates the count tables if needed and recounts every task, so writes made outside the server
+    (e.g. by the seeding scripts) are reflected.
+    """
+    Base.metadata.create_all(bind, tables=[ResponseCount.__table__, ClusterResponseCount.__table__])
+    with bind.begin() as connection:
+        for (task_id,) in connection.execute(select(Response.task_id).distinct()):
+            rebuild_counts(connection, task_id)
+
+
+def survey_stats(db_session: Session, task):
+    """
+    { question text: { answer text: count } } for a task.
+    """
+    stmt = select(ResponseCount.question_id, ResponseCount.value, ResponseCount.count) \
+        .where(ResponseCount.task_id == task.task_id, ResponseCount.count > 0)
+    result = {}
+    for question_id, value, count in db_session.execute(stmt):
+        question = task.questions_by_id[question_id].text
+        result.setdefault(question, {})[response_by_value[value]] = count
+    return result
+
+
+def responses_by_cluster(db_session: Session, task):
+    """
+    { cluster name: { question text: { answer text: count } } } for a task.
+    """
+    cluster_names = {cluster.cluster_id: cluster.name for cluster in task.clusters.values()}
+    stmt = select(ClusterResponseCount.cluster_id, ClusterResponseCount.question_id,
+                  ClusterResponseCount.value, ClusterResponseCount.count) \
+        .where(ClusterResponseCount.task_id == task.task_id, ClusterResponseCount.count > 0)
+    result = {}
+    for cluster_id, question_id, value, count in db_session.execute(stmt):
+        question = task.questions_by_id[question_id].text
+        result.setdefault(cluster_names[cluster_id], {}).setdefault(question, {})[response_by_value[value]] = count
+    return result
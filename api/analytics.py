@@ -0,0 +1,221 @@
+from sqlalchemy import select, or_
+from sqlalchemy.orm import Session
+from api.models import Response, Completion, Cluster
+import logging
+import os
+import threading
+from time import time
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# How stale the responses of a task may get before new rows are pulled in
+refresh_interval = float(os.environ.get('STATS_REFRESH_INTERVAL', 60))
+# Replaced answers update rows in place rather than adding new ones, and are found by their updated_at. Rows
+# updated this many seconds before the last refresh are read again, to catch writes committed while it ran and
+# clocks of other hosts running a little behind
+changed_rows_margin = float(os.environ.get('STATS_CHANGED_ROWS_MARGIN', 60))
+# A full reload also picks up changes made without setting updated_at, e.g. by hand
+full_reload_interval = float(os.environ.get('STATS_FULL_RELOAD_INTERVAL', 3600))
+
+response_by_value = {
+    -2: 'Strongly Disagree',
+    -1: 'Disagree',
+    1: 'Agree',
+    2: 'Strongly Agree'
+}
+
+columns = ['response_id', 'question_id', 'task_id', 'user_fid', 'username', 'value', 'submitted_at',
+           'question', 'cluster', 'token_id', 'text']
+
+
+def union_categories(frames, column):
+    categories = frames[0][column].cat.categories
+    for frame in frames[1:]:
+        categories = categories.union(frame[column].cat.categories)
+    for frame in frames:
+        frame[column] = frame[column].cat.set_categories(categories)
+
+
+class TaskResponses:
+    """
+    The responses of one task joined with question text, answer text, cluster and token id,
+    plus the high-water marks of what has been loaded so far. pandas takes half a second to import,
+    so the server only imports it once a frame is first built.
+    """
+
+    def __init__(self, task):
+        import pandas as pd
+        self.version = task.version
+        self.response_id = 0
+        self.completion_id = 0
+        # rows updated after this are read again even if already loaded
+        self.updated_after = 0.0
+        self.loaded_at = 0.0
+        self.full_loaded_at = time()
+        self.question_by_id = pd.Series({question.question_id: question.text for question in task.questions},
+                                        dtype=pd.CategoricalDtype([question.text for question in task.questions]))
+        self.text_by_value = pd.Series(response_by_value, dtype=pd.CategoricalDtype(list(response_by_value.values())))
+        self.cluster_dtype = pd.CategoricalDtype(sorted(task.clusters))
+        self.cluster_by_fid = pd.Series(dtype=self.cluster_dtype)
+        self.token_by_fid = pd.Series(dtype='Int64')
+        # completions without a token id yet, the minter fills it in later
+        self.pending_completion_ids = set()
+        self.df = self.decorate(pd.DataFrame({
+            'response_id': pd.Series(dtype='int64'),
+            'question_id': pd.Series(dtype='int64'),
+            'task_id': pd.Series(dtype='int64'),
+            'user_fid': pd.Series(dtype='Int64'),
+            'username': pd.Series(dtype='category'),
+            'value': pd.Series(dtype='int8'),
+            'submitted_at': pd.Series(dtype='datetime64[ns]'),
+        }))
+
+    def decorate(self, df):
+        df['username'] = df['username'].astype('category')
+        df['question'] = df['question_id'].map(self.question_by_id).astype(self.question_by_id.dtype)
+        df['cluster'] = df['user_fid'].map(self.cluster_by_fid).astype(self.cluster_dtype)
+        df['token_id'] = df['user_fid'].map(self.token_by_fid).astype('Int64')
+        df['text'] = df['value'].map(self.text_by_value).astype(self.text_by_value.dtype)
+        return df[columns]
+
+    def load_completions(self, db_session: Session, task_id: int):
+        import pandas as pd
+        stmt = select(Completion.completion_id, Completion.user_fid, Completion.token_id, Cluster.name) \
+            .join(Cluster, Completion.cluster_id == Cluster.cluster_id) \
+            .where(Completion.task_id == task_id) \
+            .where(or_(Completion.completion_id > self.completion_id,
+                       Completion.completion_id.in_(self.pending_completion_ids)))
+        completions = db_session.execute(stmt).all()
+        if len(completions) == 0:
+            return []
+
+        changed = pd.DataFrame(completions, columns=['completion_id', 'user_fid', 'token_id', 'cluster'])
+        self.completion_id = max(self.completion_id, int(changed['completion_id'].max()))
+        self.pending_completion_ids -= set(changed['completion_id'].tolist())
+        self.pending_completion_ids |= set(changed.loc[changed['token_id'].isna(), 'completion_id'].tolist())
+
+        changed = changed.drop_duplicates(subset='user_fid', keep='last').set_index('user_fid')
+        self.cluster_by_fid = changed['cluster'].astype(self.cluster_dtype) \
+            .combine_first(self.cluster_by_fid).astype(self.cluster_dtype)
+        self.token_by_fid = changed['token_id'].astype('Int64').combine_first(self.token_by_fid).astype('Int64')
+        return changed.index
+
+    def refresh(self, db_session: Session, task_id: int):
+        import pandas as pd
+        started = time()
+        changed_fids = self.load_completions(db_session, task_id)
+
+        stmt = select(Response.__table__) \
+            .where(Response.task_id == task_id) \
+            .where(Response.response_id > self.response_id) \
+            .order_by(Response.response_id)
+        new = self.decorate(pd.read_sql(stmt, db_session.bind))
+        # rows already loaded that were written since, i.e. replaced answers, which keep their response_id. Not
+        # bounded by response_id in SQL, which would have sqlite scan the task's rows rather than the recent ones
+        stmt = select(Response.__table__) \
+            .where(Response.task_id == task_id) \
+            .where(Response.updated_at > self.updated_after) \
+            .order_by(Response.response_id)
+        changed = pd.read_sql(stmt, db_session.bind)
+        changed = self.decorate(changed[changed['response_id'] <= self.response_id])
+
+        # readers may be holding the current frame, so changes go into a new one that is swapped in at the end
+        df = self.df
+        frames = [df, changed, new]
+        union_categories(frames, 'username')
+        late = changed.iloc[:0]
+        if len(changed) > 0:
+            df = df.copy()
+            # the frame is in response_id order
+            ids = df['response_id'].to_numpy()
+            rows = ids.searchsorted(changed['response_id'].to_numpy()).clip(0, max(len(ids) - 1, 0))
+            loaded = ids[rows] == changed['response_id'].to_numpy() if len(ids) > 0 else rows < 0
+            for column in ['username', 'value', 'text']:
+                df.iloc[rows[loaded], df.columns.get_loc(column)] = changed[column][loaded].to_numpy()
+            # rows below the high-water mark that were committed after it was read
+            late = changed[~loaded]
+        if len(new) > 0 or len(late) > 0:
+            # empty frames read back with object columns, which would turn the concatenated ones to object too
+            df = pd.concat([df] + [frame for frame in (late, new) if len(frame) > 0], ignore_index=True)
+            if len(late) > 0:
+                df = df.sort_values('response_id', ignore_index=True)
+            self.response_id = int(df['response_id'].iloc[-1])
+        elif len(changed_fids) > 0:
+            df = df.copy()
+
+        if len(changed_fids) > 0:
+            # users who finished since the last refresh get their cluster on the rows already loaded
+            finished = df['user_fid'].isin(changed_fids)
+            df.loc[finished, 'cluster'] = df.loc[finished, 'user_fid'].map(self.cluster_by_fid)
+            df.loc[finished, 'token_id'] = df.loc[finished, 'user_fid'].map(self.token_by_fid)
+
+        self.df = df
+
+        self.updated_after = started - changed_rows_margin
+        self.loaded_at = time()
+        return len(new) + len(changed)
+
+
+class AnalyticsStore:
+    """
+    Per-task response frames for the /stats endpoints, each with its own freshness.
+    A refresh only reads responses above the task's high-water mark or updated since the last refresh, and
+    completions that are new or still minting.
+    """
+
+    def __init__(self):
+        self.tasks = {}  # { task_id: TaskResponses }
+        self.locks = {}  # { task_id: Lock }
+        self.locks_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lock_for(self, task_id):
+        with self.locks_lock:
+            return self.locks.setdefault(task_id, threading.Lock())
+
+    def get(self, db_session: Session, task):
+        responses = self.tasks.get(task.task_id)
+        if responses is not None and time() - responses.loaded_at <= refresh_interval:
+            self.hits += 1
+            return responses.df
+
+        self.misses += 1
+
+        with self.lock_for(task.task_id):
+            responses = self.tasks.get(task.task_id)
+            now = time()
+            if responses is None or responses.version != task.version or \
+                    now - responses.full_loaded_at > full_reload_interval:
+                responses = TaskResponses(task)
+            elif now - responses.loaded_at <= refresh_interval:
+                return responses.df
+
+            t0 = time()
+            num_new = responses.refresh(db_session, task.task_id)
+            self.tasks[task.task_id] = responses
+            logger.info(f'Loaded {num_new} new or changed responses for task_id {task.task_id} '
+                        f'in {time() - t0:.2f} seconds')
+        return responses.df
+
+    def invalidate(self, task_id=None):
+        if task_id is None:
+            self.tasks = {}
+        else:
+            self.tasks.pop(task_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'tasks': {task_id: len(responses.df) for task_id, responses in self.tasks.items()},
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+analytics_store = AnalyticsStore()
@@ -0,0 +1,296 @@
+# Creates a task from a quiz definition and bulk loads responses and completions into it, either generated
+# or read from a csv of user_fid,username,question,value rows (question is the sequence number):
+# python -m api.bulk_import --quiz ./json/quiz.json --users 1000000
+# python -m api.bulk_import --task-id 1 --responses responses.csv
+from contextlib import contextmanager
+from itertools import islice, product
+from time import perf_counter, time
+from sqlalchemy import insert, select, func
+from api.models import engine, SessionLocal, Base, Task, Category, Question, Cluster, Response, Completion, \
+    question_category_table
+from api.aggregates import rebuild_counts
+from api.response_buffer import upsert_responses
+from api.task_cache import task_cache
+from api.scoring import get_scorer
+import argparse
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Rows per executemany, generated users are also scored this many responses at a time
+import_batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', 100000))
+
+answer_values = np.array([-2, -1, 1, 2], dtype=np.int64)
+
+# cluster images of The Network State Survey, other clusters get none
+cluster_images = {
+    'Creative Collectivist': 'Qmbbhbbawqnn1ZN6fWkQRL26cCrJYypLZJPKrFBMmY4Hfa',
+    'Creative Individualist': 'QmS25zAxoiAjBxW8f3QW4etahfnx9QcNTxxxsF3HJnCXRB',
+    'Structured Collectivist': 'QmV5zju6bM98CyZwpVmvSdZwR7Kou1eAYkfAXyfnkYDceV',
+    'Structured Individualist': 'QmQ3LHSPDVm3TpM2BGX5p3bwinDG8hknaHurQDHT5awMNf'
+}
+
+
+def create_task(connection, quiz, title, description, network, contract_address):
+    """
+    Creates a task from quiz entries like json/quiz.json's. Each entry's category is one category per axis,
+    e.g. 'Structured-Individualist'. The two categories met on an axis are opposites, and a cluster is made
+    for every combination of them. Returns the task_id.
+    """
+    task_id = connection.execute(insert(Task).values(
+        title=title, description=description, network=network, contract_address=contract_address
+    )).inserted_primary_key[0]
+
+    # category names per axis, in the order they are first met
+    axes = []
+    for q in quiz:
+        for axis, name in enumerate(q['category'].split('-')):
+            if axis == len(axes):
+                axes.append([])
+            if name not in axes[axis]:
+                axes[axis].append(name)
+
+    category_ids = {}
+    for names in axes:
+        for name in names:
+            category_ids[name] = connection.execute(
+                insert(Category).values(task_id=task_id, name=name)
+            ).inserted_primary_key[0]
+    for names in axes:
+        if len(names) == 2:
+            a, b = names
+            connection.execute(Category.__table__.update().where(Category.category_id == category_ids[a])
+                               .values(opposite_category_id=category_ids[b]))
+            connection.execute(Category.__table__.update().where(Category.category_id == category_ids[b])
+                               .values(opposite_category_id=category_ids[a]))
+
+    for i, q in enumerate(quiz):
+        question_id = connection.execute(insert(Question).values(
+            task_id=task_id,
+            sequence_num=i + 1,
+            text=q['question'],
+            image_path=q.get('img'),
+            image_ipfs_hash=q.get('ipfs', '')
+        )).inserted_primary_key[0]
+        connection.execute(insert(question_category_table), [
+            {'question_id': question_id, 'category_id': category_ids[name]} for name in q['category'].split('-')
+        ])
+
+    connection.execute(insert(Cluster), [
+        {'task_id': task_id, 'name': ' '.join(names), 'image_ipfs_hash': cluster_images.get(' '.join(names), '')}
+        for names in product(*axes)
+    ])
+    logger.info('Created task {} with {} questions'.format(task_id, len(quiz)))
+    return task_id
+
+
+def insert_rows(connection, table, columns, rows):
+    """
+    Inserts rows, given as tuples in the order of columns, import_batch_size at a time. On sqlite the tuples
+    go straight to the driver's executemany, elsewhere through a Core insert. Returns how many were inserted.
+    """
+    rows = iter(rows)
+    if connection.dialect.name == 'sqlite':
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table.name, ', '.join(columns), ', '.join('?' * len(columns)))
+    inserted = 0
+    while True:
+        batch = list(islice(rows, import_batch_size))
+        if len(batch) == 0:
+            return inserted
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql(sql, batch)
+        else:
+            connection.execute(insert(table), [dict(zip(columns, row)) for row in batch])
+        inserted += len(batch)
+
+
+@contextmanager
+def deferred_indexes(connection, tables):
+    """
+    Drops the tables' non-unique indexes for the block and builds them again after it. Much faster than
+    keeping them up to date row by row when the load is large compared to what is already in the tables.
+    """
+    indexes = [index for table in tables for index in table.indexes if not index.unique]
+    for index in indexes:
+        index.drop(connection, checkfirst=True)
+    yield
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+def insert_responses(connection, task_id, question_ids, user_fids, usernames, values):
+    """
+    Inserts responses given as equal length arrays, in order.
+    """
+    return insert_rows(connection, Response.__table__, ['question_id', 'task_id', 'user_fid', 'username', 'value'],
+                       zip(question_ids.tolist(), [task_id] * len(question_ids), user_fids.tolist(),
+                           usernames.tolist(), values.tolist()))
+
+
+def insert_completions(connection, task, scorer, fids, values, ranks=None):
+    """
+    Scores a users x questions values matrix and inserts a completion for each user. Returns how many were inserted.
+    """
+    names, _ = scorer.score(values, ranks)
+    cluster_ids = np.array([task.clusters[name].cluster_id if name in task.clusters else -1 for name in names],
+                           dtype=np.int64)
+    scored = cluster_ids >= 0
+    if not scored.all():
+        logger.warning('{} users of task {} scored to no cluster'.format(int((~scored).sum()), task.task_id))
+    return insert_rows(connection, Completion.__table__, ['task_id', 'user_fid', 'cluster_id'],
+                       zip([task.task_id] * int(scored.sum()), fids[scored].tolist(), cluster_ids[scored].tolist()))
+
+
+def load_snapshot(task_id):
+    with SessionLocal() as db_session:
+        return task_cache.build(db_session, task_id)
+
+
+def next_fid(connection):
+    return (connection.execute(select(func.max(Response.user_fid))).scalar() or 0) + 1
+
+
+def generate_responses(connection, task, num_users, first_fid=None, seed=None):
+    """
+    Generates num_users users with random answers to every question the frame asks (all but the first,
+    which is on the start page) and a completion for each. Users get fids from first_fid on, by default
+    above every fid in the database. Returns (responses, completions) inserted.
+    """
+    scorer = get_scorer(task)
+    rng = np.random.default_rng(seed)
+    if first_fid is None:
+        first_fid = next_fid(connection)
+    asked = scorer.question_ids[1:]
+    users_per_batch = max(1, import_batch_size // max(1, len(asked)))
+
+    responses = completions = 0
+    for start in range(first_fid, first_fid + num_users, users_per_batch):
+        fids = np.arange(start, min(start + users_per_batch, first_fid + num_users), dtype=np.int64)
+        values = np.zeros((len(fids), len(scorer.question_ids)), dtype=np.int64)
+        values[:, 1:] = answer_values[rng.integers(0, len(answer_values), size=(len(fids), len(asked)))]
+
+        # each user's answers in question order, which is the order the frame asks them in
+        usernames = np.array(['user{}'.format(fid) for fid in fids.tolist()], dtype=object)
+        responses += insert_responses(connection, task.task_id,
+                                      np.tile(asked, len(fids)),
+                                      np.repeat(fids, len(asked)),
+                                      np.repeat(usernames, len(asked)),
+                                      values[:, 1:].reshape(-1))
+        completions += insert_completions(connection, task, scorer, fids, values)
+    return responses, completions
+
+
+def import_responses(connection, task, path):
+    """
+    Imports responses from a csv of user_fid,username,question,value rows, in file order. Where a user answered
+    a question more than once the last answer is kept, and it replaces an answer already in the database.
+    Users who already completed the task are skipped, so importing a file again changes nothing. Users who
+    answered every question the frame asks get a completion. Returns (responses, completions) written.
+    """
+    scorer = get_scorer(task)
+    frame = pd.read_csv(path, dtype={'user_fid': np.int64, 'username': str, 'question': np.int64, 'value': np.int64})
+
+    question_by_sequence = pd.Series({question.sequence_num: question.question_id for question in task.questions})
+    frame['question_id'] = frame['question'].map(question_by_sequence)
+    unknown = frame['question_id'].isna() | ~frame['value'].isin(answer_values)
+    if unknown.any():
+        logger.warning('Skipping {} rows with an unknown question or value'.format(int(unknown.sum())))
+    frame = frame[~unknown].drop_duplicates(['user_fid', 'question_id'], keep='last')
+    completed = frame['user_fid'].isin(connection.execute(
+        select(Completion.user_fid).where(Completion.task_id == task.task_id, Completion.user_fid.is_not(None))
+    ).scalars().all())
+    if completed.any():
+        logger.warning('Skipping {} rows of users who already completed task {}'.format(int(completed.sum()),
+                                                                                    task.task_id))
+        frame = frame[~completed]
+    if len(frame) == 0:
+        return 0, 0
+    question_ids = frame['question_id'].to_numpy(dtype=np.int64)
+    user_fids = frame['user_fid'].to_numpy()
+    given_values = frame['value'].to_numpy()
+
+    imported_at = time()
+    rows = [
+        {'question_id': question_id, 'task_id': task.task_id, 'user_fid': user_fid, 'username': username,
+         'value': value, 'updated_at': imported_at}
+        for question_id, user_fid, username, value in zip(question_ids.tolist(), user_fids.tolist(),
+                                                          frame['username'].tolist(), given_values.tolist())
+    ]
+    upsert_responses(connection, rows)
+    responses = len(rows)
+
+    # scored like recompute_clusters, the position of a row orders the user's answers
+    fids, user_rows = np.unique(user_fids, return_inverse=True)
+    columns = pd.Series(scorer.column_by_question).reindex(question_ids).to_numpy()
+    values = np.zeros((len(fids), len(scorer.question_ids)), dtype=np.int64)
+    values[user_rows, columns] = given_values
+    ranks = np.zeros_like(values)
+    ranks[user_rows, columns] = np.arange(len(question_ids))
+    complete = (values[:, 1:] != 0).all(axis=1)
+    completions = insert_completions(connection, task, scorer, fids[complete], values[complete], ranks[complete])
+    return responses, completions
+
+
+def bulk_import(quiz=None, task_id=None, num_users=0, responses_path=None, title='The Network State Survey',
+                description='', network='mumbai', contract_address='0x0', seed=None, defer_indexes=False, bind=engine):
+    """
+    Creates a task from quiz, or uses task_id, and loads generated users and/or a csv of responses into it
+    in one transaction, then recounts the task. Returns the task_id.
+    """
+    Base.metadata.create_all(bind)
+    if task_id is None:
+        with bind.begin() as connection:
+            task_id = create_task(connection, quiz, title, description, network, contract_address)
+    task = load_snapshot(task_id)
+    if task is None:
+        raise ValueError('No such task: {}'.format(task_id))
+
+    t0 = perf_counter()
+    responses = completions = 0
+    tables = [Response.__table__, Completion.__table__] if defer_indexes else []
+    with bind.begin() as connection:
+        with deferred_indexes(connection, tables):
+            if responses_path is not None:
+                imported = import_responses(connection, task, responses_path)
+                responses, completions = responses + imported[0], completions + imported[1]
+            if num_users > 0:
+                generated = generate_responses(connection, task, num_users, seed=seed)
+                responses, completions = responses + generated[0], completions + generated[1]
+        rebuild_counts(connection, task_id)
+    elapsed = perf_counter() - t0
+    rows = responses + completions
+    logger.info('Loaded {} responses and {} completions into task {} in {:.1f}s, {:.2f}s per million rows'.format(
+        responses, completions, task_id, elapsed, 1e6 * elapsed / rows if rows else 0.0))
+    return task_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quiz', default='./json/quiz.json', help='task definition, used unless --task-id is given')
+    parser.add_argument('--task-id', type=int, help='load into this existing task')
+    parser.add_argument('--title', default='The Network State Survey')
+    parser.add_argument('--description', default='')
+    parser.add_argument('--network', default='mumbai')
+    parser.add_argument('--contract-address', default='0x0')
+    parser.add_argument('--users', type=int, default=0, help='users with random answers to generate')
+    parser.add_argument('--responses', help='csv of user_fid,username,question,value rows to import')
+    parser.add_argument('--seed', type=int, help='random seed of the generated answers')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='build the response and completion indexes after loading, for large loads into small tables')
+    args = parser.parse_args()
+
+    quiz = None
+    if args.task_id is None:
+        with open(args.quiz, 'r') as f:
+            quiz = json.load(f)
+    bulk_import(quiz=quiz, task_id=args.task_id, num_users=args.users, responses_path=args.responses,
+                title=args.title, description=args.description, network=args.network,
+                contract_address=args.contract_address, seed=args.seed, defer_indexes=args.defer_indexes)
@@ -0,0 +1,153 @@
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from fastapi.encoders import jsonable_encoder
+from api.models import SessionLocal, Response, Completion
+from api.aggregates import chunks, response_by_value
+import csv
+import io
+import json
+import logging
+import os
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Rows per page of the paginated endpoints, and per query when streaming an export
+export_page_size = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+export_max_page_size = int(os.environ.get('EXPORT_MAX_PAGE_SIZE', 10000))
+
+response_columns = ['response_id', 'question_id', 'task_id', 'user_fid', 'username', 'value', 'submitted_at',
+                    'question', 'cluster', 'token_id', 'text']
+user_columns = ['username', 'token_id', 'user_fid', 'cluster']
+
+
+def latest_completions(db_session: Session, task_id, user_fids):
+    """
+    Returns { user_fid: (cluster_id, token_id) } of each user's latest completion of the task.
+    """
+    completions = {}
+    for chunk in chunks(list(user_fids)):
+        # filtered by task here, like latest_clusters, so the (user_fid, task_id) index is used over the task_id one
+        stmt = select(Completion.task_id, Completion.user_fid, Completion.cluster_id, Completion.token_id) \
+            .where(Completion.user_fid.in_(chunk)) \
+            .order_by(Completion.completion_id)
+        for completion_task_id, user_fid, cluster_id, token_id in db_session.execute(stmt):
+            if completion_task_id == task_id:
+                completions[user_fid] = (cluster_id, token_id)
+    return completions
+
+
+def cluster_names(task):
+    return {cluster.cluster_id: cluster.name for cluster in task.clusters.values()}
+
+
+def response_records(db_session: Session, task, username, after=None, limit=export_page_size):
+    """
+    The user's responses to the task with response_id above after, in response_id order, with the same
+    fields as the rows of the analytics frame. Served by the (task_id, username) index.
+    """
+    stmt = select(Response.response_id, Response.question_id, Response.task_id, Response.user_fid,
+                  Response.username, Response.value, Response.submitted_at) \
+        .where(Response.task_id == task.task_id, Response.username == username)
+    if after is not None:
+        stmt = stmt.where(Response.response_id > after)
+    rows = db_session.execute(stmt.order_by(Response.response_id).limit(limit)).all()
+
+    completions = latest_completions(db_session, task.task_id, {row.user_fid for row in rows})
+    names = cluster_names(task)
+    records = []
+    for row in rows:
+        question = task.questions_by_id.get(row.question_id)
+        cluster_id, token_id = completions.get(row.user_fid, (None, None))
+        records.append({
+            **row._asdict(),
+            'question': question.text if question is not None else None,
+            'cluster': names.get(cluster_id),
+            'token_id': token_id,
+            'text': response_by_value.get(row.value)
+        })
+    return records
+
+
+def user_records(db_session: Session, task, after=None, limit=export_page_size):
+    """
+    The users who answered the task with user_fid above after, in user_fid order. Served by the
+    (task_id, user_fid, username) index. Like /stats/all-users, a missing token id or cluster is 0.
+    """
+    stmt = select(Response.user_fid, func.min(Response.username).label('username')) \
+        .where(Response.task_id == task.task_id, Response.user_fid.is_not(None))
+    if after is not None:
+        stmt = stmt.where(Response.user_fid > after)
+    rows = db_session.execute(stmt.group_by(Response.user_fid).order_by(Response.user_fid).limit(limit)).all()
+
+    completions = latest_completions(db_session, task.task_id, [row.user_fid for row in rows])
+    names = cluster_names(task)
+    records = []
+    for row in rows:
+        cluster_id, token_id = completions.get(row.user_fid, (None, None))
+        records.append({
+            'username': row.username,
+            'token_id': token_id if token_id is not None else 0,
+            'user_fid': row.user_fid,
+            'cluster': names.get(cluster_id, 0)
+        })
+    return records
+
+
+def page(records, key, limit):
+    """
+    A page of records with the cursor of the next one, which is None on the last page.
+    """
+    return {
+        'items': records,
+        'next': records[-1][key] if len(records) == limit else None
+    }
+
+
+def encode_ndjson(records, columns):
+    return ''.join(json.dumps(record) + '\n' for record in jsonable_encoder(records))
+
+
+def encode_csv(records, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writerows(jsonable_encoder(records))
+    return buffer.getvalue()
+
+
+def csv_header(columns):
+    return ','.join(columns) + '\r\n'
+
+
+encoders = {
+    'ndjson': encode_ndjson,
+    'csv': encode_csv
+}
+
+media_types = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def stream_records(fetch, key, columns, export_format):
+    """
+    Yields fetch(db_session, after, limit) page by page, encoded as ndjson lines or csv rows. Each page is read
+    in a session of its own, so a slow client never holds a connection or a read transaction open for long,
+    and only one page is in memory at a time.
+    """
+    encode = encoders[export_format]
+    if export_format == 'csv':
+        yield csv_header(columns)
+    after = None
+    while True:
+        with SessionLocal() as db_session:
+            records = fetch(db_session, after, export_page_size)
+        if len(records) > 0:
+            yield encode(records, columns)
+        if len(records) < export_page_size:
+            return
+        after = records[-1][key]
@@ -0,0 +1,49 @@
+import logging
+import os
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+infura_key = os.environ.get('INFURA_API_KEY')
+# Provider for tasks on the 'local' network, e.g. 'test' (ape's in-memory chain) or 'geth' pointed at a dev node
+local_provider = os.environ.get('LOCAL_CHAIN_PROVIDER', 'test')
+
+infura_urls = {
+    'mumbai': 'https://polygon-mumbai.infura.io/v3/{}',
+    'polygon': 'https://polygon-mainnet.infura.io/v3/{}'
+}
+
+
+def network_provider(network_name):
+    if network_name == 'local':
+        return local_provider
+    if infura_key is None:
+        raise RuntimeError('INFURA_API_KEY is needed for the {} network'.format(network_name))
+    return infura_urls[network_name].format(infura_key)
+
+
+def network(network_name):
+    # ape sets up its plugins and networks when imported, which takes seconds, so it's left until the chain is used
+    from ape import networks
+    return {
+        'mumbai': networks.polygon.mumbai,
+        'polygon': networks.polygon.mainnet,
+        'local': networks.ethereum.local
+    }[network_name]
+
+
+def use_provider(network_name):
+    return network(network_name).use_provider(network_provider(network_name))
+
+
+def collection_size(task):
+    """
+    Number of tokens minted so far by the task's contract, read from chain.
+    """
+    from ape import project
+    with use_provider(task.network) as _:
+        nft_contract = project.SBT.at(task.contract_address)
+        return nft_contract.numIdentities(chain_id=network(task.network).chain_id)
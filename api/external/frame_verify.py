@@ -0,0 +1,298 @@
+from blake3 import blake3
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from api.external import hub_api
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from time import monotonic
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# 'remote' sends every message to neynar, 'local' verifies signatures of known signers here
+validation_mode = os.environ.get('FRAME_VALIDATION_MODE', 'remote')
+# Hub http api used to refresh the signer keys of known fids, e.g. https://hub.pinata.cloud
+hub_http_url = os.environ.get('FARCASTER_HUB_URL')
+signer_refresh_interval = float(os.environ.get('SIGNER_REFRESH_INTERVAL', 300))
+# Signers not verified against the hub for this long are dropped and go back to remote validation. Without
+# FARCASTER_HUB_URL they are never re-verified, so a revoked signer is trusted for at most this long
+signer_table_ttl = float(os.environ.get('SIGNER_TABLE_TTL', 3600))
+# Fids kept in the signer table, the least recently seen are dropped first
+signer_table_size = int(os.environ.get('SIGNER_TABLE_SIZE', 100000))
+
+# protobuf enum values from the farcaster message schema
+MESSAGE_TYPE_FRAME_ACTION = 13
+HASH_SCHEME_BLAKE3 = 1
+SIGNATURE_SCHEME_ED25519 = 1
+FARCASTER_NETWORK_MAINNET = 1
+# frames have at most four buttons, numbered from 1
+MAX_BUTTONS = 4
+
+# LRU of { fid: { 'signers': set of public keys, 'interactor': neynar user dict,
+#                 'refreshed_at': monotonic time the signers were last verified } }
+signer_table = OrderedDict()
+
+local_hits = 0
+remote_fallbacks = 0
+
+refresh_task = None
+
+
+class InvalidMessage(Exception):
+    pass
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise InvalidMessage('Truncated varint')
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise InvalidMessage('Varint too long')
+
+
+def parse_fields(buf):
+    """
+    Minimal protobuf wire format decoder, returns { field_number: value } keeping the last value of each field.
+    Varints are returned as ints and length delimited fields as bytes, which is all the frame schema needs.
+    """
+    fields = {}
+    pos = 0
+    while pos < len(buf):
+        tag, pos = read_varint(buf, pos)
+        field_number, wire_type = tag >> 3, tag & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            if pos + length > len(buf):
+                raise InvalidMessage('Truncated field {}'.format(field_number))
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type in (1, 5):
+            length = 8 if wire_type == 1 else 4
+            if pos + length > len(buf):
+                raise InvalidMessage('Truncated field {}'.format(field_number))
+            value = buf[pos:pos + length]
+            pos += length
+        else:
+            raise InvalidMessage('Unsupported wire type {}'.format(wire_type))
+        fields[field_number] = value
+    return fields
+
+
+def decode_message(messageBytes):
+    """
+    Decodes a hex encoded farcaster Message holding a FrameActionBody.
+    """
+    try:
+        raw = bytes.fromhex(messageBytes[2:] if messageBytes.startswith('0x') else messageBytes)
+    except ValueError:
+        raise InvalidMessage('Message is not hex encoded')
+
+    message = parse_fields(raw)
+    # data_bytes (7) is set when the signed bytes are not the canonical encoding of data (1)
+    data_bytes = message.get(7) or message.get(1)
+    if data_bytes is None:
+        raise InvalidMessage('Message has no data')
+    data = parse_fields(data_bytes)
+    body = parse_fields(data.get(16, b''))
+
+    return {
+        'data_bytes': data_bytes,
+        'hash': message.get(2, b''),
+        'hash_scheme': message.get(3, 0),
+        'signature': message.get(4, b''),
+        'signature_scheme': message.get(5, 0),
+        'signer': message.get(6, b''),
+        'type': data.get(1, 0),
+        'fid': data.get(2, 0),
+        'timestamp': data.get(3, 0),
+        'network': data.get(4, 0),
+        'url': body.get(1, b'').decode(errors='replace'),
+        'button_index': body.get(2, 0),
+        'input_text': body.get(4, b'').decode(errors='replace'),
+        'state': body.get(5, b'').decode(errors='replace'),
+    }
+
+
+def verify_signature(decoded):
+    if decoded['type'] != MESSAGE_TYPE_FRAME_ACTION:
+        raise InvalidMessage('Not a frame action')
+    if decoded['network'] != FARCASTER_NETWORK_MAINNET:
+        raise InvalidMessage('Wrong network')
+    if decoded['hash_scheme'] != HASH_SCHEME_BLAKE3 or decoded['signature_scheme'] != SIGNATURE_SCHEME_ED25519:
+        raise InvalidMessage('Unsupported hash or signature scheme')
+    if blake3(decoded['data_bytes']).digest(length=20) != decoded['hash']:
+        raise InvalidMessage('Hash mismatch')
+    try:
+        Ed25519PublicKey.from_public_bytes(decoded['signer']).verify(decoded['signature'], decoded['hash'])
+    except (InvalidSignature, ValueError):
+        raise InvalidMessage('Bad signature')
+
+
+def known_signer(fid, signer):
+    entry = signer_table.get(fid)
+    if entry is None or signer not in entry['signers']:
+        return None
+    if monotonic() - entry['refreshed_at'] > signer_table_ttl:
+        del signer_table[fid]
+        return None
+    signer_table.move_to_end(fid)
+    return entry
+
+
+def to_validate_response(decoded, interactor):
+    # Same shape as the parts of neynar's frame/validate response that show_task reads
+    return {
+        'valid': True,
+        'action': {
+            'url': decoded['url'],
+            'timestamp': decoded['timestamp'],
+            'interactor': interactor,
+            'tapped_button': {
+                'index': decoded['button_index']
+            },
+            'input': {
+                'text': decoded['input_text']
+            },
+            'state': {
+                'serialized': decoded['state']
+            }
+        }
+    }
+
+
+def learn_signer(decoded, message):
+    interactor = message['action']['interactor']
+    if interactor['fid'] != decoded['fid']:
+        logger.warning('Hub returned fid {} for message signed by fid {}'.format(interactor['fid'], decoded['fid']))
+        return
+    entry = signer_table.get(decoded['fid'])
+    if entry is None or monotonic() - entry['refreshed_at'] > signer_table_ttl:
+        # the hub has only vouched for this signer, an expired entry's others aren't carried over
+        entry = {'signers': set(), 'refreshed_at': monotonic()}
+        signer_table[decoded['fid']] = entry
+    # a signer added to a live entry expires with the ones verified before it
+    entry['signers'].add(decoded['signer'])
+    entry['interactor'] = interactor
+    signer_table.move_to_end(decoded['fid'])
+    while len(signer_table) > signer_table_size:
+        signer_table.popitem(last=False)
+
+
+async def validate_message_local(messageBytes):
+    """
+    Verifies the message signature locally when its signer is already known for the fid,
+    otherwise falls back to the hub and remembers the signer if the hub accepts the message.
+    """
+    global local_hits, remote_fallbacks
+    try:
+        decoded = decode_message(messageBytes)
+        verify_signature(decoded)
+        if not 1 <= decoded['button_index'] <= MAX_BUTTONS:
+            raise InvalidMessage('Button index {} out of range'.format(decoded['button_index']))
+    except InvalidMessage as e:
+        logger.warning('Rejecting frame message: {}'.format(e))
+        return None
+
+    entry = known_signer(decoded['fid'], decoded['signer'])
+    if entry is not None:
+        local_hits += 1
+        return to_validate_response(decoded, entry['interactor'])
+
+    remote_fallbacks += 1
+    message = await hub_api.validate_message_async(messageBytes)
+    if message is not None:
+        learn_signer(decoded, message)
+    return message
+
+
+def get_validator():
+    if validation_mode == 'local':
+        return validate_message_local
+    return hub_api.validate_message_async
+
+
+async def fetch_interactors(client, fids):
+    url = '{}/v2/farcaster/user/bulk'.format(hub_api.neynar_api_url)
+    response = await client.get(url, params={'fids': ','.join(str(fid) for fid in fids)})
+    response.raise_for_status()
+    return {user['fid']: user for user in response.json()['users']}
+
+
+async def fetch_signers(client, fid):
+    url = '{}/v1/onChainSignersByFid'.format(hub_http_url)
+    response = await client.get(url, params={'fid': fid})
+    response.raise_for_status()
+    return {
+        bytes.fromhex(event['signerEventBody']['key'][2:])
+        for event in response.json()['events']
+    }
+
+
+async def refresh_signer_table():
+    client = hub_api.get_async_client()
+    fids = list(signer_table)
+    # neynar's bulk user endpoint takes up to 100 fids per call
+    for i in range(0, len(fids), 100):
+        batch = fids[i:i + 100]
+        interactors = await fetch_interactors(client, batch)
+        for fid in batch:
+            entry = signer_table.get(fid)
+            if entry is None or fid not in interactors:
+                continue
+            if hub_http_url is not None:
+                # drops revoked signers, new ones are learned again through the remote fallback
+                entry['signers'] &= await fetch_signers(client, fid)
+                # only signers checked against the hub have their ttl renewed
+                entry['refreshed_at'] = monotonic()
+            entry['interactor'] = interactors[fid]
+    logger.info('Refreshed signer table for {} fids'.format(len(fids)))
+
+
+async def refresh_signer_table_forever():
+    while True:
+        await asyncio.sleep(signer_refresh_interval)
+        try:
+            await refresh_signer_table()
+        except Exception as e:
+            logger.error('Could not refresh signer table: {!r}'.format(e))
+
+
+def start_signer_refresh():
+    global refresh_task
+    if validation_mode == 'local' and hub_http_url is None:
+        logger.warning('FARCASTER_HUB_URL is not set, signers are trusted for SIGNER_TABLE_TTL ({:.0f}s) '
+                       'after the hub last accepted them, without checking for revocations'.format(signer_table_ttl))
+    if validation_mode == 'local' and refresh_task is None:
+        refresh_task = asyncio.ensure_future(refresh_signer_table_forever())
+
+
+def stop_signer_refresh():
+    global refresh_task
+    if refresh_task is not None:
+        refresh_task.cancel()
+    refresh_task = None
+
+
+def stats():
+    return {
+        'mode': validation_mode,
+        'known_fids': len(signer_table),
+        'max_fids': signer_table_size,
+        'local_hits': local_hits,
+        'remote_fallbacks': remote_fallbacks
+    }
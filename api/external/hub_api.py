@@ -1,7 +1,9 @@
-import requests
+import asyncio
+import hashlib
 import logging
 import os
-from time import time
+from collections import OrderedDict
+from time import time, monotonic
 
 # Configure the logging with time
 logging.basicConfig(level=logging.INFO,
@@ -15,6 +17,24 @@ tasks = {}
 secret_key = 'done!'
 api_key = os.environ.get('NEYNAR_API_KEY')
 
+# Base url is configurable so that a local stub of the hub can be used for benchmarking
+neynar_api_url = os.environ.get('NEYNAR_API_URL', 'https://api.neynar.com')
+validate_url = '{}/v2/farcaster/frame/validate'.format(neynar_api_url)
+
+# Settings for the shared async client used by the frame handlers
+hub_timeout = float(os.environ.get('HUB_TIMEOUT', 5.0))
+hub_connect_timeout = float(os.environ.get('HUB_CONNECT_TIMEOUT', 2.0))
+hub_max_connections = int(os.environ.get('HUB_MAX_CONNECTIONS', 100))
+hub_max_keepalive = int(os.environ.get('HUB_MAX_KEEPALIVE', 20))
+hub_max_concurrency = int(os.environ.get('HUB_MAX_CONCURRENCY', 64))
+
+# Settings for the cache of already validated messages
+message_cache_size = int(os.environ.get('HUB_CACHE_SIZE', 10000))
+message_cache_ttl = float(os.environ.get('HUB_CACHE_TTL', 600))
+
+async_client = None
+hub_semaphore = None
+
 def get_headers():
     return {
         "accept": "application/json",
@@ -23,27 +43,183 @@ def get_headers():
     }
 
 
-def validate_message(messageBytes):
-    url = "https://api.neynar.com/v2/farcaster/frame/validate"
-    payload = {
+def get_validate_payload(messageBytes):
+    return {
         "cast_reaction_context": False,
         "follow_context": True,
         'message_bytes_in_hex': messageBytes
     }
-    t0 = time()
-    response = requests.post(url, json=payload, headers=get_headers())
-    logger.info(f'Request to farcaster hub took {time() - t0:.2f} seconds')
-    if response.ok:
+
+
+def decode_validate_response(response, ok):
+    if ok:
         j = response.json()
         if j['valid']:
-            logger.info('Decoded message: {}'.format(j))
+            logger.debug('Decoded message: {}'.format(j))
             return j
     else:
         logger.error('message not ok {}'.format(response))
     return None
 
 
+def validate_message(messageBytes):
+    # only the blocking helpers use requests, the server goes through httpx and never loads it
+    import requests
+    t0 = time()
+    response = requests.post(validate_url, json=get_validate_payload(messageBytes), headers=get_headers())
+    logger.info(f'Request to farcaster hub took {time() - t0:.2f} seconds')
+    return decode_validate_response(response, response.ok)
+
+
+def get_async_client():
+    # Created lazily so the client and semaphore belong to the running event loop
+    global async_client, hub_semaphore
+    if async_client is None:
+        # httpx and the transports it loads take a while to import, so the server imports it on the first frame
+        import httpx
+        # httpx rejects None header values, requests silently drops them
+        headers = {key: value for key, value in get_headers().items() if value is not None}
+        async_client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(hub_timeout, connect=hub_connect_timeout),
+            limits=httpx.Limits(max_connections=hub_max_connections,
+                                max_keepalive_connections=hub_max_keepalive)
+        )
+        hub_semaphore = asyncio.Semaphore(hub_max_concurrency)
+    return async_client
+
+
+async def close_async_client():
+    global async_client, hub_semaphore
+    if async_client is not None:
+        await async_client.aclose()
+    async_client = None
+    hub_semaphore = None
+
+
+async def validate_message_async(messageBytes):
+    import httpx
+    client = get_async_client()
+    t0 = time()
+    try:
+        async with hub_semaphore:
+            response = await client.post(validate_url, json=get_validate_payload(messageBytes))
+    except httpx.HTTPError as e:
+        logger.error('Request to farcaster hub failed: {!r}'.format(e))
+        return None
+    logger.info(f'Request to farcaster hub took {time() - t0:.2f} seconds')
+    return decode_validate_response(response, response.is_success)
+
+
+class VerifiedMessageCache:
+    """
+    Bounded LRU of validated messages keyed by a hash of the message bytes, with a ttl per entry.
+    Concurrent requests for the same message share a single upstream call. A message is only reported as a
+    duplicate once a request carrying it was handled, so the retry of a request that failed is handled again.
+    Only used from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # { key: (expires_at, message, handled) }
+        self.in_flight = {}  # { key: future }
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+
+    @staticmethod
+    def key(messageBytes):
+        return hashlib.sha256(messageBytes.encode()).digest()
+
+    def get(self, key):
+        """
+        Returns (message, handled), or None if the message isn't cached.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, message, handled = entry
+        if expires_at < monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return message, handled
+
+    def put(self, key, message):
+        self.entries[key] = (monotonic() + self.ttl, message, False)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def mark_handled(self, messageBytes):
+        """
+        Call once the request carrying the message succeeded, later ones carrying it are then duplicates.
+        """
+        key = self.key(messageBytes)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries[key] = (entry[0], entry[1], True)
+
+    async def get_or_validate(self, messageBytes, validate):
+        """
+        Returns (message, duplicate), where duplicate is True if a request carrying the message was already
+        handled. Requests joining another's in-flight validation aren't duplicates yet, as that request may still
+        fail; handling the same tap twice only writes the same answer twice.
+        """
+        key = self.key(messageBytes)
+
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.joins += 1
+            # shield so a cancelled joiner doesn't cancel the call for everyone else
+            return await asyncio.shield(future), False
+
+        self.misses += 1
+        future = asyncio.ensure_future(validate(messageBytes))
+        self.in_flight[key] = future
+        try:
+            message = await asyncio.shield(future)
+        finally:
+            self.in_flight.pop(key, None)
+
+        # invalid messages are not cached, so a transient hub failure can be retried
+        if message is not None:
+            self.put(key, message)
+        return message, False
+
+    def stats(self):
+        lookups = self.hits + self.joins + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'in_flight': len(self.in_flight),
+            'hits': self.hits,
+            'joins': self.joins,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.joins) / lookups if lookups else 0.0
+        }
+
+
+message_cache = VerifiedMessageCache(message_cache_size, message_cache_ttl)
+
+
+async def validate_message_cached(messageBytes, validate=validate_message_async):
+    return await message_cache.get_or_validate(messageBytes, validate)
+
+
+def mark_message_handled(messageBytes):
+    message_cache.mark_handled(messageBytes)
+
+
 def get_user(addr):
+    import requests
     addr = addr.lower()
     url = 'https://api.neynar.com/v2/farcaster/user/bulk-by-address?addresses={}'.format(addr)
     response = requests.get(url, headers=get_headers())
@@ -64,6 +240,7 @@ def get_user(addr):
 
 
 def get_recent_casts(fid):
+    import requests
     url = 'https://api.neynar.com/v1/farcaster/casts?fid=3&viewerFid={}&limit=25'.format(fid)
     response = requests.get(url, headers=get_headers())
     if response.ok:
@@ -93,6 +270,7 @@ def find_earn(casts):
 
 
 def get_replies(cast_hash, thread_hash, fid):
+    import requests
     url = 'https://api.neynar.com/v1/farcaster/all-casts-in-thread?threadHash={}&viewerFid={}'.format(thread_hash, fid)
     response = requests.get(url, headers=get_headers())
     if response.ok:
@@ -1,17 +1,39 @@
-import requests
+import httpx
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import threading
 
 pinata_api_key = os.environ.get('PINATA_API_KEY')
 pinata_api_secret = os.environ.get('PINATA_API_SECRET')
 pinata_jwt = os.environ.get('PINATA_JWT')
 
+# Base url is configurable so that a local stand-in can be used for benchmarking
+pinata_api_url = os.environ.get('PINATA_API_URL', 'https://api.pinata.cloud')
+pin_file_path = '/pinning/pinFileToIPFS'
+
+ipfs_timeout = float(os.environ.get('IPFS_TIMEOUT', 60.0))
+ipfs_max_connections = int(os.environ.get('IPFS_MAX_CONNECTIONS', 16))
+# uploads in flight at once in a batch
+ipfs_pin_concurrency = int(os.environ.get('IPFS_PIN_CONCURRENCY', 8))
+# sha256 of pinned content -> IpfsHash, one json object per line
+ipfs_pin_cache_path = os.environ.get('IPFS_PIN_CACHE', './ipfs_pins.jsonl')
+
 # Configure the logging with time
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 logger = logging.getLogger(__name__)
 
+client = None
+client_lock = threading.Lock()
+
+# pin_batch runs on an event loop of its own in a background thread, so its client, and the connections it keeps
+# alive, outlive a batch. { 'pid', 'loop', 'client' }, started by the first batch of each process
+pin_loop = None
+
 
 def get_headers():
     return {
@@ -20,32 +42,171 @@ def get_headers():
     }
 
 
-def pin_img(path):
-    image = open(path, 'rb')
-    filename = path.split('/')[-1]
-    files = {
-        'file': (filename, image)
-    }
-    response = requests.post('https://api.pinata.cloud/pinning/pinFileToIPFS', files=files, headers=get_headers())
+def get_limits():
+    return httpx.Limits(max_connections=ipfs_max_connections, max_keepalive_connections=ipfs_max_connections)
+
+
+def get_client():
+    # one pooled client for the blocking helpers, shared by all threads
+    global client
+    with client_lock:
+        if client is None:
+            client = httpx.Client(base_url=pinata_api_url, headers=get_headers(), timeout=ipfs_timeout,
+                                  limits=get_limits())
+    return client
+
+
+def get_pin_loop():
+    global pin_loop
+    with client_lock:
+        # a forked worker inherits the parent's but not its thread
+        if pin_loop is None or pin_loop['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='ipfs-pinning', daemon=True).start()
+            pin_loop = {'pid': os.getpid(), 'loop': loop, 'client': None}
+    return pin_loop
+
+
+def get_async_client():
+    # only called on the pinning loop, which owns the client
+    loop = get_pin_loop()
+    if loop['client'] is None:
+        loop['client'] = httpx.AsyncClient(base_url=pinata_api_url, headers=get_headers(), timeout=ipfs_timeout,
+                                           limits=get_limits())
+    return loop['client']
+
+
+class PinCache:
+    """
+    Content-addressed record of what was already pinned, so the same bytes are never uploaded twice.
+    Kept in memory and appended to a file, which is read back on startup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}  # { sha256 hex digest: IpfsHash }
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash while appending
+                        continue
+                    self.hashes[entry['sha256']] = entry['IpfsHash']
+            logger.info('Loaded {} pinned hashes from {}'.format(len(self.hashes), path))
+
+    def get(self, digest):
+        ipfs_hash = self.hashes.get(digest)
+        if ipfs_hash is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ipfs_hash
+
+    def put(self, digest, ipfs_hash):
+        with self.lock:
+            if self.hashes.get(digest) == ipfs_hash:
+                return
+            self.hashes[digest] = ipfs_hash
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'sha256': digest, 'IpfsHash': ipfs_hash}) + '\n')
+
+    def stats(self):
+        return {'size': len(self.hashes), 'hits': self.hits, 'misses': self.misses}
+
+
+pin_cache = PinCache(ipfs_pin_cache_path)
+
+
+def content_digest(content: bytes):
+    return hashlib.sha256(content).hexdigest()
+
+
+def decode_pin_response(filename, digest, response):
     j = response.json()
-    if response.ok:
-        logger.info('Successfully pinned: {}'.format(j))
-    else:
+    if not response.is_success:
         logger.error('Could not pin {}: {}'.format(filename, j))
+        response.raise_for_status()
+    logger.info('Successfully pinned: {}'.format(j))
+    pin_cache.put(digest, j['IpfsHash'])
     return j['IpfsHash']
 
 
+def pin_bytes(filename, content: bytes, content_type='application/octet-stream'):
+    digest = content_digest(content)
+    ipfs_hash = pin_cache.get(digest)
+    if ipfs_hash is not None:
+        logger.info('Already pinned {}: {}'.format(filename, ipfs_hash))
+        return ipfs_hash
+    response = get_client().post(pin_file_path, files={'file': (filename, content, content_type)})
+    return decode_pin_response(filename, digest, response)
+
+
+def pin_img(path):
+    with open(path, 'rb') as image:
+        content = image.read()
+    return pin_bytes(path.split('/')[-1], content)
+
+
 def pin_text(filename, text):
     logger.info('Pinning {}:{} to ipfs'.format(filename, text))
-    files = {
-        'file': (filename, text, 'text/plain')
-    }
-    response = requests.post('https://api.pinata.cloud/pinning/pinFileToIPFS', files=files, headers=get_headers())
-    j = response.json()
-    if response.ok:
-        logger.info('Successfully pinned: {}'.format(j))
-    else:
-        logger.error('Could not pin {}: {}'.format(filename, j))
-    return j['IpfsHash']
+    return pin_bytes(filename, text.encode(), 'text/plain')
+
+
+async def pin_batch(files):
+    """
+    Pins (filename, content, content_type) tuples concurrently over the process' pooled connections.
+    Returns the IpfsHash of each file in order, or the exception that pinning it raised.
+    Files with the same content are uploaded once. Runs on the pinning loop, call it through run_pin_batch.
+    """
+    digests = [content_digest(content) for _, content, _ in files]
+    uploads = {}  # { digest: index of the first file with that content }
+    for i, digest in enumerate(digests):
+        if pin_cache.get(digest) is None:
+            uploads.setdefault(digest, i)
+
+    results = {}
+    if uploads:
+        semaphore = asyncio.Semaphore(ipfs_pin_concurrency)
+        async_client = get_async_client()
+
+        async def upload(digest, i):
+            filename, content, content_type = files[i]
+            async with semaphore:
+                response = await async_client.post(pin_file_path, files={'file': (filename, content, content_type)})
+            return decode_pin_response(filename, digest, response)
+
+        hashes = await asyncio.gather(*[upload(digest, i) for digest, i in uploads.items()], return_exceptions=True)
+        results = dict(zip(uploads, hashes))
+        logger.info('Pinned {} of {} files, the rest were already pinned'.format(len(uploads), len(files)))
+
+    return [results[digest] if digest in results else pin_cache.hashes[digest] for digest in digests]
+
+
+def run_pin_batch(files):
+    """
+    Blocking pin_batch, for callers without an event loop or with one of their own.
+    """
+    return asyncio.run_coroutine_threadsafe(pin_batch(files), get_pin_loop()['loop']).result()
+
+
+def pin_files(paths):
+    """
+    Blocking wrapper around pin_batch for files on disk. Raises the first error, if any.
+    """
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append((path.split('/')[-1], f.read(), 'application/octet-stream'))
+    hashes = run_pin_batch(files)
+    for ipfs_hash in hashes:
+        if isinstance(ipfs_hash, Exception):
+            raise ipfs_hash
+    return hashes
 
 # pin_img('img/questions/0.png')
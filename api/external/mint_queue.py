@@ -0,0 +1,39 @@
+import logging
+import os
+import threading
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+broker_url = 'pyamqp://guest@localhost//'
+# completions finishing within this many seconds of each other are minted in one batch
+mint_batch_window = float(os.environ.get('MINT_BATCH_WINDOW', 2))
+
+# The server's side of the minter. Tasks are sent by name, so the server never imports api.external.minter
+# and ape with it, and celery is only imported when the first task is sent
+client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            from celery import Celery
+            client = Celery('minter', broker=broker_url)
+        return client
+
+
+def health_check():
+    get_client().send_task('api.external.minter.health_check')
+
+
+def queue_mint():
+    """
+    Schedules a batch for completions marked as queued. Calls within the same window all find the same rows,
+    whichever batch runs first claims them and the others end up empty.
+    """
+    get_client().send_task('api.external.minter.mint_pending', countdown=mint_batch_window)
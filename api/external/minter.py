@@ -1,19 +1,35 @@
 from celery import Celery
-from ape import accounts, project, networks
-from celery.signals import worker_init
+from ape import accounts, project
+from celery.signals import worker_init, worker_ready
+from itertools import groupby
+from sqlalchemy import update, or_, and_
+from urllib.parse import quote
 import logging
 import os
 import pwd
 import json
-from .ipfs import pin_text
-from api.models import SessionLocal, Completion
-
-db_session = SessionLocal()
+from time import time
+from .ipfs import run_pin_batch
+from .chain import use_provider
+from .mint_queue import broker_url, mint_batch_window
+from web3.exceptions import TransactionNotFound
+from api.models import engine, SessionLocal, Base, Completion, MinterNonce, add_missing_columns
+from api.aggregates import upsert_dialects
+from api.token_ids import token_allocator
 
 # Get the current process's user ID
 uid = os.getuid()
 
-infura_key = os.environ.get('INFURA_API_KEY')
+# alias of the ape account that mints, or 'test' for the first test account of a local dev chain
+minter_account = os.environ.get('MINTER_ACCOUNT', 'dev')
+mint_batch_size = int(os.environ.get('MINT_BATCH_SIZE', 50))
+mint_max_attempts = int(os.environ.get('MINT_MAX_ATTEMPTS', 3))
+# a batch claimed this long ago by a worker that never finished it is picked up again
+mint_claim_timeout = float(os.environ.get('MINT_CLAIM_TIMEOUT', 600))
+mint_confirm_interval = float(os.environ.get('MINT_CONFIRM_INTERVAL', 5))
+mint_confirm_retries = int(os.environ.get('MINT_CONFIRM_RETRIES', 120))
+# how often mints still unconfirmed after confirm_mints gave up on them are checked again, and dropped ones requeued
+mint_sweep_interval = float(os.environ.get('MINT_SWEEP_INTERVAL', 600))
 
 # Get the user name from the user ID
 user_name = pwd.getpwuid(uid).pw_name
@@ -26,21 +42,29 @@ logger = logging.getLogger(__name__)
 
 logger.info(f"The process is running as: {user_name}")
 
-app = Celery('minter', broker='pyamqp://guest@localhost//')
+app = Celery('minter', broker=broker_url)
 
 account = None
-
-network_provider = {
-    'mumbai': 'https://polygon-mumbai.infura.io/v3/' + infura_key,
-    'polygon': 'https://polygon-mainnet.infura.io/v3/' + infura_key
-}
+synced_nonces = set()  # networks whose nonce this worker resynced from chain since it started
 
 
 @worker_init.connect
 def on_worker_init(**kwargs):
     global account
-    account = accounts.load('dev')
-    account.set_autosign(True)
+    if minter_account == 'test':
+        account = accounts.test_accounts[0]
+    else:
+        account = accounts.load(minter_account)
+        account.set_autosign(True)
+    add_missing_columns(Completion.__table__)
+    Base.metadata.create_all(engine, tables=[MinterNonce.__table__])
+
+
+@worker_ready.connect
+def on_worker_ready(**kwargs):
+    # picks up completions queued while no worker was running, and mints whose confirmation was lost with one
+    mint_pending.delay()
+    sweep_submitted.delay()
 
 
 @app.task
@@ -49,41 +73,325 @@ def health_check():
     return 'ok'
 
 
+def queue_mint():
+    # mint_queue.queue_mint, for the worker's own use
+    mint_pending.apply_async(countdown=mint_batch_window)
+
+
 @app.task
 def mint_to(completion_id, metadata, recipient_address, token_id):
-    network = {
-        'mumbai': networks.polygon.mumbai,
-        'polygon': networks.polygon.mainnet
-    }
-
-    completion = db_session.query(Completion).filter_by(completion_id=completion_id).first()
-    logger.info('Minting {} nft to {}, minter: {}'.format(completion.cluster.name, recipient_address, account))
-
-    with network[completion.task.network].use_provider(network_provider[completion.task.network]) as _:
-        tries = 0
-        success = False
-        while tries < 3:
+    # kept for messages enqueued before minting was batched
+    with SessionLocal() as db_session:
+        db_session.execute(
+            update(Completion)
+            .where(Completion.completion_id == completion_id)
+            .values(recipient=recipient_address, mint_metadata=json.dumps(metadata), mint_status='queued')
+        )
+        db_session.commit()
+    queue_mint()
+
+
+def claimable():
+    return or_(
+        Completion.mint_status == 'queued',
+        and_(Completion.mint_status == 'pinning', Completion.claimed_at < time() - mint_claim_timeout)
+    )
+
+
+def mint_order():
+    # tokens are numbered in the order their mints land, which has to be the order their ids were allocated in
+    return Completion.allocated_token_id, Completion.completion_id
+
+
+def claim_batch(db_session):
+    """
+    Marks up to mint_batch_size queued completions as this worker's, returns them in allocation order.
+    """
+    ids = [
+        completion_id for (completion_id,) in db_session.query(Completion.completion_id)
+        .filter(claimable())
+        .order_by(*mint_order())
+        .limit(mint_batch_size)
+    ]
+    if len(ids) == 0:
+        return []
+    # the status check is repeated in the UPDATE, so rows another worker claimed in the meantime are skipped
+    claimed = db_session.execute(
+        update(Completion)
+        .where(Completion.completion_id.in_(ids), claimable())
+        .values(mint_status='pinning', claimed_at=time(), mint_attempts=Completion.mint_attempts + 1)
+        .returning(Completion.completion_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db_session.commit()
+    return db_session.query(Completion) \
+        .filter(Completion.completion_id.in_(claimed)) \
+        .order_by(*mint_order()) \
+        .all()
+
+
+def pin_metadata(completions):
+    """
+    Returns { completion_id: token uri, or the exception pinning its metadata raised }, pinning the batch concurrently.
+    """
+    uris = {}
+    files = {}
+    for completion in completions:
+        if completion.allocated_token_id is not None:
+            # the id may have been reconciled with chain since the metadata was built
+            metadata = json.loads(completion.mint_metadata)
+            metadata['token_id'] = completion.allocated_token_id
+            completion.mint_metadata = json.dumps(metadata)
+        if completion.task.network == 'local':
+            # nothing on a dev chain needs to resolve the uri
+            uris[completion.completion_id] = 'data:application/json,{}'.format(quote(completion.mint_metadata))
+        else:
+            filename = '{}-{}.json'.format(completion.recipient, completion.cluster.name)
+            files[completion.completion_id] = (filename, completion.mint_metadata.encode(), 'text/plain')
+    if files:
+        hashes = run_pin_batch(list(files.values()))
+        for completion_id, ipfs_hash in zip(files, hashes):
+            uris[completion_id] = ipfs_hash if isinstance(ipfs_hash, Exception) else 'ipfs://{}'.format(ipfs_hash)
+    return uris
+
+
+def requeue(db_session, completion):
+    """
+    Puts a completion back in the queue. It is now minted after the ones allocated since, so it gets the next id;
+    the ones between its old and new id are shifted back when the first of them is confirmed.
+    """
+    completion.mint_status = 'queued'
+    if completion.allocated_token_id is not None:
+        completion.allocated_token_id = token_allocator.allocate(db_session, completion.task)
+
+
+def release(db_session, completion, error):
+    """
+    Puts a completion back in the queue, or gives up on it after mint_max_attempts.
+    """
+    logger.error('Could not mint completion {}: {}'.format(completion.completion_id, error))
+    if completion.mint_attempts >= mint_max_attempts:
+        logger.error('Minting completion {} failed too many times. Not retrying'.format(completion.completion_id))
+        completion.mint_status = 'failed'
+        write_result(completion, False)
+    else:
+        requeue(db_session, completion)
+
+
+def pending_nonce(provider):
+    return provider.web3.eth.get_transaction_count(account.address, 'pending')
+
+
+def nonce_filter(network):
+    return (MinterNonce.network == network) & (MinterNonce.address == account.address)
+
+
+def lock_nonce(db_session, network, provider):
+    """
+    Returns the account's next nonce on the network, keeping its row locked until the session commits, so other
+    workers' batches wait for this one's. The first batch since the worker started resyncs it with chain.
+    """
+    lock = update(MinterNonce) \
+        .where(nonce_filter(network)) \
+        .values(next_nonce=MinterNonce.next_nonce) \
+        .returning(MinterNonce.next_nonce)
+    nonce = db_session.execute(lock).scalar()
+    if nonce is None:
+        insert = upsert_dialects[engine.dialect.name]
+        db_session.execute(insert(MinterNonce.__table__).values(
+            network=network, address=account.address, next_nonce=pending_nonce(provider), synced_at=time()
+        ).on_conflict_do_nothing())
+        nonce = db_session.execute(lock).scalar()
+    elif network not in synced_nonces:
+        # transactions sent from elsewhere, e.g. by hand, moved it on
+        nonce = max(nonce, pending_nonce(provider))
+    synced_nonces.add(network)
+    return nonce
+
+
+def store_nonce(db_session, network, nonce):
+    db_session.execute(update(MinterNonce).where(nonce_filter(network)).values(next_nonce=nonce, synced_at=time()))
+
+
+def submit(db_session, completions):
+    """
+    Sends one mint per completion, all to the same contract, with consecutive nonces and without waiting for
+    receipts in between. Stops at the first transaction that can't be sent, since every later nonce would be stuck
+    behind it, and puts the rest back in the queue.
+    """
+    task = completions[0].task
+    with use_provider(task.network) as provider:
+        nft_contract = project.SBT.at(task.contract_address)
+        nonce = lock_nonce(db_session, task.network, provider)
+        for i, completion in enumerate(completions):
             try:
-                filename = '{}-{}.json'.format(recipient_address, completion.cluster.name)
-                hash = pin_text(filename, json.dumps(metadata))
-
-                nft_contract = project.SBT.at(completion.task.contract_address)
-                receipt = nft_contract.mint(recipient_address, 'ipfs://{}'.format(hash), sender=account)
-                if not receipt.failed:
-                    success = True
-                    completion.token_id = token_id
-                    db_session.commit()
-                    break
+                txn = nft_contract.mint.as_transaction(completion.recipient, completion.token_uri,
+                                                       sender=account, nonce=nonce)
+                txn = account.sign_transaction(account.prepare_transaction(txn))
+                tx_hash = provider.web3.eth.send_raw_transaction(txn.serialize_transaction())
             except Exception as e:
-                logger.error('Transaction failed: {}'.format(e))
+                release(db_session, completion, e)
+                for unsent in completions[i + 1:]:
+                    # not their fault, so this doesn't count as one of their attempts
+                    requeue(db_session, unsent)
+                    unsent.mint_attempts -= 1
+                try:
+                    # in case the node took the transaction after all
+                    nonce = pending_nonce(provider)
+                except Exception as e:
+                    logger.warning('Could not resync the nonce of {}: {!r}'.format(account.address, e))
+                break
+            completion.tx_hash = tx_hash.hex()
+            completion.mint_status = 'submitted'
+            nonce += 1
+        store_nonce(db_session, task.network, nonce)
+
+
+@app.task
+def mint_pending():
+    """
+    Mints a batch of queued completions: pins their metadata concurrently, submits the mints back to back
+    and leaves the receipts to confirm_mints.
+    """
+    with SessionLocal() as db_session:
+        completions = claim_batch(db_session)
+        if len(completions) == 0:
+            return 0
+        logger.info('Minting a batch of {} completions, minter: {}'.format(len(completions), account))
+
+        uris = pin_metadata(completions)
+        pinned = []
+        for completion in completions:
+            uri = uris[completion.completion_id]
+            if isinstance(uri, Exception):
+                release(db_session, completion, uri)
+            else:
+                completion.token_uri = uri
+                pinned.append(completion)
+        db_session.commit()
+
+        def contract_of(completion):
+            return completion.task.network, completion.task.contract_address
 
-            tries += 1
+        for _, group in groupby(sorted(pinned, key=contract_of), key=contract_of):
+            submit(db_session, list(group))
+        db_session.commit()
 
-    if not success:
-        logger.error('Transaction failed too many times. Not retrying')
+        submitted = [completion.completion_id for completion in completions if completion.mint_status == 'submitted']
+        requeued = any(completion.mint_status == 'queued' for completion in completions)
 
+    if len(submitted) > 0:
+        confirm_mints.apply_async(args=[submitted], countdown=mint_confirm_interval)
+    if requeued:
+        queue_mint()
+    return len(submitted)
+
+
+def minted_token_id(nft_contract, receipt):
+    for log in receipt.decode_logs(nft_contract.IdentityCreated):
+        return log.token
+    return None
+
+
+def dropped(provider, tx_hash):
+    """
+    Whether a transaction without a receipt can no longer be mined: the node doesn't know it, or another
+    transaction of the same sender was mined with its nonce.
+    """
+    try:
+        txn = provider.web3.eth.get_transaction(tx_hash)
+    except TransactionNotFound:
+        return True
+    return txn['blockNumber'] is None and txn['nonce'] < provider.web3.eth.get_transaction_count(txn['from'])
+
+
+def check_mints(db_session, completions, sweep=False):
+    """
+    Marks the completions whose mints landed as minted and puts the reverted ones back in the queue. When sweeping,
+    the ones whose transaction was dropped are put back too. Returns the ids of the ones still pending.
+    """
+    pending = []
+    for completion in completions:
+        task = completion.task
+        with use_provider(task.network) as provider:
+            try:
+                receipt = provider.get_receipt(completion.tx_hash, timeout=0)
+            except Exception:
+                # not mined yet
+                if sweep and dropped(provider, completion.tx_hash):
+                    release(db_session, completion, 'transaction {} was dropped'.format(completion.tx_hash))
+                    # its nonce may have been left unused, which would hold up every later one
+                    lock_nonce(db_session, task.network, provider)
+                    store_nonce(db_session, task.network, pending_nonce(provider))
+                else:
+                    pending.append(completion.completion_id)
+                continue
+            if receipt.failed:
+                release(db_session, completion, 'transaction {} reverted'.format(completion.tx_hash))
+            else:
+                completion.token_id = minted_token_id(project.SBT.at(task.contract_address), receipt)
+                completion.mint_status = 'minted'
+                if completion.token_id is not None and completion.allocated_token_id is not None:
+                    token_allocator.reconcile(db_session, task, completion.allocated_token_id,
+                                              completion.token_id)
+                    completion.allocated_token_id = completion.token_id
+                write_result(completion, True)
+    return pending
+
+
+@app.task(bind=True, max_retries=mint_confirm_retries)
+def confirm_mints(self, completion_ids):
+    """
+    Checks the receipts of submitted mints, and retries itself until none of them is pending anymore. The ones
+    still pending after the last retry are left to sweep_submitted.
+    """
+    with SessionLocal() as db_session:
+        completions = db_session.query(Completion) \
+            .filter(Completion.completion_id.in_(completion_ids), Completion.mint_status == 'submitted') \
+            .order_by(*mint_order()) \
+            .all()
+        pending = check_mints(db_session, completions)
+        requeued = any(completion.mint_status == 'queued' for completion in completions)
+        db_session.commit()
+
+    if requeued:
+        queue_mint()
+    if len(pending) > 0:
+        if self.request.retries < self.max_retries:
+            raise self.retry(args=[pending], countdown=mint_confirm_interval)
+        logger.warning('Mints of completions {} are still pending, leaving them to the sweep'.format(pending))
+    return len(completions) - len(pending)
+
+
+@app.task
+def sweep_submitted():
+    """
+    Settles the mints submitted more than mint_sweep_interval ago that are still unconfirmed: minted and reverted
+    ones like confirm_mints would, and dropped ones are put back in the queue. Runs every mint_sweep_interval.
+    """
+    with SessionLocal() as db_session:
+        completions = db_session.query(Completion) \
+            .filter(Completion.mint_status == 'submitted', Completion.claimed_at < time() - mint_sweep_interval) \
+            .order_by(*mint_order()) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        pending = check_mints(db_session, completions, sweep=True)
+        requeued = any(completion.mint_status == 'queued' for completion in completions)
+        db_session.commit()
+
+    if requeued:
+        queue_mint()
+    return len(completions) - len(pending)
+
+
+app.conf.beat_schedule = {
+    'sweep-submitted': {'task': sweep_submitted.name, 'schedule': mint_sweep_interval}
+}
+
+
+def write_result(completion, success):
     with open('./results.tsv', 'a') as f:
-        result = '{}\t{}\t{}\t{}\t{}\n'.format(hash, recipient_address, completion.token_id, completion.user_fid, success)
+        result = '{}\t{}\t{}\t{}\t{}\n'.format(completion.token_uri, completion.recipient, completion.token_id,
+                                                completion.user_fid, success)
         logger.info('Writing to results: {}'.format(result))
         f.write(result)
-
@@ -0,0 +1,51 @@
+from api.image_render import get_question_template
+import json
+import os
+
+url_stem = 'https://earthnetcdn.com'
+
+# 'ipfs' points frames at the question images pinned ahead of time, 'dynamic' at /image/question, rendered on demand
+frame_image_mode = os.environ.get('FRAME_IMAGE_MODE', 'ipfs')
+image_url_stem = os.environ.get('IMAGE_URL_STEM', url_stem)
+
+button_titles = json.load(open('./json/button_titles.json', 'r'))
+
+
+def get_image_tags(url):
+    return '''
+        <meta property="og:title" content="The Network State Survey"/>
+        <meta property="og:image" content="{}">
+        <meta property="fc:frame" content="vNext"/>
+        <meta property="fc:frame:image" content="{}">
+        <meta property="fc:frame:image:aspect_ratio" content="1.91:1"/>
+    '''.format(url, url)
+
+
+def get_button_tags(task_id: int, page_num: int):
+    tags = [
+        '''
+            <meta property="fc:frame:button:{}" content="{}">
+            <meta property="fc:frame:button:{}:action" content="post">
+        '''.format(index + 1, title, index + 1)
+        for index, title in enumerate(button_titles)
+    ]
+
+    return ''.join(tags) + '<meta property="fc:frame:post_url" content="{}/task/{}/{}">'.format(url_stem, task_id,
+                                                                                                page_num)
+
+
+def get_image_version(text):
+    # changes whenever the image would, so the url can be cached forever
+    return get_question_template().render_key(text)[:16]
+
+
+def get_question_image_url(task_id: int, question):
+    if frame_image_mode == 'dynamic':
+        return '{}/image/question/{}/{}.png?v={}'.format(image_url_stem, task_id, question.question_id,
+                                                         get_image_version(question.text))
+    return 'https://gateway.pinata.cloud/ipfs/{}'.format(question.image_ipfs_hash)
+
+
+def get_question_meta_tags(task_id: int, page_num: int, question):
+    return '{}{}'.format(get_image_tags(get_question_image_url(task_id, question)),
+                         get_button_tags(task_id, page_num + 1))
@@ -0,0 +1,105 @@
+from prometheus_client import Histogram, CollectorRegistry, REGISTRY, multiprocess
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from contextlib import contextmanager
+from sqlalchemy import event
+from random import random
+from time import perf_counter
+import logging
+import os
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Fraction of stage executions that are timed, request latency is always recorded
+stage_sample_rate = float(os.environ.get('METRICS_STAGE_SAMPLE_RATE', 1.0))
+# Set when the server runs several workers, see run-server-prod.sh: each one writes its histograms to files
+# there, which /metrics adds up, so a scrape sees every worker's requests whichever worker answers it
+multiprocess_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+latency_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+request_latency = Histogram('http_request_duration_seconds', 'Request latency by route',
+                            ['method', 'route', 'status'], buckets=latency_buckets)
+stage_latency = Histogram('stage_duration_seconds', 'Latency of the stages of a request, sampled',
+                          ['stage'], buckets=latency_buckets)
+
+
+def sampled():
+    return stage_sample_rate >= 1.0 or random() < stage_sample_rate
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Times the block as the given stage, for the sampled fraction of executions.
+    """
+    if not sampled():
+        yield
+        return
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.labels(stage).observe(perf_counter() - t0)
+
+
+def observe_request(method, route, status, seconds):
+    request_latency.labels(method, route, status).observe(seconds)
+
+
+def instrument_engine(engine):
+    """
+    Times every sampled statement run on the engine as the db_query stage.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_started_at = perf_counter() if sampled() else None
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context.query_started_at is not None:
+            stage_latency.labels('db_query').observe(perf_counter() - context.query_started_at)
+
+
+class CacheCollector:
+    """
+    Reports hits, misses and hit ratio of the in-process caches, read from their stats() when scraped.
+    """
+
+    def __init__(self):
+        self.caches = {}  # { name: object with stats() returning hits and misses }
+
+    def register(self, name, cache):
+        self.caches[name] = cache
+
+    def collect(self):
+        hits = CounterMetricFamily('cache_hits', 'Cache hits', labels=['cache'])
+        misses = CounterMetricFamily('cache_misses', 'Cache misses', labels=['cache'])
+        ratio = GaugeMetricFamily('cache_hit_ratio', 'Cache hits over lookups', labels=['cache'])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            cache_hits = stats['hits'] + stats.get('joins', 0) + stats.get('disk_hits', 0)
+            lookups = cache_hits + stats['misses']
+            hits.add_metric([name], cache_hits)
+            misses.add_metric([name], stats['misses'])
+            ratio.add_metric([name], cache_hits / lookups if lookups else 0.0)
+        yield hits
+        yield misses
+        yield ratio
+
+
+cache_collector = CacheCollector()
+REGISTRY.register(cache_collector)
+
+
+def metrics_registry():
+    if multiprocess_dir is None:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, multiprocess_dir)
+    # the caches are read from the worker answering, and the shared one is the same from any of them
+    registry.register(cache_collector)
+    return registry
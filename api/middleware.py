@@ -0,0 +1,109 @@
+from logging.handlers import QueueHandler, QueueListener
+from time import perf_counter_ns
+from starlette.datastructures import MutableHeaders
+from api.metrics import observe_request
+from api.routes.page_cache import frame_page_cache_control
+import logging
+import os
+import queue
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Set to log a line per request with its route, status and time
+access_log = os.environ.get('ACCESS_LOG', '') != ''
+# Cache-Control of GET responses whose route has no policy of its own below
+default_cache_control = os.environ.get('DEFAULT_CACHE_CONTROL', 'max-age=10')
+
+# Cache-Control by route template, for GET and HEAD responses that don't set their own. The frame pages set
+# theirs already, these cover the responses of theirs that don't, e.g. a page rendered for a signed message
+route_cache_control = {
+    '/': frame_page_cache_control,
+    '/already-completed': frame_page_cache_control,
+    '/task/{task_id}': frame_page_cache_control,
+    '/metrics': 'no-store',
+}
+
+access_logger = logging.getLogger('api.access')
+access_logger.setLevel(logging.INFO if access_log else logging.WARNING)
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+log_listener = None
+
+
+def start_access_log():
+    """
+    Sends the access log through a queue to a thread writing it to the root logger's handlers,
+    so the event loop never waits on the log's stream.
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+    log_listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    log_listener.start()
+    access_logger.addHandler(queue_handler)
+    access_logger.propagate = False
+
+
+def stop_access_log():
+    global log_listener
+    if log_listener is None:
+        return
+    access_logger.removeHandler(queue_handler)
+    access_logger.propagate = True
+    # writes out what is still queued
+    log_listener.stop()
+    log_listener = None
+
+
+def cache_control(method, route, status):
+    # posted frames and errors are answers to one request, not something to reuse
+    if method not in ('GET', 'HEAD') or status >= 400:
+        return 'no-store'
+    return route_cache_control.get(route, default_cache_control)
+
+
+class RequestMiddleware:
+    """
+    Times each request into the request latency histogram, labelled by route template, and gives responses
+    without a Cache-Control of their own the policy of their route. A pure ASGI middleware: unlike a
+    BaseHTTPMiddleware it doesn't run the app in a task of its own or pipe the body through a stream,
+    it only looks at the messages sent. Times run to the last byte of the body, streamed ones included.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter_ns()
+        status = 500
+
+        async def send_with_cache_control(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                headers = MutableHeaders(scope=message)
+                if 'cache-control' not in headers:
+                    # the router has put the matched route in the scope by the time the response starts
+                    route = scope.get('route')
+                    headers.append('Cache-Control', cache_control(scope['method'], route.path if route else None,
+                                                                  status))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cache_control)
+        finally:
+            seconds = (perf_counter_ns() - start) / 1e9
+            # labelled by route template rather than url, so /task/1/2 and /task/1/3 share a series
+            route = scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            observe_request(scope['method'], route, status, seconds)
+            if access_logger.isEnabledFor(logging.INFO):
+                access_logger.info('{} {} {} {:.2f}ms'.format(scope['method'], route, status, seconds * 1000))
@@ -0,0 +1,168 @@
+# Schema revisions of databases created before the models changed, applied in order at server startup
+# and recorded in the schema_revision table. They can also be applied, or listed, by hand:
+# python -m api.migrations
+# python -m api.migrations --list
+from sqlalchemy import inspect, insert, select, text, String
+from api.models import engine, Base, Response, Completion, Question, Cluster, SchemaRevision
+from time import time
+import argparse
+import logging
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+
+def rebuild_table(connection, table, casts, where='1 = 1'):
+    """
+    sqlite can't change the type of a column, so the table is renamed, created again from the model
+    and the rows matching where copied over, with casts giving the SQL expression to copy a column with.
+    """
+    old_name = '{}_old'.format(table.name)
+    inspector = inspect(connection)
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    # the indexes move with the renamed table, and their names would clash with the new table's
+    for index in inspector.get_indexes(table.name):
+        connection.execute(text('DROP INDEX {}'.format(index['name'])))
+    connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(table.name, old_name)))
+    table.create(connection)
+    columns = [column.name for column in table.columns if column.name in existing]
+    connection.execute(text('INSERT INTO {} ({}) SELECT {} FROM {} WHERE {}'.format(
+        table.name, ', '.join(columns), ', '.join(casts.get(column, column) for column in columns), old_name, where
+    )))
+    connection.execute(text('DROP TABLE {}'.format(old_name)))
+
+
+def response_username_text(connection):
+    """
+    Response.username was declared Integer, so sqlite stored usernames that look like numbers as numbers.
+    """
+    columns = {column['name']: column for column in inspect(connection).get_columns('response')}
+    if isinstance(columns['username']['type'], String):
+        return
+    if connection.dialect.name == 'sqlite':
+        # the new table comes with the unique (user_fid, question_id) index, so duplicates are collapsed
+        # to the most recent response like response_user_question_index does
+        rebuild_table(connection, Response.__table__, {'username': 'CAST(username AS TEXT)'},
+                      where='user_fid IS NULL OR response_id IN (SELECT MAX(response_id) FROM response_old '
+                            'WHERE user_fid IS NOT NULL GROUP BY user_fid, question_id)')
+    else:
+        connection.execute(text('ALTER TABLE response ALTER COLUMN username TYPE VARCHAR USING username::varchar'))
+
+
+def hot_query_indexes(connection):
+    """
+    Replaces single column indexes with composite ones matching the hot queries, and makes cluster
+    names unique within a task.
+    """
+    # value is never filtered on, the others are prefixes of the composite indexes
+    for name in ['ix_response_value', 'ix_response_user_fid', 'ix_completion_user_fid', 'ix_cluster_task_id',
+                 'ix_cluster_name']:
+        connection.execute(text('DROP INDEX IF EXISTS {}'.format(name)))
+
+    # completions of duplicate clusters move to the first one, the count tables are rebuilt at startup
+    connection.execute(text('''
+        UPDATE completion SET cluster_id = (
+            SELECT MIN(first.cluster_id) FROM cluster AS first
+            JOIN cluster AS duplicate ON duplicate.task_id = first.task_id AND duplicate.name = first.name
+            WHERE duplicate.cluster_id = completion.cluster_id
+        )
+        WHERE cluster_id IN (SELECT cluster_id FROM cluster)
+          AND cluster_id NOT IN (SELECT MIN(cluster_id) FROM cluster GROUP BY task_id, name)
+    '''))
+    connection.execute(text('''
+        DELETE FROM cluster WHERE cluster_id NOT IN (
+            SELECT MIN(cluster_id) FROM cluster GROUP BY task_id, name
+        )
+    '''))
+
+    for table, name in [(Response.__table__, 'ix_response_task_username'),
+                        (Completion.__table__, 'ix_completion_user_task'),
+                        (Question.__table__, 'ix_question_task_sequence'),
+                        (Cluster.__table__, 'ix_cluster_task_name')]:
+        index = next(index for index in table.indexes if index.name == name)
+        index.create(connection, checkfirst=True)
+
+
+def task_user_index(connection):
+    """
+    Lets the users of a task be paged through in user_fid order without a scan.
+    """
+    index = next(index for index in Response.__table__.indexes if index.name == 'ix_response_task_user')
+    index.create(connection, checkfirst=True)
+
+
+def response_user_question_index(connection):
+    """
+    Creates the unique (user_fid, question_id) index the response upserts rely on. A user's duplicate responses
+    are collapsed to the most recent one first, otherwise the index can't be created. Responses without a
+    user_fid are left alone, they aren't the same user's and the index doesn't constrain them either.
+    """
+    connection.execute(text('''
+        DELETE FROM response WHERE user_fid IS NOT NULL AND response_id NOT IN (
+            SELECT MAX(response_id) FROM response WHERE user_fid IS NOT NULL GROUP BY user_fid, question_id
+        )
+    '''))
+    index = next(index for index in Response.__table__.indexes if index.name == 'ix_response_user_question')
+    index.create(connection, checkfirst=True)
+
+
+def response_updated_at(connection):
+    """
+    Adds Response.updated_at, so the stats frames can pick up answers replaced in place.
+    """
+    if 'updated_at' not in {column['name'] for column in inspect(connection).get_columns('response')}:
+        connection.execute(text('ALTER TABLE response ADD COLUMN updated_at FLOAT'))
+    index = next(index for index in Response.__table__.indexes if index.name == 'ix_response_task_updated')
+    index.create(connection, checkfirst=True)
+
+
+# in the order they are applied, never rename or reorder applied ones
+revisions = [
+    ('0001_response_username_text', response_username_text),
+    ('0002_hot_query_indexes', hot_query_indexes),
+    ('0003_task_user_index', task_user_index),
+    ('0004_response_user_question_index', response_user_question_index),
+    ('0005_response_updated_at', response_updated_at),
+]
+
+
+def applied_revisions(bind=engine):
+    Base.metadata.create_all(bind, tables=[SchemaRevision.__table__])
+    with bind.connect() as connection:
+        return {name for (name,) in connection.execute(select(SchemaRevision.name))}
+
+
+def migrate(bind=engine):
+    """
+    Applies the pending revisions, each in its own transaction. A database without the tables yet
+    is created from the models, which are already at the latest revision.
+    """
+    applied = applied_revisions(bind)
+    if not inspect(bind).has_table(Response.__tablename__):
+        Base.metadata.create_all(bind)
+    for name, revision in revisions:
+        if name in applied:
+            continue
+        with bind.begin() as connection:
+            if connection.dialect.name == 'sqlite':
+                # pysqlite only opens a transaction before DML, a failing revision would be left half applied
+                connection.exec_driver_sql('BEGIN')
+            revision(connection)
+            connection.execute(insert(SchemaRevision).values(name=name, applied_at=time()))
+        logger.info('Applied schema revision {}'.format(name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--list', action='store_true', help='list the revisions and whether they are applied')
+    args = parser.parse_args()
+
+    if args.list:
+        applied = applied_revisions()
+        for name, _ in revisions:
+            print('{} {}'.format('applied' if name in applied else 'pending', name))
+    else:
+        migrate()
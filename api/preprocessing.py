@@ -1,51 +1,24 @@
-from PIL import Image, ImageDraw, ImageFont
 import json
-import textwrap
-from external.ipfs import pin_img
+from external.ipfs import pin_img, pin_files
 from external.hub_api import logger
 import random
 from models import SessionLocal, Question
+from image_render import QuestionTemplate, render_many
 import os
 
 session = SessionLocal()
+question_template = QuestionTemplate()
 
 def text_to_png(text, filename):
-    # Create an image with white background
-    height = 400
-    # width = int(height * 1.19)
-    width = height
-    font_size = 40
-    color = (0, 0, 0)
-    image = Image.open('./img/frame3.png')
-    # image = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(image)
-
-    # Load the specified font
-    font = ImageFont.truetype("./font/Cinzel-Regular.ttf", font_size)
-
-    # Calculate text size and position
-    # text_width, text_height = draw.text(text, font=font)
-    # x = (width - text_width) / 2
-    # y = (height - text_height) / 2
-
-    lines = textwrap.wrap(text, width=24)
-    for i, line in enumerate(lines):
-        # Draw the text on the image
-        x = 4.5 * width / 10
-        y = (i + 1) * (height / 12) + (height * 0.8)
-        draw.text((x, y), line, fill=color, font=font, align='center')
-
-    # Save the image
-    image.save(filename)
+    question_template.save(text, filename)
 
 
 def add_images_to_quiz():
     with open('./json/quiz.json', 'r') as f:
         j = json.load(f)
         for i, obj in enumerate(j):
-            filename = './img/questions/{}.png'.format(i)
-            text_to_png(obj['question'], filename)
-            obj['img'] = filename
+            obj['img'] = './img/questions/{}.png'.format(i)
+        render_many([(obj['question'], obj['img']) for obj in j])
 
     with open('./json/quiz.json', 'w') as f:
         json.dump(fp=f, obj=j, indent=4)
@@ -59,11 +32,13 @@ def add_images_to_task(task_id):
         logger.info('Creating directory: {}'.format(dir))
         os.makedirs(dir, exist_ok=True)
 
-    for i, question in enumerate(questions):
-        filename = '{}/{}.png'.format(dir, question.question_id)
-        text_to_png(question.text, filename)
-        question.image_path = filename
-        ipfs_hash = pin_img(filename)
+    for question in questions:
+        question.image_path = '{}/{}.png'.format(dir, question.question_id)
+    render_many([(question.text, question.image_path) for question in questions])
+
+    # pinned together, images that were pinned before are not uploaded again
+    hashes = pin_files([question.image_path for question in questions])
+    for question, ipfs_hash in zip(questions, hashes):
         question.image_ipfs_hash = ipfs_hash
         session.add(question)
         logger.info('Created image for question {}: {} - {}'.format(question.question_id, question.text, question.image_ipfs_hash))
@@ -75,8 +50,8 @@ def add_images_to_task(task_id):
 def add_images_to_ipfs():
     with open('./json/quiz.json', 'r') as f:
         j = json.load(f)
-        for i, obj in enumerate(j):
-            hash = pin_img(obj['img'])
+        hashes = pin_files([obj['img'] for obj in j])
+        for obj, hash in zip(j, hashes):
             obj['ipfs'] = hash
 
     with open('./json/quiz.json', 'w') as f:
@@ -0,0 +1,120 @@
+from api.models import engine, Response
+from api.aggregates import upsert_dialects, apply_response_deltas
+from api.metrics import stage_timer
+import atexit
+import asyncio
+import logging
+import os
+import threading
+from time import time
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+flush_size = int(os.environ.get('RESPONSE_FLUSH_SIZE', 500))
+flush_interval = float(os.environ.get('RESPONSE_FLUSH_INTERVAL', 1.0))
+
+# Keeps each statement under sqlite's limit on bound parameters
+max_rows_per_statement = 1000
+
+def upsert_responses(connection, rows):
+    """
+    Writes response rows, replacing the value of any the user already gave to the same question.
+    """
+    insert = upsert_dialects[connection.dialect.name]
+    for i in range(0, len(rows), max_rows_per_statement):
+        stmt = insert(Response.__table__).values(rows[i:i + max_rows_per_statement])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_fid', 'question_id'],
+            set_={
+                'value': stmt.excluded.value,
+                'username': stmt.excluded.username,
+                'updated_at': stmt.excluded.updated_at
+            }
+        )
+        connection.execute(stmt)
+
+
+class ResponseBuffer:
+    """
+    Write-behind buffer for responses. Taps are coalesced per (user_fid, question_id) and written
+    as multi-row INSERT ... ON CONFLICT DO UPDATE statements, either when the buffer is full or on a timer.
+    """
+
+    def __init__(self, bind, max_size, interval):
+        self.bind = bind
+        self.max_size = max_size
+        self.interval = interval
+        self.pending = {}  # { (user_fid, question_id): row }
+        self.lock = threading.Lock()
+        # Serializes flushes so an older batch can never overwrite a newer one
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+
+    def add(self, question_id, task_id, user_fid, username, value):
+        """
+        Returns True when the buffer has reached its size limit and should be flushed.
+        """
+        with self.lock:
+            self.pending[(user_fid, question_id)] = {
+                'question_id': question_id,
+                'task_id': task_id,
+                'user_fid': user_fid,
+                'username': username,
+                'value': value
+            }
+            return len(self.pending) >= self.max_size
+
+    def upsert(self, connection, rows):
+        upsert_responses(connection, rows)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+            if len(batch) == 0:
+                return 0
+
+            t0 = time()
+            try:
+                rows = [dict(row, updated_at=t0) for row in batch.values()]
+                with stage_timer('response_flush'), self.bind.begin() as connection:
+                    apply_response_deltas(connection, rows)
+                    self.upsert(connection, rows)
+            except Exception:
+                # Put the batch back, unless a newer tap for the same key arrived in the meantime
+                with self.lock:
+                    for key, row in batch.items():
+                        self.pending.setdefault(key, row)
+                raise
+            logger.info(f'Flushed {len(batch)} responses in {time() - t0:.3f} seconds')
+            return len(batch)
+
+    async def flush_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error('Could not flush responses: {!r}'.format(e))
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_forever())
+
+    async def stop(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+
+response_buffer = ResponseBuffer(engine, flush_size, flush_interval)
+
+# Last chance flush for processes that exit without running the app's shutdown handlers
+atexit.register(response_buffer.flush)
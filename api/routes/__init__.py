@@ -1,3 +1,4 @@
 from .frames import frames_router
 from .stats import stats_router
-
+from .images import images_router
+from .metrics import metrics_router
@@ -1,12 +1,23 @@
-from fastapi import Request, APIRouter
+from fastapi import Request, APIRouter, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from fastapi.templating import Jinja2Templates
-from api.external.hub_api import validate_message
-from api.external.minter import health_check, mint_to
-from api.routes.stats import collection_size
-from api.models import SessionLocal, Question, Response, Completion, Cluster, Task
+from fastapi.responses import RedirectResponse
+from api.external.hub_api import validate_message_cached, mark_message_handled
+from api.external.frame_verify import get_validator
+from api.external.mint_queue import health_check, queue_mint
+from api.token_ids import token_allocator
+from sqlalchemy.orm import Session
+from api.models import get_db, SessionLocal, Response, Completion, Task
+from api.task_cache import task_cache
+from api.routes.page_cache import PageCache, page_response
+from api.response_buffer import response_buffer
+from api.aggregates import apply_completion_deltas
 from typing import Optional
-from api.scoring import get_quiz_result
+from api.scoring import get_scorer, running_scores, running_name
+from api.metrics import stage_timer
+from api.frame_tags import url_stem
+from api.shared_cache import shared_cache
 import json
 import logging
 
@@ -18,8 +29,6 @@ logging.basicConfig(level=logging.INFO,
 # Create a logger object
 logger = logging.getLogger(__name__)
 
-db_session = SessionLocal()
-
 frames_router = APIRouter()
 
 templates = Jinja2Templates(directory="api/routes/templates")
@@ -33,15 +42,21 @@ class FrameSignature(BaseModel):
     trustedData: TrustedData
 
 
-url_stem = 'https://earthnetcdn.com'
-
 nft_url = {
     'mumbai': 'https://testnets.opensea.io/assets/mumbai/0x5A05289A5Ffbfa6a45663D092A0fE7C1Bc0c5bc9',
     'polygon': 'https://opensea.io/collection/the-network-state-survey'
 }
+# page of a single token, by contract address and token id
+token_url = {
+    'mumbai': 'https://testnets.opensea.io/assets/mumbai/{}/{}',
+    'polygon': 'https://opensea.io/assets/matic/{}/{}'
+}
 
 button_scores = [2, 1, -1, -2]
-button_titles = json.load(open('./json/button_titles.json', 'r'))
+
+# Several workers share a cache, and any of them may handle a user's next tap seeing only what is in the database.
+# Each tap is then written before it is answered, and the final page scores the user from the database
+multi_worker = shared_cache.backend != 'memory'
 
 no_duplicates = json.load(open('./json/no_duplicates.json', 'r'))
 no_such_survey = json.load(open('./json/no_such_survey.json', 'r'))
@@ -61,45 +76,86 @@ result_images = {
     # 'unknown_error': 'https://i.imgur.com/8Q3KAxj.png'
 }
 
+page_cache = PageCache(templates, start_url)
+
 
 @frames_router.get("/")
-async def read_item(request: Request):
-    health_check.delay()
+def read_item(request: Request):
+    # sending the health check task blocks on the broker, so this runs in the threadpool
+    health_check()
 
-    return templates.TemplateResponse("result.html", {'request': request, 'result_image': result_images['success']})
+    return page_response(request, page_cache.get_result_page(result_images['success']))
 
 
 @frames_router.get("/already-completed")
 async def already_completed(request: Request):
-    return templates.TemplateResponse("result.html",
-                                      {'request': request, 'result_image': result_images['already_completed']})
+    return page_response(request, page_cache.get_result_page(result_images['already_completed']))
+
+
+@frames_router.get("/nft/{completion_id}")
+def show_nft(completion_id: int, db_session: Session = Depends(get_db)):
+    """
+    Where the end page's "See NFT" points: the token once its mint is confirmed, the collection until then,
+    since the id it will get is only known for sure when it lands.
+    """
+    completion = db_session.get(Completion, completion_id)
+    if completion is None or completion.task.network not in nft_url:
+        raise HTTPException(status_code=404, detail='No such NFT')
+    task = completion.task
+    if completion.mint_status == 'minted' and completion.token_id is not None:
+        return RedirectResponse(token_url[task.network].format(task.contract_address, completion.token_id))
+    return RedirectResponse(nft_url[task.network])
 
 
 @frames_router.get("/task/{task_id}")
-def get_task(request: Request, task_id: int):
-    return show_task(request, task_id, 0)
+async def get_task(request: Request, task_id: int, db_session: Session = Depends(get_db)):
+    return await show_task(request, task_id, 0, db_session=db_session)
 
 
 @frames_router.post("/task/{task_id}/{page_num}")
-def show_task(request: Request, task_id: int, page_num: int, frame_signature: Optional[FrameSignature] = None):
-    task = db_session.query(Task).filter_by(task_id=task_id).first()
+async def show_task(request: Request, task_id: int, page_num: int, frame_signature: Optional[FrameSignature] = None,
+                    db_session: Session = Depends(get_db)):
+    # Validation is awaited on the event loop so a slow hub doesn't hold a threadpool worker,
+    # only the database work below is handed off to the threadpool
+    message = None
+    duplicate = False
+    if frame_signature is None:
+        # unsigned pages are the same for everyone, serve them straight from the page cache when rendered
+        task = task_cache.peek(task_id)
+        page = page_cache.get_cached_task_page(task, page_num) if task is not None else None
+        if page is not None:
+            return page_response(request, page)
+    elif page_num != 0:
+        with stage_timer('hub_validation'):
+            message, duplicate = await validate_message_cached(frame_signature.trustedData.messageBytes,
+                                                               get_validator())
+        if message is None:
+            raise HTTPException(status_code=400, detail='Invalid frame message')
+
+    response = await run_in_threadpool(render_task_page, db_session, request, task_id, page_num, message, duplicate)
+    if message is not None and not duplicate:
+        # only now, so if recording the tap failed the client's retry records it instead of being skipped
+        mark_message_handled(frame_signature.trustedData.messageBytes)
+    return response
+
+
+def render_task_page(db_session: Session, request: Request, task_id: int, page_num: int, message: Optional[dict],
+                     duplicate: bool = False):
+    task = task_cache.get(db_session, task_id)
 
     if task is None:
-        return templates.TemplateResponse("result.html",
-                                          {'request': request, 'result_image': result_images['no_such_survey']})
+        return page_response(request, page_cache.get_result_page(result_images['no_such_survey']))
 
     if page_num == 0:
-        response = {
-            'request': request,
-            'task_id': task_id,
-            'image_tags': get_image_tags(start_url)
-        }
-        return templates.TemplateResponse("start.html", response)
+        return page_response(request, page_cache.get_task_page(task, 0))
+
+    # the question pages, then the mint page at len(task.questions)
+    if not 0 < page_num <= len(task.questions):
+        return page_response(request, page_cache.get_result_page(result_images['no_such_survey']))
 
-    question = get_question(task_id, page_num)
+    question = task.get_question(page_num)
 
-    if frame_signature is not None:
-        message = validate_message(frame_signature.trustedData.messageBytes)
+    if message is not None:
         username = message['action']['interactor']['username']
         button_index = message['action']['tapped_button']['index']
         user_fid = message['action']['interactor']['fid']
@@ -107,113 +163,93 @@ def show_task(request: Request, task_id: int, page_num: int, frame_signature: Op
         already_completed = db_session.query(Completion).filter_by(user_fid=user_fid, task_id=task_id).first()
         if already_completed is not None and user_fid != 336572:
             logger.warning('User {} already completed task {}'.format(username, task_id))
-            return templates.TemplateResponse("result.html",
-                                              {'request': request, 'result_image': result_images['already_completed']})
-
-        if page_num < len(questions.get(task_id, [])):
-            existing = db_session.query(Response).filter_by(user_fid=user_fid, question_id=question.question_id).first()
-            if existing and user_fid != 336572:
-                existing.value = button_scores[button_index - 1]
-                logger.info('Replacing response for user {} = {}'.format(username, existing))
+            return page_response(request, page_cache.get_result_page(result_images['already_completed']))
+
+        if page_num < len(task.questions):
+            if duplicate:
+                # a resent tap (client retry or double tap), the response was already recorded
+                logger.info('Duplicate message from user {} for question {}'.format(username, question.question_id))
             else:
-                response = Response(
-                    question_id=question.question_id,
-                    task_id=task_id,
-                    user_fid=user_fid,
-                    username=username,
-                    value=button_scores[button_index - 1])
-                db_session.add(response)
-                logger.info('Adding response for user {} = {}'.format(username, response))
-
-            db_session.commit()
+                value = button_scores[button_index - 1]
+                if not multi_worker:
+                    running_scores.record(task, user_fid, question.question_id, value)
+                if response_buffer.add(question_id=question.question_id,
+                                       task_id=task_id,
+                                       user_fid=user_fid,
+                                       username=username,
+                                       value=value) or multi_worker:
+                    response_buffer.flush()
         else:
             # final stage: mint
             # recipients = message['action']['interactor']['verifications']
             recipients = message['action']['interactor']['verified_addresses']['eth_addresses']
             if len(recipients) == 0:
                 logger.error('No address to mint to. Aborting')
-                return templates.TemplateResponse("result.html",
-                                                  {'request': request, 'result_image': result_images['no_address']})
+                return page_response(request, page_cache.get_result_page(result_images['no_address']))
 
             recipient = recipients[0]
-            all_answers = db_session.query(Response).filter_by(task_id=task_id, username=username)
-
-            result = get_quiz_result(all_answers)
-
-            cluster = db_session.query(Cluster).filter_by(task_id=task_id, name=result['name']).first()
-
-            token_id = collection_size(task) + 1
-
-            completion = Completion(task_id=task_id, user_fid=user_fid, cluster_id=cluster.cluster_id)
+            running = running_scores.get_complete(task, user_fid)
+            if running is not None:
+                answers = list(running.answers.items())
+                cluster = task.clusters[running_name(get_scorer(task), running)]
+            else:
+                # this process didn't see all of the user's taps, score them from the database
+                response_buffer.flush()
+                answers = [
+                    (answer.question_id, answer.value)
+                    for answer in db_session.query(Response).filter_by(task_id=task_id, username=username)
+                                                            .order_by(Response.response_id)
+                ]
+                cluster = task.clusters[get_scorer(task).score_user(answers)['name']]
+
+            # the user's responses have to be in the database before they are counted towards their cluster
+            if running is not None:
+                response_buffer.flush()
+            token_id = token_allocator.allocate(db_session, task)
+            apply_completion_deltas(db_session.connection(), task_id, user_fid, cluster.cluster_id)
+            metadata = ipfs_metadata(task, username, answers, cluster, token_id)
+            # the minter picks the completion up from the queue in its next batch
+            completion = Completion(task_id=task_id, user_fid=user_fid, cluster_id=cluster.cluster_id,
+                                    allocated_token_id=token_id, recipient=recipient,
+                                    mint_metadata=json.dumps(metadata), mint_status='queued')
             db_session.add(completion)
-            db_session.commit()
-
-            metadata = ipfs_metadata(all_answers, cluster, token_id)
-
-            mint_to.delay(completion.completion_id, metadata, recipient, token_id)
-
-            return templates.TemplateResponse("end.html",
-                                              {'request': request, 'result_image': final_url, 'nft_url': '{}/{}'.format(nft_url[task.network], token_id)})
-    response = {
-        'request': request,
-        'meta_tags': '{}{}'.format(get_image_tags('https://gateway.pinata.cloud/ipfs/{}'.format(question.image_ipfs_hash)),
-                                   get_button_tags(task_id, page_num + 1))
-    }
-
-    # logger.info(response)
-    return templates.TemplateResponse('task_page.html', response)
-
-
-def get_image_tags(url):
-    return '''
-        <meta property="og:title" content="The Network State Survey"/>
-        <meta property="og:image" content="{}">
-        <meta property="fc:frame" content="vNext"/>
-        <meta property="fc:frame:image" content="{}">
-        <meta property="fc:frame:image:aspect_ratio" content="1.91:1"/>
-    '''.format(url, url)
-
-
-def get_button_tags(task_id: int, page_num: int):
-    tags = [
-        '''
-            <meta property="fc:frame:button:{}" content="{}">
-            <meta property="fc:frame:button:{}:action" content="post">
-        '''.format(index + 1, title, index + 1)
-        for index, title in enumerate(button_titles)
-    ]
-
-    return ''.join(tags) + '<meta property="fc:frame:post_url" content="{}/task/{}/{}">'.format(url_stem, task_id,
-                                                                                                page_num)
-
-questions = {} # { task_id: [questions] }
-
-
-def get(lst, index, default=None):
-    return lst[index] if 0 <= index < len(lst) else default
-
-
-def get_question(task_id: int, page_num: int):
-    if task_id not in questions:
-        questions[task_id] = db_session.query(Question).filter_by(task_id=task_id).all()
-        logger.info('Cache miss for question {} from task {}, received from db {}'.format(page_num, task_id, questions[task_id]))
-    else:
-        logger.info('Cache hit for question {} from task {}: {}'.format(page_num, task_id, questions[task_id]))
-    return get(questions[task_id], page_num, None)
-
-
-def ipfs_metadata(answers, cluster, token_id):
-    username = answers[0].username
-
+            with stage_timer('db_commit'):
+                db_session.commit()
+            running_scores.discard(task_id, user_fid)
+
+            with stage_timer('celery_enqueue'):
+                queue_mint()
+
+            with stage_timer('template_render'):
+                return templates.TemplateResponse("end.html",
+                                                  {'request': request, 'result_image': final_url,
+                                                   'nft_url': '{}/nft/{}'.format(url_stem, completion.completion_id)})
+    page = page_cache.get_task_page(task, page_num)
+    if page is None:
+        # the mint page requested without a signed message
+        return page_response(request, page_cache.get_result_page(result_images['no_such_survey']))
+    return page_response(request, page)
+
+
+def warm_page_cache():
+    """
+    Builds the snapshot and renders every page of each task, so the first visitors don't pay for it.
+    """
+    with SessionLocal() as db_session:
+        for (task_id,) in db_session.query(Task.task_id).all():
+            page_cache.warm(task_cache.get(db_session, task_id))
+
+
+def ipfs_metadata(task, username, answers, cluster, token_id):
     metadata = {
         'name': cluster.name,
         'image': 'ipfs://{}'.format(cluster.image_ipfs_hash),
         'token_id': token_id,
         'username': username,
-        'survey': answers[0].task.title,
+        'survey': task.title,
         'attributes': [
-            map_step_to_attribute(answer)
-            for answer in answers
+            map_step_to_attribute(task.questions_by_id[question_id], value)
+            for question_id, value in answers
         ],
         # 'external_uri': ''
     }
@@ -229,9 +265,9 @@ agreement = {
     2: 'Strongly Agree'
 }
 
-def map_step_to_attribute(response):
+def map_step_to_attribute(question, value):
     return {
-        'trait_type': response.question.text,
-        'value': agreement[response.value]
+        'trait_type': question.text,
+        'value': agreement[value]
     }
 
@@ -0,0 +1,204 @@
+from fastapi import APIRouter, Request, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from api.models import get_db
+from api.task_cache import task_cache
+from api import image_render
+from api.image_render import get_question_template
+from api.frame_tags import get_image_version
+import logging
+import os
+import tempfile
+import threading
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+images_router = APIRouter(prefix='/image')
+
+# Memory budget for rendered images, least recently used ones are spilled to disk beyond it
+image_cache_bytes = int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024))
+image_cache_dir = os.environ.get('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'frame-images'))
+# Disk budget of the spilled images, least recently used ones are deleted beyond it
+image_spill_bytes = int(os.environ.get('IMAGE_SPILL_BYTES', 512 * 1024 * 1024))
+frame_image_max_age = int(os.environ.get('FRAME_IMAGE_MAX_AGE', 86400))
+
+
+class ImageCache:
+    """
+    Rendered images by render key: an LRU in memory, bounded by total bytes, over a directory of spilled ones,
+    bounded the same way.
+    """
+
+    def __init__(self, max_bytes, spill_dir, max_spill_bytes=image_spill_bytes):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_size = 0
+        self.spill_evictions = 0
+        self.images = OrderedDict()  # { render key: png bytes }
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.prune_spill()
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, '{}.png'.format(key))
+
+    def get_cached(self, key):
+        """
+        Returns the image if it is in memory, without touching the disk.
+        """
+        with self.lock:
+            body = self.images.get(key)
+            if body is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = body
+            self.size += len(body)
+            evicted = []
+            while self.size > self.max_bytes and len(self.images) > 1:
+                old_key, old_body = self.images.popitem(last=False)
+                self.size -= len(old_body)
+                evicted.append((old_key, old_body))
+        for old_key, old_body in evicted:
+            self.spill(old_key, old_body)
+
+    def spill(self, key, body):
+        if not self.spill_dir:
+            return
+        path = self.spill_path(key)
+        if os.path.exists(path):
+            return
+        # written under a temporary name first, so readers never see half a file
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.spill_size += len(body)
+            over = self.spill_size > self.max_spill_bytes
+        if over:
+            self.prune_spill()
+
+    def prune_spill(self):
+        """
+        Deletes the least recently used spilled images until the directory is under 90% of its budget, so it isn't
+        pruned again on every spill. Other workers may spill to the same directory, so it is measured rather than
+        trusted to this process' count.
+        """
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            if not entry.name.endswith('.png'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        evictions = 0
+        for _, file_size, path in sorted(files):
+            if size <= self.max_spill_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        with self.lock:
+            self.spill_size = size
+            self.spill_evictions += evictions
+
+    def read_spilled(self, key):
+        if not self.spill_dir:
+            return None
+        path = self.spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+            # the modification time is what pruning goes by
+            os.utime(path)
+        except FileNotFoundError:
+            # never spilled, or pruned since
+            return None
+        return body
+
+    def get_or_render(self, key, render):
+        """
+        Returns the image from memory or disk, or renders and caches it. Blocking, call from a thread.
+        """
+        body = self.get_cached(key)
+        if body is not None:
+            return body
+        body = self.read_spilled(key)
+        if body is not None:
+            self.disk_hits += 1
+        else:
+            body = render()
+            self.misses += 1
+        self.put(key, body)
+        return body
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'images': len(self.images),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'spill_bytes': self.spill_size,
+            'max_spill_bytes': self.max_spill_bytes,
+            'spill_evictions': self.spill_evictions,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+
+image_cache = ImageCache(image_cache_bytes, image_cache_dir)
+
+
+@images_router.get('/question/{task_id}/{question_id}.png')
+async def get_question_image(request: Request, task_id: int, question_id: int, db_session: Session = Depends(get_db)):
+    task = task_cache.peek(task_id)
+    if task is None:
+        task = await run_in_threadpool(task_cache.get, db_session, task_id)
+    question = task.questions_by_id.get(question_id) if task is not None else None
+    if question is None:
+        raise HTTPException(status_code=404, detail='No such question')
+
+    template = image_render.question_template
+    if template is None:
+        # the first request loads the background and font, and imports PIL, off the event loop
+        template = await run_in_threadpool(get_question_template)
+    key = template.render_key(question.text)
+    headers = {'ETag': '"{}"'.format(key)}
+    if request.query_params.get('v') == get_image_version(question.text):
+        # the url changes along with the image
+        headers['Cache-Control'] = 'public, max-age={}, immutable'.format(frame_image_max_age)
+    else:
+        headers['Cache-Control'] = 'public, max-age=60'
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+
+    body = image_cache.get_cached(key)
+    if body is None:
+        body = await run_in_threadpool(image_cache.get_or_render, key, lambda: template.encode(question.text))
+    return Response(content=body, media_type='image/png', headers=headers)
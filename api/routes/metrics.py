@@ -0,0 +1,24 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from api.metrics import cache_collector, metrics_registry
+from api.external.hub_api import message_cache
+from api.task_cache import task_cache
+from api.shared_cache import shared_cache
+from api.analytics import analytics_store
+from api.routes.frames import page_cache
+from api.routes.images import image_cache
+
+metrics_router = APIRouter()
+
+cache_collector.register('questions', task_cache)
+cache_collector.register('all_responses', analytics_store)
+cache_collector.register('pages', page_cache)
+cache_collector.register('hub_messages', message_cache)
+cache_collector.register('images', image_cache)
+cache_collector.register('shared', shared_cache)
+
+
+@metrics_router.get('/metrics')
+def get_metrics():
+    return Response(content=generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST)
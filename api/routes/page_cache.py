@@ -0,0 +1,126 @@
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.templating import Jinja2Templates
+from api.frame_tags import get_image_tags
+from api.metrics import stage_timer
+import hashlib
+import logging
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Page urls don't change when a task is edited, so clients and CDNs may keep a page but have to revalidate it on
+# every use. While the task is unchanged that costs an empty 304 for the page's ETag, after a refresh the new page
+# is served at once
+frame_page_cache_control = 'public, no-cache'
+
+
+class RenderedPage:
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+
+
+class PageCache:
+    """
+    Fully rendered frame pages as bytes. Task pages are kept per task snapshot version,
+    so refreshing a task in the task cache makes its pages render again on next use.
+    """
+
+    def __init__(self, templates: Jinja2Templates, start_url: str):
+        self.templates = templates
+        self.start_image_tags = get_image_tags(start_url)
+        self.task_pages = {}  # { task_id: (snapshot version, { page_num: RenderedPage }) }
+        self.result_pages = {}  # { result_image: RenderedPage }
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, name, **context):
+        with stage_timer('template_render'):
+            return RenderedPage(self.templates.get_template(name).render(**context).encode())
+
+    def render_task_page(self, task, page_num: int):
+        if page_num == 0:
+            return self.render('start.html', task_id=task.task_id, image_tags=self.start_image_tags)
+        if 0 < page_num < len(task.page_meta_tags):
+            return self.render('task_page.html', meta_tags=task.page_meta_tags[page_num])
+        return None
+
+    def pages_for(self, task):
+        entry = self.task_pages.get(task.task_id)
+        if entry is None or entry[0] != task.version:
+            entry = (task.version, {})
+            self.task_pages[task.task_id] = entry
+        return entry[1]
+
+    def get_cached_task_page(self, task, page_num: int):
+        """
+        Returns the page if it is already rendered for this snapshot, without rendering anything.
+        """
+        entry = self.task_pages.get(task.task_id)
+        if entry is None or entry[0] != task.version:
+            return None
+        page = entry[1].get(page_num)
+        if page is not None:
+            self.hits += 1
+        return page
+
+    def get_task_page(self, task, page_num: int):
+        """
+        Returns the start page (page 0) or a question page of the task, or None if there is no such page.
+        """
+        pages = self.pages_for(task)
+        page = pages.get(page_num)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = self.render_task_page(task, page_num)
+        if page is not None:
+            pages[page_num] = page
+        return page
+
+    def get_result_page(self, result_image: str):
+        page = self.result_pages.get(result_image)
+        if page is None:
+            self.misses += 1
+            page = self.render('result.html', result_image=result_image)
+            self.result_pages[result_image] = page
+        else:
+            self.hits += 1
+        return page
+
+    def warm(self, task):
+        for page_num in range(len(task.questions)):
+            self.get_task_page(task, page_num)
+        logger.info('Pre-rendered {} pages of task {}'.format(len(task.questions), task.task_id))
+
+    def invalidate(self, task_id=None):
+        if task_id is None:
+            self.task_pages = {}
+        else:
+            self.task_pages.pop(task_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'tasks': {task_id: len(pages) for task_id, (_, pages) in self.task_pages.items()},
+            'result_pages': len(self.result_pages),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+def page_response(request: Request, page: RenderedPage):
+    headers = {'ETag': page.etag}
+    if request.method == 'GET':
+        headers['Cache-Control'] = frame_page_cache_control
+        if request.headers.get('if-none-match') == page.etag:
+            return Response(status_code=304, headers=headers)
+    return Response(content=page.body, media_type='text/html', headers=headers)
@@ -1,12 +1,23 @@
-from fastapi import APIRouter
-from ape import accounts, project, networks
+from fastapi import APIRouter, Depends, Query, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Literal, Optional
+import hmac
 import logging
 import os
-from time import time
-import pandas as pd
-from api.models import SessionLocal, Task, Response, Question, Completion, Category, Cluster
-
-db_session = SessionLocal()
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from api.models import get_db, Task, Response, Question, Completion, Category, Cluster
+from api.external.hub_api import message_cache
+from api.external import frame_verify
+from api.task_cache import task_cache
+from api.shared_cache import shared_cache, cached
+from api.routes.images import image_cache
+from api.scoring import recompute_clusters
+from api.analytics import analytics_store, columns
+from api.aggregates import survey_stats, responses_by_cluster, rebuild_counts
+from api.token_ids import token_allocator
+from api.export import response_records, user_records, page, stream_records, response_columns, user_columns, \
+    media_types, export_page_size, export_max_page_size
 
 # Configure the logging with time
 logging.basicConfig(level=logging.INFO,
@@ -14,61 +25,142 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 logger = logging.getLogger(__name__)
 
-stats_router = APIRouter(prefix='/stats')
+# Seconds the results of the heavier endpoints below are shared between workers before being computed again,
+# as long as their responses' max-age. Rebuilding a task's counts or recomputing its clusters drops them sooner
+stats_cache_ttl = float(os.environ.get('STATS_CACHE_TTL', 10))
 
-infura_key = os.environ.get('INFURA_API_KEY')
+# Bearer token the endpoints below that change state require. Unset, they are disabled
+admin_token = os.environ.get('ADMIN_TOKEN')
+
+stats_router = APIRouter(prefix='/stats')
 
-network_provider = {
-    'mumbai': 'https://polygon-mumbai.infura.io/v3/' + infura_key,
-    'polygon': 'https://polygon-mainnet.infura.io/v3/' + infura_key
-}
 
-network = {
-    'mumbai': networks.polygon.mumbai,
-    'polygon': networks.polygon.mainnet
-}
+def require_admin(authorization: Optional[str] = Header(None)):
+    if not admin_token:
+        raise HTTPException(status_code=403, detail='Admin endpoints are disabled, set ADMIN_TOKEN')
+    if authorization is None or not hmac.compare_digest(authorization.encode(),
+                                                        'Bearer {}'.format(admin_token).encode()):
+        raise HTTPException(status_code=401, detail='Invalid admin token', headers={'WWW-Authenticate': 'Bearer'})
 
-response_by_value = {
-    -2: 'Strongly Disagree',
-    -1: 'Disagree',
-    1: 'Agree',
-    2: 'Strongly Agree'
-}
 
-all_responses = {}
+def stats_key(name, task_id):
+    return 'stats:{}:{}'.format(name, task_id)
 
 
-def collection_size(task: Task):
-    with network[task.network].use_provider(network_provider[task.network]) as _:
-        nft_contract = project.SBT.at(task.contract_address)
-        return nft_contract.numIdentities(chain_id=network[task.network].chain_id)
+def drop_task_stats(task_id):
+    shared_cache.delete(*[stats_key(name, task_id) for name in ('survey_stats', 'responses_by_cluster', 'all_users')])
 
 
 @stats_router.get("/collection-size/{task_id}")
-def get_collection_size(task_id: int):
-    task = db_session.query(Task).filter_by(task_id=task_id).first()
-    return collection_size(task)
+def get_collection_size(task_id: int, db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail='No such task')
+    return token_allocator.chain_size(db_session, task)
+
+
+@stats_router.post("/collection-size/{task_id}/invalidate", dependencies=[Depends(require_admin)])
+def invalidate_collection_size(task_id: int, db_session: Session = Depends(get_db)):
+    # reseeds the token ids from chain on the next completion, e.g. after redeploying the contract
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail='No such task')
+    token_allocator.invalidate(db_session, task)
+    return {'task_id': task_id}
+
+
+@stats_router.get('/hub-cache')
+def get_hub_cache_stats():
+    return message_cache.stats()
+
+
+@stats_router.get('/frame-validation')
+def get_frame_validation_stats():
+    return frame_verify.stats()
+
+
+@stats_router.get('/image-cache')
+def get_image_cache_stats():
+    return image_cache.stats()
+
+
+@stats_router.get('/task-cache')
+def get_task_cache_stats():
+    return task_cache.stats()
+
+
+@stats_router.get('/shared-cache')
+def get_shared_cache_stats():
+    return shared_cache.stats()
+
+
+@stats_router.post('/task/{task_id}/refresh', dependencies=[Depends(require_admin)])
+def refresh_task(task_id: int, db_session: Session = Depends(get_db)):
+    # call after editing a task so the frames pick up the change
+    snapshot = task_cache.refresh(db_session, task_id)
+    drop_task_stats(task_id)
+    return {'task_id': task_id, 'version': snapshot.version if snapshot is not None else None}
+
+
+@stats_router.post('/recompute-clusters/{task_id}', dependencies=[Depends(require_admin)])
+def recompute_task_clusters(task_id: int, db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return {'task_id': task_id, 'changed': 0}
+    changed = recompute_clusters(db_session, task)
+    drop_task_stats(task_id)
+    return {'task_id': task_id, 'changed': changed}
+
+
+@stats_router.post('/rebuild-counts/{task_id}', dependencies=[Depends(require_admin)])
+def rebuild_task_counts(task_id: int, db_session: Session = Depends(get_db)):
+    # call after writing responses or completions outside the server
+    rebuild_counts(db_session.connection(), task_id)
+    db_session.commit()
+    drop_task_stats(task_id)
+    return {'task_id': task_id}
 
 
 @stats_router.get('/survey-stats/{task_id}')
-def get_collection_stats(task_id: int):
-    responses = get_all_responses(task_id)
-    logger.info("responses: {}".format(responses))
-    grouped = responses.groupby(['question', 'text']).size()
-    d = {}
-    for (question, answer), count in grouped.items():
-        try:
-            d[question][answer] = count
-        except KeyError:
-            d[question] = { answer: count }
+def get_collection_stats(task_id: int, db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return {}
+    d = cached(stats_key('survey_stats', task_id), stats_cache_ttl, lambda: survey_stats(db_session, task))
     logger.info('survey-stats returning {}'.format(d))
     return d
 
 
 @stats_router.get('/individual-responses/{task_id}/{username}')
-def get_individual_responses(task_id: int, username: str):
-    responses = get_all_responses(task_id)
-    return responses[responses['username'] == username].to_dict('records')
+def get_individual_responses(task_id: int, username: str, db_session: Session = Depends(get_db)):
+    # one user's responses are few, reading them through the index beats filtering the task's whole frame
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return []
+    return response_records(db_session, task, username, limit=None)
+
+
+@stats_router.get('/individual-responses/{task_id}/{username}/page')
+def get_individual_responses_page(task_id: int, username: str, after: Optional[int] = None,
+                                  limit: int = Query(export_page_size, ge=1, le=export_max_page_size),
+                                  db_session: Session = Depends(get_db)):
+    # pass the previous page's next as after to get the following page
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return page([], 'response_id', limit)
+    return page(response_records(db_session, task, username, after, limit), 'response_id', limit)
+
+
+@stats_router.get('/individual-responses/{task_id}/{username}/export')
+def export_individual_responses(task_id: int, username: str, format: Literal['ndjson', 'csv'] = 'ndjson',
+                                db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    records = stream_records(
+        lambda page_session, after, limit: response_records(page_session, task, username, after, limit)
+        if task is not None else [],
+        'response_id', response_columns, format
+    )
+    return StreamingResponse(records, media_type=media_types[format])
 
 # @stats_router.get('/user/{username}')
 # def get_user(username: str):
@@ -78,88 +170,94 @@ def get_individual_responses(task_id: int, username: str):
 
 
 @stats_router.get('/all-users/{task_id}')
-def get_all_usernames(task_id: int):
-    responses = get_all_responses(task_id)
+def get_all_usernames(task_id: int, db_session: Session = Depends(get_db)):
+    return cached(stats_key('all_users', task_id), stats_cache_ttl, lambda: all_usernames(db_session, task_id))
+
+
+def all_usernames(db_session: Session, task_id: int):
+    responses = get_all_responses(db_session, task_id)
     user_data = responses[['username', 'token_id', 'user_fid', 'cluster']].drop_duplicates(subset='username')
-    user_data.fillna(0, inplace=True)
+    user_data = user_data.astype(object).fillna(0)
     logger.info('usernames: {}'.format(user_data))
     return user_data.to_dict('records')
 
 
+@stats_router.get('/all-users/{task_id}/page')
+def get_all_users_page(task_id: int, after: Optional[int] = None,
+                       limit: int = Query(export_page_size, ge=1, le=export_max_page_size),
+                       db_session: Session = Depends(get_db)):
+    # users in user_fid order, pass the previous page's next as after to get the following page
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return page([], 'user_fid', limit)
+    return page(user_records(db_session, task, after, limit), 'user_fid', limit)
+
+
+@stats_router.get('/all-users/{task_id}/export')
+def export_all_users(task_id: int, format: Literal['ndjson', 'csv'] = 'ndjson', db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    records = stream_records(
+        lambda page_session, after, limit: user_records(page_session, task, after, limit) if task is not None else [],
+        'user_fid', user_columns, format
+    )
+    return StreamingResponse(records, media_type=media_types[format])
+
+
 @stats_router.get('/all-tasks')
-def get_all_tasks():
-    stmt = db_session.query(Task).statement
-    df = pd.read_sql(stmt, db_session.bind)
-    return df.to_dict('records')
+def get_all_tasks(db_session: Session = Depends(get_db)):
+    return [row._asdict() for row in db_session.execute(select(Task.__table__))]
 
 
 @stats_router.get('/task/{task_id}')
-def get_task(task_id: int):
-    stmt = db_session.query(Task).filter_by(task_id=task_id).statement
-    df = pd.read_sql(stmt, db_session.bind)
-    return df.to_dict('records')
+def get_task(task_id: int, db_session: Session = Depends(get_db)):
+    return [row._asdict() for row in db_session.execute(select(Task.__table__).where(Task.task_id == task_id))]
 
 
 @stats_router.get('/all-clusters/{task_id}')
-def get_all_clusters(task_id: int):
-    stmt = db_session.query(Cluster).filter_by(task_id=task_id).statement
-    df = pd.read_sql(stmt, db_session.bind)
-    return df.to_dict('records')
-
-
-def nested_dict_from_groupby(grouped):
-    result_dict = {}
-    for keys, value in grouped.items():
-        current_level = result_dict
-        # Iterate over the keys (except for the last one) to create the nested structure
-        for key in keys[:-1]:
-            if key not in current_level:
-                current_level[key] = {}
-            current_level = current_level[key]
-        # Use the last key for the actual group data (you might want to customize this part)
-        current_level[keys[-1]] = value
-    return result_dict
+def get_all_clusters(task_id: int, db_session: Session = Depends(get_db)):
+    return [row._asdict() for row in db_session.execute(select(Cluster.__table__).where(Cluster.task_id == task_id))]
 
 
 @stats_router.get('/responses-by-cluster/{task_id}')
-def get_responses_by_cluster(task_id: int):
-    responses = get_all_responses(task_id)
-    grouped = responses.groupby(['cluster', 'question', 'text']).size()
-    reply = nested_dict_from_groupby(grouped)
-
-    return reply
-
-
-last_load_time = time()
-
-
-def get_all_responses(task_id: int):
-    global last_load_time
-    if task_id not in all_responses or time() - last_load_time > 60:
-        t0 = time()
-        logger.info('Cache miss for responses for task {}'.format(task_id))
-        stmt = db_session.query(Response).filter_by(task_id=task_id).statement
-        df = pd.read_sql(stmt, db_session.bind)
-
-        questions_by_id = {
-            question.question_id: question.text
-            for question in db_session.query(Question).filter_by(task_id=task_id).all()
-        }
-        df['question'] = df['question_id'].apply(lambda x: questions_by_id[x])
-
-        cluster_by_user_fid = {
-            completion.user_fid: {
-                'cluster': completion.cluster.name,
-                'token_id': completion.token_id
-            }
-            for completion in db_session.query(Completion).filter_by(task_id=task_id).all()
-        }
-        df['cluster'] = df['user_fid'].apply(lambda x: cluster_by_user_fid[x]['cluster'])
-        df['token_id'] = df['user_fid'].apply(lambda x: cluster_by_user_fid[x]['token_id'])
-
-        df['text'] = df['value'].apply(lambda x: response_by_value[x])
-
-        all_responses[task_id] = df
-        last_load_time = time()
-        logger.info(f'Gathering responses for task_id {task_id} took {time() - t0:.2f} seconds')
-    return all_responses[task_id]
+def get_responses_by_cluster(task_id: int, db_session: Session = Depends(get_db)):
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        return {}
+    return cached(stats_key('responses_by_cluster', task_id), stats_cache_ttl,
+                  lambda: responses_by_cluster(db_session, task))
+
+
+@stats_router.get('/snapshot/{task_id}')
+def get_snapshot(task_id: int):
+    # what the latest columnar snapshot of the task holds, see api/snapshots.py. The snapshot endpoints
+    # import it themselves, so only a server that serves them imports pyarrow
+    from api.snapshots import open_snapshot
+    snapshot = open_snapshot(task_id)
+    return snapshot.manifest if snapshot is not None else {}
+
+
+@stats_router.get('/snapshot/{task_id}/survey-stats')
+def get_snapshot_survey_stats(task_id: int):
+    # as /survey-stats, counted from the snapshot files rather than the count tables, so without the database
+    from api.snapshots import open_snapshot, snapshot_stats
+    snapshot = open_snapshot(task_id)
+    if snapshot is None:
+        return {}
+    return snapshot_stats(snapshot)
+
+
+@stats_router.get('/snapshot/{task_id}/responses-by-cluster')
+def get_snapshot_responses_by_cluster(task_id: int):
+    from api.snapshots import open_snapshot, snapshot_stats
+    snapshot = open_snapshot(task_id)
+    if snapshot is None:
+        return {}
+    return snapshot_stats(snapshot, by_cluster=True)
+
+
+def get_all_responses(db_session: Session, task_id: int):
+    task = task_cache.get(db_session, task_id)
+    if task is None:
+        import pandas as pd
+        return pd.DataFrame(columns=columns)
+    return analytics_store.get(db_session, task)
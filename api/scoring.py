@@ -1,4 +1,11 @@
 import logging
+import os
+import threading
+from collections import OrderedDict
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from api.aggregates import rebuild_counts
+from api.models import Response, Completion
 
 # Configure the logging with time
 logging.basicConfig(level=logging.INFO,
@@ -38,3 +45,260 @@ def get_quiz_result(all_answers):
     logger.info('Computed result of quiz: {}'.format(result))
 
     return result
+
+
+class TaskScorer:
+    """
+    Vectorized version of get_quiz_result for one task, built from a task snapshot.
+    Scores a users x questions matrix of answer values in one matmul against a questions x categories weight matrix.
+    Names come out identical to get_quiz_result, including its tie breaking and the order of the axes in the name,
+    both of which depend on the order the answers were given in.
+    """
+
+    def __init__(self, task):
+        # numpy is imported by the first scorer, so the server doesn't load it until a survey is answered
+        import numpy as np
+        self.version = task.version
+        self.question_ids = np.array([question.question_id for question in task.questions], dtype=np.int64)
+        self.column_by_question = {question_id: i for i, question_id in enumerate(self.question_ids.tolist())}
+        categories = list(task.categories.values())
+        self.category_names = [category.name for category in categories]
+        column_by_category = {category.category_id: i for i, category in enumerate(categories)}
+        num_categories = len(categories)
+
+        self.weights = np.zeros((len(task.questions), num_categories), dtype=np.int64)
+        # position of the category in the question's category list, get_quiz_result visits them in that order
+        self.positions = np.full((len(task.questions), num_categories), num_categories, dtype=np.int64)
+        for row, question in enumerate(task.questions):
+            for position, category_id in enumerate(question.category_ids):
+                self.weights[row, column_by_category[category_id]] = 1
+                self.positions[row, column_by_category[category_id]] = position
+
+        # each pair of opposite categories is one axis
+        self.axes = []
+        for category in categories:
+            opposite = column_by_category.get(category.opposite_category_id)
+            column = column_by_category[category.category_id]
+            if opposite is not None and column < opposite:
+                self.axes.append((column, opposite))
+
+    def values_matrix(self, answers_by_user):
+        """
+        answers_by_user is { user: [(question_id, value), ...] } in the order the answers were given.
+        Returns the users, their values matrix and the rank of each answer.
+        """
+        import numpy as np
+        users = list(answers_by_user)
+        values = np.zeros((len(users), len(self.question_ids)), dtype=np.int64)
+        ranks = np.zeros_like(values)
+        for row, user in enumerate(users):
+            for rank, (question_id, value) in enumerate(answers_by_user[user]):
+                values[row, self.column_by_question[question_id]] = value
+                ranks[row, self.column_by_question[question_id]] = rank
+        return users, values, ranks
+
+    def score(self, values, ranks=None):
+        """
+        values is a users x questions matrix with 0 for unanswered questions, ranks gives the order
+        the answers were given in (defaults to question order). Returns (names, scores).
+        """
+        import numpy as np
+        num_users, num_questions = values.shape
+        num_categories = len(self.category_names)
+        scores = values @ self.weights
+        if num_users == 0 or len(self.axes) == 0:
+            return np.full(num_users, '', dtype=object), scores
+        if ranks is None:
+            ranks = np.broadcast_to(np.arange(num_questions), values.shape)
+
+        answered = values != 0
+        rows = np.arange(num_users)
+        no_rank = np.iinfo(np.int64).max
+
+        winners = np.full((num_users, len(self.axes)), -1, dtype=np.int64)
+        first_seen = np.full((num_users, len(self.axes)), no_rank, dtype=np.int64)
+        for axis, (a, b) in enumerate(self.axes):
+            touches = (self.weights[:, a] | self.weights[:, b]).astype(bool)
+            answer_ranks = np.where(answered & touches, ranks, no_rank)
+            first_question = answer_ranks.argmin(axis=1)
+            seen = answer_ranks[rows, first_question] != no_rank
+
+            # the category of this axis that get_quiz_result meets first is the one it compares against its opposite
+            a_first = self.positions[first_question, a] <= self.positions[first_question, b]
+            first = np.where(a_first, a, b)
+            other = np.where(a_first, b, a)
+            winner = np.where(scores[rows, first] > scores[rows, other], first, other)
+
+            winners[:, axis] = np.where(seen, winner, -1)
+            position = np.minimum(self.positions[first_question, a], self.positions[first_question, b])
+            first_seen[:, axis] = np.where(seen, answer_ranks[rows, first_question] * (num_categories + 1) + position, no_rank)
+
+        # order the axes the way they were first met, then turn each distinct combination into a name once
+        order = np.argsort(first_seen, axis=1, kind='stable')
+        ordered = np.take_along_axis(winners, order, axis=1)
+        combinations, inverse = np.unique(ordered, axis=0, return_inverse=True)
+        combination_names = np.array([
+            ' '.join(self.category_names[column] for column in combination if column >= 0)
+            for combination in combinations
+        ], dtype=object)
+        return combination_names[inverse.reshape(-1)], scores
+
+    def score_user(self, answers):
+        """
+        Scores one user's answers, given as [(question_id, value), ...] in the order they were given.
+        """
+        import numpy as np
+        _, values, ranks = self.values_matrix({None: answers})
+        names, scores = self.score(values, ranks)
+        # like get_quiz_result, only categories of answered questions get a score
+        scored = self.weights[values[0] != 0].any(axis=0)
+        result = {
+            'name': names[0],
+            'scores': {
+                self.category_names[column]: int(scores[0, column])
+                for column in np.flatnonzero(scored)
+            }
+        }
+        logger.info('Computed result of quiz: {}'.format(result))
+        return result
+
+
+class RunningScore:
+    """
+    One user's answers to a task so far, in the order they were first given, with their category scores
+    and how each axis was first met, kept up to date tap by tap.
+    """
+    __slots__ = ('version', 'answers', 'scores', 'first_seen')
+
+    def __init__(self, scorer):
+        import numpy as np
+        self.version = scorer.version
+        self.answers = OrderedDict()  # { question_id: value }
+        self.scores = np.zeros(len(scorer.category_names), dtype=np.int64)
+        self.first_seen = [None] * len(scorer.axes)  # per axis: (answer rank, position in question, category column)
+
+
+def record_answer(scorer, running, question_id, value):
+    column = scorer.column_by_question[question_id]
+    previous = running.answers.get(question_id)
+    if previous is None:
+        rank = len(running.answers)
+        for axis, (a, b) in enumerate(scorer.axes):
+            if running.first_seen[axis] is None and (scorer.weights[column, a] or scorer.weights[column, b]):
+                position_a, position_b = scorer.positions[column, a], scorer.positions[column, b]
+                first = a if position_a <= position_b else b
+                running.first_seen[axis] = (rank, min(position_a, position_b), first)
+        running.scores += scorer.weights[column] * value
+    else:
+        # a replaced answer keeps its place, like the upserted response row keeps its response_id
+        running.scores += scorer.weights[column] * (value - previous)
+    running.answers[question_id] = value
+
+
+def running_name(scorer, running):
+    names = []
+    for first_seen, axis in sorted((first_seen, axis) for axis, first_seen in enumerate(running.first_seen)
+                                   if first_seen is not None):
+        a, b = scorer.axes[axis]
+        first = first_seen[2]
+        other = b if first == a else a
+        winner = first if running.scores[first] > running.scores[other] else other
+        names.append(scorer.category_names[winner])
+    return ' '.join(names)
+
+
+class RunningScores:
+    """
+    Bounded LRU of RunningScore per (task_id, user_fid), so finishing a survey doesn't need to rescan the answers.
+    It only sees the taps this process handled, callers fall back to the database when it isn't complete.
+    """
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.users = OrderedDict()  # { (task_id, user_fid): RunningScore }
+        self.lock = threading.Lock()
+
+    def record(self, task, user_fid, question_id, value):
+        scorer = get_scorer(task)
+        key = (task.task_id, user_fid)
+        with self.lock:
+            running = self.users.get(key)
+            if running is None or running.version != scorer.version:
+                running = RunningScore(scorer)
+                self.users[key] = running
+            self.users.move_to_end(key)
+            record_answer(scorer, running, question_id, value)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def get_complete(self, task, user_fid):
+        """
+        Returns the user's running score if it holds an answer to every question page of the task, otherwise None.
+        """
+        scorer = get_scorer(task)
+        with self.lock:
+            running = self.users.get((task.task_id, user_fid))
+        # page 0 is the start page, so the first question of a task is never asked
+        if running is None or running.version != scorer.version or len(running.answers) < len(task.questions) - 1:
+            return None
+        return running
+
+    def discard(self, task_id, user_fid):
+        with self.lock:
+            self.users.pop((task_id, user_fid), None)
+
+
+running_scores = RunningScores(int(os.environ.get('RUNNING_SCORES_SIZE', 100000)))
+
+scorers = {}  # { task_id: TaskScorer }
+
+
+def get_scorer(task):
+    scorer = scorers.get(task.task_id)
+    if scorer is None or scorer.version != task.version:
+        scorer = TaskScorer(task)
+        scorers[task.task_id] = scorer
+    return scorer
+
+
+def recompute_clusters(db_session: Session, task):
+    """
+    Scores every user of a task in bulk and moves completions whose cluster changed, returns how many moved.
+    """
+    import numpy as np
+    rows = db_session.query(Response.user_fid, Response.question_id, Response.value) \
+        .filter_by(task_id=task.task_id) \
+        .order_by(Response.response_id) \
+        .all()
+    scorer = get_scorer(task)
+    if len(rows) == 0:
+        return 0
+
+    user_fids, question_ids, answer_values = (np.array(column, dtype=np.int64) for column in zip(*rows))
+    fids, user_rows = np.unique(user_fids, return_inverse=True)
+    columns = np.array([scorer.column_by_question[question_id] for question_id in question_ids.tolist()])
+
+    values = np.zeros((len(fids), len(scorer.question_ids)), dtype=np.int64)
+    values[user_rows, columns] = answer_values
+    # rows are in response_id order, so their position orders each user's answers
+    ranks = np.zeros_like(values)
+    ranks[user_rows, columns] = np.arange(len(rows))
+    names, _ = scorer.score(values, ranks)
+
+    cluster_by_fid = {
+        fid: task.clusters[name].cluster_id
+        for fid, name in zip(fids.tolist(), names)
+        if name in task.clusters
+    }
+    changes = [
+        {'completion_id': completion_id, 'cluster_id': cluster_by_fid[user_fid]}
+        for completion_id, user_fid, cluster_id in db_session.query(
+            Completion.completion_id, Completion.user_fid, Completion.cluster_id).filter_by(task_id=task.task_id)
+        if user_fid in cluster_by_fid and cluster_by_fid[user_fid] != cluster_id
+    ]
+    if changes:
+        db_session.execute(update(Completion), changes)
+        rebuild_counts(db_session.connection(), task.task_id)
+        db_session.commit()
+    logger.info('Recomputed clusters of {} users for task {}, {} changed'.format(len(fids), task.task_id, len(changes)))
+    return len(changes)
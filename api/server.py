@@ -1,9 +1,19 @@
-from fastapi import FastAPI, Request
-from api.routes import frames_router, stats_router
+from fastapi import FastAPI
+from api.routes import frames_router, stats_router, images_router, metrics_router
+from api.routes.frames import warm_page_cache
+from api.external.hub_api import close_async_client
+from api.external.frame_verify import start_signer_refresh, stop_signer_refresh
+from api.response_buffer import response_buffer
+from api.aggregates import ensure_counts
+from api.token_ids import ensure_token_table, start_token_sync, stop_token_sync
+from api.models import engine, Completion, add_missing_columns
+from api.migrations import migrate
+from api.metrics import instrument_engine
+from api.middleware import RequestMiddleware, start_access_log, stop_access_log
+from api.shared_cache import shared_cache
 from fastapi.middleware.cors import CORSMiddleware
-import time
-from starlette.middleware.base import BaseHTTPMiddleware
 import logging
+import os
 
 # Configure the logging with time
 logging.basicConfig(level=logging.INFO,
@@ -13,31 +23,51 @@ logging.basicConfig(level=logging.INFO,
 # Create a logger object
 logger = logging.getLogger(__name__)
 
-
-class LogResponseTime(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        # Log the response time (you can customize this part to fit your logging format)
-        logger.info(f"Response time for request {request.url}: {process_time:.2f} seconds.")
-        return response
-
-
-class CacheControlMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        response.headers["Cache-Control"] = "max-age=10"  # Apply cache-control globally
-        return response
+# Set to 0 when the database is prepared once before starting several workers, which would otherwise all
+# migrate and recount it at the same time, see run-server-prod.sh
+prepare_on_startup = os.environ.get('PREPARE_DATABASE', '1') != '0'
 
 
 app = FastAPI()
 
 app.include_router(frames_router)
 app.include_router(stats_router)
+app.include_router(images_router)
+app.include_router(metrics_router)
+
+instrument_engine(engine)
+
+
+def prepare_database():
+    migrate()
+    add_missing_columns(Completion.__table__)
+    ensure_counts()
+    ensure_token_table()
+
 
-app.add_middleware(LogResponseTime)
-app.add_middleware(CacheControlMiddleware)
+@app.on_event('startup')
+async def startup():
+    start_access_log()
+    if prepare_on_startup:
+        prepare_database()
+    shared_cache.start()
+    warm_page_cache()
+    response_buffer.start()
+    start_signer_refresh()
+    start_token_sync()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    stop_signer_refresh()
+    stop_token_sync()
+    await response_buffer.stop()
+    await close_async_client()
+    shared_cache.stop()
+    stop_access_log()
+
+
+app.add_middleware(RequestMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -47,6 +77,6 @@ app.add_middleware(
 )
 
 
-
-
-
+if __name__ == '__main__':
+    # prepares the database for workers started with PREPARE_DATABASE=0
+    prepare_database()
@@ -0,0 +1,215 @@
+from threading import Lock
+from time import sleep, time
+import json
+import logging
+import os
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# Where the caches the server's workers share live. memory:// keeps them in the process, which is all a single
+# worker needs; redis://host:port/db shares them between workers through Redis, or a server speaking its
+# protocol such as Valkey or Dragonfly. See run-server-prod.sh
+cache_url = os.environ.get('CACHE_URL', 'memory://')
+# Prefix of the keys and of the invalidation channel, so several deployments can share one Redis
+cache_prefix = os.environ.get('CACHE_PREFIX', 'survey')
+
+
+class MemoryCache:
+    """
+    The shared cache of a single process. Values are kept as they are, and invalidations go straight to the
+    process' own handlers.
+    """
+    backend = 'memory'
+
+    def __init__(self):
+        self.values = {}  # { key: (expires_at or None, value) }
+        self.counters = {}
+        self.handlers = []
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.values.get(key)
+        if entry is None or (entry[0] is not None and entry[0] < time()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = (time() + ttl if ttl is not None else None, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def publish(self, message):
+        for handler in self.handlers:
+            handler(message)
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend,
+            'keys': len(self.values),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+def to_json(value):
+    # stats computed with pandas hold numpy scalars, which json can't encode itself
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+class RedisCache:
+    """
+    A cache shared by every process using the same Redis. Values are stored as JSON, so only dicts, lists, strings
+    and numbers can be shared, and nothing read back from Redis is ever executed; invalidations are published
+    on a channel each process listens to from a thread of its own. The cache is never what a request depends on:
+    if Redis can't be reached, lookups miss and stores are dropped, so each worker computes for itself.
+    """
+    backend = 'redis'
+
+    def __init__(self, url):
+        # only needed by servers sharing their caches, so single worker ones never import it
+        import redis
+        self.errors = (redis.RedisError,)
+        self.client = redis.Redis.from_url(url)
+        self.channel = '{}:invalidate'.format(cache_prefix)
+        self.handlers = []
+        self.listener = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def key(self, key):
+        return '{}:{}'.format(cache_prefix, key)
+
+    def failed(self, action, key, e):
+        self.failures += 1
+        logger.warning('Shared cache {} of {} failed: {}'.format(action, key, e))
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.key(key))
+        except self.errors as e:
+            self.failed('get', key, e)
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(self.key(key), json.dumps(value, default=to_json),
+                            px=int(ttl * 1000) if ttl is not None else None)
+        except self.errors as e:
+            self.failed('set', key, e)
+
+    def delete(self, *keys):
+        try:
+            self.client.delete(*[self.key(key) for key in keys])
+        except self.errors as e:
+            self.failed('delete', keys, e)
+
+    def incr(self, key):
+        try:
+            return self.client.incr(self.key(key))
+        except self.errors as e:
+            self.failed('incr', key, e)
+            # still tells this value from the ones counted before and, most likely, from the other workers'
+            return int(time() * 1e6)
+
+    def publish(self, message):
+        try:
+            self.client.publish(self.channel, json.dumps(message))
+        except self.errors as e:
+            self.failed('publish', message, e)
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def on_message(self, message):
+        message = json.loads(message['data'])
+        for handler in self.handlers:
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('Handling invalidation {} failed'.format(message))
+
+    def on_listener_error(self, e, pubsub, thread):
+        # the listener reconnects and subscribes again on its next read, what was published meanwhile is lost
+        self.failed('listen', self.channel, e)
+        sleep(1)
+
+    def start(self):
+        if self.listener is not None:
+            return
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self.on_message})
+        self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self.on_listener_error)
+
+    def stop(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend,
+            'listening': self.listener is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+def make_cache(url):
+    if url.startswith('memory://'):
+        return MemoryCache()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url)
+    raise ValueError('Unsupported CACHE_URL {}, expected memory:// or redis://'.format(url))
+
+
+def cached(key, ttl, compute):
+    """
+    The value shared at key, or compute()'s, which is then shared for ttl seconds. Workers missing at the same
+    time each compute it; the point is that the ones after them don't.
+    """
+    value = shared_cache.get(key)
+    if value is None:
+        value = compute()
+        shared_cache.set(key, value, ttl)
+    return value
+
+
+shared_cache = make_cache(cache_url)
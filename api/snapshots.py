@@ -0,0 +1,334 @@
+# Columnar snapshots of each task's responses, completions, questions and clusters, as Arrow IPC files under
+# SNAPSHOT_DIR/task-<task_id>/, for analysts and for aggregations too heavy to run against the live database.
+# Responses are appended by response_id, a part file per run, the other tables are small and written whole.
+# Every file is uncompressed Arrow IPC, so readers memory map it instead of loading it, and it opens with
+# pyarrow.ipc.open_file or pandas.read_feather:
+# python -m api.snapshots
+# python -m api.snapshots --task-id 1 --full
+# python -m api.snapshots --interval 300
+from itertools import islice
+from time import perf_counter, time, sleep
+from sqlalchemy import select, make_url
+from api.models import engine, Task, Response, Completion, Question, Cluster
+from api.aggregates import response_by_value
+import argparse
+import json
+import logging
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+snapshot_dir = os.environ.get('SNAPSHOT_DIR', './snapshots')
+# Rows per record batch read from sqlite, and so per record batch of a part file
+snapshot_batch_size = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 1000000))
+# Replaced answers update rows in place rather than adding new ones, a periodic full snapshot picks them up
+full_snapshot_interval = float(os.environ.get('FULL_SNAPSHOT_INTERVAL', 86400))
+# Beyond this many response parts they are merged into one, from the files rather than the database
+max_response_parts = int(os.environ.get('MAX_RESPONSE_PARTS', 32))
+
+response_schema = pa.schema([
+    ('response_id', pa.int64()),
+    ('question_id', pa.int64()),
+    ('task_id', pa.int64()),
+    ('user_fid', pa.int64()),
+    ('username', pa.string()),
+    ('value', pa.int8()),
+    ('submitted_at', pa.timestamp('us')),
+])
+completion_schema = pa.schema([
+    ('completion_id', pa.int64()),
+    ('task_id', pa.int64()),
+    ('user_fid', pa.int64()),
+    ('cluster_id', pa.int64()),
+    ('token_id', pa.int64()),
+    ('mint_status', pa.string()),
+    ('claimed_at', pa.float64()),
+])
+question_schema = pa.schema([
+    ('question_id', pa.int64()),
+    ('sequence_num', pa.int64()),
+    ('text', pa.string()),
+])
+cluster_schema = pa.schema([
+    ('cluster_id', pa.int64()),
+    ('name', pa.string()),
+    ('image_ipfs_hash', pa.string()),
+])
+
+
+def adbc_connect(url):
+    """
+    An ADBC connection to the database at a SQLAlchemy url. ADBC drivers read results straight into Arrow,
+    several times faster than building rows in Python. Only the snapshot job needs them, so they are
+    imported here rather than by every process that reads snapshots.
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        import adbc_driver_sqlite.dbapi
+        return adbc_driver_sqlite.dbapi.connect(url.database)
+    import adbc_driver_postgresql.dbapi
+    return adbc_driver_postgresql.dbapi.connect(url.set(drivername='postgresql').render_as_string(hide_password=False))
+
+
+def columns_of(model, schema):
+    return [getattr(model, name) for name in schema.names]
+
+
+def fetch_batches(cursor, dialect, stmt, schema):
+    """
+    Yields the rows of stmt as record batches of schema. The drivers infer types from the values,
+    e.g. sqlite timestamps come as strings, so each batch is cast.
+    """
+    cursor.execute(str(stmt.compile(dialect=dialect, compile_kwargs={'literal_binds': True})))
+    for batch in cursor.fetch_record_batch():
+        yield batch.rename_columns(schema.names).cast(schema)
+
+
+def write_table(path, schema, batches):
+    """
+    Writes the batches to path as an Arrow IPC file, through a temporary file so readers never see half of it.
+    Returns how many rows were written.
+    """
+    rows = 0
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    os.replace(tmp_path, path)
+    return rows
+
+
+def read_table(path):
+    """
+    Memory maps an Arrow IPC file. The table's buffers point into the map, so nothing is read until used.
+    """
+    with pa.memory_map(path, 'r') as source:
+        return ipc.open_file(source).read_all()
+
+
+def task_dir(task_id, directory=None):
+    return os.path.join(directory or snapshot_dir, 'task-{}'.format(task_id))
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path, manifest):
+    tmp_path = os.path.join(path, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+
+def new_manifest(task_id, generation):
+    return {
+        'task_id': task_id,
+        # full snapshots start a new generation of response parts, the old one is removed once it's replaced
+        'generation': generation,
+        'response_id': 0,
+        'responses': 0,
+        'completions': 0,
+        'parts': [],
+        'next_part': 0,
+        'full_at': time(),
+        'updated_at': None
+    }
+
+
+def next_part(manifest):
+    manifest['next_part'] += 1
+    return 'responses-{}-{}.arrow'.format(manifest['generation'], manifest['next_part'])
+
+
+def compact_parts(path, manifest):
+    """
+    Merges the response parts into one, batch by batch, and returns the parts replaced.
+    """
+    parts = manifest['parts']
+    merged = next_part(manifest)
+    write_table(os.path.join(path, merged), response_schema,
+                (batch for part in parts for batch in read_table(os.path.join(path, part)).to_batches()))
+    manifest['parts'] = [merged]
+    return parts
+
+
+def snapshot_task(cursor, dialect, task_id, directory=None, full=False):
+    """
+    Appends the task's responses above the last snapshot's response_id as a new part, and rewrites its
+    completions, questions and clusters. A full snapshot rewrites the responses too. Returns the manifest.
+    """
+    t0 = perf_counter()
+    path = task_dir(task_id, directory)
+    os.makedirs(path, exist_ok=True)
+    manifest = read_manifest(path)
+    stale = []
+    if manifest is None or full or time() - manifest['full_at'] > full_snapshot_interval:
+        if manifest is not None:
+            stale = manifest['parts']
+        manifest = new_manifest(task_id, manifest['generation'] + 1 if manifest is not None else 1)
+
+    stmt = select(*columns_of(Response, response_schema)) \
+        .where(Response.task_id == task_id, Response.response_id > manifest['response_id']) \
+        .order_by(Response.response_id)
+    part = next_part(manifest)
+    response_ids = []
+
+    def new_responses():
+        for batch in fetch_batches(cursor, dialect, stmt, response_schema):
+            response_ids.append(batch.column('response_id')[-1].as_py())
+            yield batch
+
+    appended = write_table(os.path.join(path, part), response_schema, new_responses())
+    if appended > 0:
+        manifest['parts'].append(part)
+        manifest['response_id'] = response_ids[-1]
+        manifest['responses'] += appended
+    else:
+        os.remove(os.path.join(path, part))
+    if len(manifest['parts']) > max_response_parts:
+        stale += compact_parts(path, manifest)
+
+    stmt = select(*columns_of(Completion, completion_schema)) \
+        .where(Completion.task_id == task_id).order_by(Completion.completion_id)
+    manifest['completions'] = write_table(os.path.join(path, 'completions.arrow'), completion_schema,
+                                          fetch_batches(cursor, dialect, stmt, completion_schema))
+    stmt = select(*columns_of(Question, question_schema)) \
+        .where(Question.task_id == task_id).order_by(Question.sequence_num, Question.question_id)
+    write_table(os.path.join(path, 'questions.arrow'), question_schema,
+                fetch_batches(cursor, dialect, stmt, question_schema))
+    stmt = select(*columns_of(Cluster, cluster_schema)).where(Cluster.task_id == task_id)
+    write_table(os.path.join(path, 'clusters.arrow'), cluster_schema,
+                fetch_batches(cursor, dialect, stmt, cluster_schema))
+
+    manifest['updated_at'] = time()
+    write_manifest(path, manifest)
+    # readers that loaded the previous manifest keep their maps of removed files, unlinking doesn't unmap them
+    for name in stale:
+        os.remove(os.path.join(path, name))
+    logger.info('Snapshot of task {}: {} new responses, {} in total, {} completions in {:.2f}s'.format(
+        task_id, appended, manifest['responses'], manifest['completions'], perf_counter() - t0))
+    return manifest
+
+
+def snapshot_all(task_ids=None, directory=None, full=False, bind=engine):
+    """
+    Snapshots the given tasks, or every task. On sqlite each task is read in one transaction, so its tables
+    agree with each other, and being a WAL reader it doesn't hold up the server's writes. The sqlite driver
+    bundles its own sqlite, and two copies of sqlite in one process don't see each other's locks, so this
+    runs in a process of its own that reads only through ADBC, never in the server.
+    """
+    if task_ids is None:
+        with adbc_connect(bind.url) as connection, connection.cursor() as cursor:
+            cursor.execute(str(select(Task.task_id).order_by(Task.task_id).compile(dialect=bind.dialect)))
+            task_ids = [task_id for (task_id,) in cursor.fetchall()]
+    for task_id in task_ids:
+        with adbc_connect(bind.url) as connection, connection.cursor() as cursor:
+            if bind.dialect.name == 'sqlite':
+                cursor.adbc_statement.set_options(**{'adbc.sqlite.query.batch_rows': str(snapshot_batch_size)})
+            snapshot_task(cursor, bind.dialect, task_id, directory, full)
+            connection.rollback()
+
+
+class TaskSnapshot:
+    """
+    A task's snapshot tables, memory mapped. Loading one reads only the manifest and the file footers.
+    """
+
+    def __init__(self, manifest, responses, completions, questions, clusters):
+        self.manifest = manifest
+        self.responses = responses
+        self.completions = completions
+        self.questions = questions
+        self.clusters = clusters
+
+    def latest_completions(self):
+        """
+        Each user's latest completion, as a table of user_fid, cluster_id and token_id.
+        """
+        return self.completions.select(['user_fid', 'cluster_id', 'token_id']) \
+            .group_by('user_fid', use_threads=False) \
+            .aggregate([('cluster_id', 'last'), ('token_id', 'last')]) \
+            .rename_columns(['user_fid', 'cluster_id', 'token_id'])
+
+    def answer_counts(self, by_cluster=False):
+        """
+        Counts of each (question_id, value), or of each (cluster_id, question_id, value) among users who
+        completed the task, as a table with a count column.
+        """
+        responses = self.responses.select(['user_fid', 'question_id', 'value'])
+        keys = ['question_id', 'value']
+        if by_cluster:
+            responses = responses.join(self.latest_completions().select(['user_fid', 'cluster_id']), 'user_fid',
+                                       join_type='inner')
+            keys = ['cluster_id'] + keys
+        return responses.group_by(keys).aggregate([('question_id', 'count')]) \
+            .rename_columns(keys + ['count'])
+
+
+def open_snapshot(task_id, directory=None):
+    """
+    The task's latest snapshot, or None if it has none yet.
+    """
+    path = task_dir(task_id, directory)
+    for attempt in range(2):
+        manifest = read_manifest(path)
+        if manifest is None:
+            return None
+        try:
+            parts = [read_table(os.path.join(path, part)) for part in manifest['parts']]
+            return TaskSnapshot(
+                manifest,
+                pa.concat_tables(parts) if len(parts) > 0 else response_schema.empty_table(),
+                read_table(os.path.join(path, 'completions.arrow')),
+                read_table(os.path.join(path, 'questions.arrow')),
+                read_table(os.path.join(path, 'clusters.arrow'))
+            )
+        except FileNotFoundError:
+            # a full snapshot removed the parts between reading the manifest and opening them
+            if attempt == 1:
+                raise
+
+
+def snapshot_stats(snapshot, by_cluster=False):
+    """
+    survey_stats, or responses_by_cluster with by_cluster, computed from a snapshot instead of the count tables.
+    """
+    questions = dict(zip(snapshot.questions.column('question_id').to_pylist(),
+                         snapshot.questions.column('text').to_pylist()))
+    clusters = dict(zip(snapshot.clusters.column('cluster_id').to_pylist(),
+                        snapshot.clusters.column('name').to_pylist()))
+    counts = snapshot.answer_counts(by_cluster)
+    counts = counts.filter(pc.greater(counts.column('count'), 0))
+    result = {}
+    for row in counts.to_pylist():
+        answers = result.setdefault(clusters[row['cluster_id']], {}) if by_cluster else result
+        answers.setdefault(questions[row['question_id']], {})[response_by_value[row['value']]] = row['count']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task-id', type=int, action='append', help='task to snapshot, all of them by default')
+    parser.add_argument('--dir', default=snapshot_dir, help='directory to write the snapshots to')
+    parser.add_argument('--full', action='store_true', help='rewrite the responses instead of appending the new ones')
+    parser.add_argument('--interval', type=float, help='keep snapshotting, every this many seconds')
+    args = parser.parse_args()
+
+    while True:
+        snapshot_all(args.task_id, args.dir, args.full)
+        if args.interval is None:
+            break
+        sleep(args.interval)
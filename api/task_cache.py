@@ -0,0 +1,256 @@
+from dataclasses import dataclass, asdict
+from sqlalchemy.orm import Session, selectinload
+from api.models import Task, Question, Category, Cluster
+from api.frame_tags import get_question_meta_tags
+from api.shared_cache import shared_cache
+from typing import Dict, Optional, Tuple
+import logging
+import threading
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QuestionSnapshot:
+    question_id: int
+    sequence_num: int
+    text: str
+    image_ipfs_hash: str
+    category_ids: Tuple[int, ...]
+
+
+@dataclass(frozen=True)
+class CategorySnapshot:
+    category_id: int
+    name: str
+    opposite_category_id: Optional[int]
+
+
+@dataclass(frozen=True)
+class ClusterSnapshot:
+    cluster_id: int
+    name: str
+    image_ipfs_hash: str
+
+
+@dataclass(frozen=True)
+class TaskSnapshot:
+    """
+    Everything needed to render a task's pages, read once from the database and never mutated.
+    Has the same network/contract_address attributes as Task, so it can be passed where a Task is expected.
+    """
+    version: int
+    task_id: int
+    title: str
+    description: str
+    network: str
+    contract_address: str
+    questions: Tuple[QuestionSnapshot, ...]
+    questions_by_id: Dict[int, QuestionSnapshot]
+    categories: Dict[int, CategorySnapshot]
+    clusters: Dict[str, ClusterSnapshot]
+    # meta tags of each question page, indexed by page number
+    page_meta_tags: Tuple[str, ...]
+
+    def get_question(self, page_num: int):
+        return self.questions[page_num] if 0 <= page_num < len(self.questions) else None
+
+
+def snapshot_key(task_id):
+    return 'task_snapshot:{}'.format(task_id)
+
+
+def snapshot_record(snapshot):
+    """
+    The snapshot as plain dicts and lists, which is how it is kept in the shared cache.
+    """
+    return {
+        'version': snapshot.version,
+        'task_id': snapshot.task_id,
+        'title': snapshot.title,
+        'description': snapshot.description,
+        'network': snapshot.network,
+        'contract_address': snapshot.contract_address,
+        'questions': [asdict(question) for question in snapshot.questions],
+        'categories': [asdict(category) for category in snapshot.categories.values()],
+        'clusters': [asdict(cluster) for cluster in snapshot.clusters.values()],
+        'page_meta_tags': list(snapshot.page_meta_tags)
+    }
+
+
+def snapshot_from_record(record):
+    questions = tuple(
+        QuestionSnapshot(**dict(question, category_ids=tuple(question['category_ids'])))
+        for question in record['questions']
+    )
+    return TaskSnapshot(
+        version=record['version'],
+        task_id=record['task_id'],
+        title=record['title'],
+        description=record['description'],
+        network=record['network'],
+        contract_address=record['contract_address'],
+        questions=questions,
+        questions_by_id={question.question_id: question for question in questions},
+        categories={category['category_id']: CategorySnapshot(**category) for category in record['categories']},
+        clusters={cluster['name']: ClusterSnapshot(**cluster) for cluster in record['clusters']},
+        page_meta_tags=tuple(record['page_meta_tags'])
+    )
+
+
+class TaskCache:
+    """
+    Per-task snapshots, built on first use and swapped in whole when a task is refreshed or invalidated.
+    Readers never take a lock: replacing a dict entry is atomic, and a reader keeps whatever snapshot it got.
+    Snapshots are also kept in the shared cache, so of several workers only the first builds a task's, and
+    refreshing or invalidating a task in one worker drops the stale snapshot of every other one.
+    """
+
+    def __init__(self):
+        self.snapshots = {}  # { task_id: TaskSnapshot }
+        self.build_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        shared_cache.subscribe(self.on_invalidate)
+
+    def build(self, db_session: Session, task_id: int):
+        task = db_session.query(Task).filter_by(task_id=task_id).first()
+        if task is None:
+            return None
+
+        questions = db_session.query(Question) \
+            .options(selectinload(Question.categories)) \
+            .filter_by(task_id=task_id) \
+            .order_by(Question.sequence_num, Question.question_id) \
+            .all()
+        categories = db_session.query(Category).filter_by(task_id=task_id).all()
+        clusters = db_session.query(Cluster).filter_by(task_id=task_id).all()
+
+        question_snapshots = tuple(
+            QuestionSnapshot(
+                question_id=question.question_id,
+                sequence_num=question.sequence_num,
+                text=question.text,
+                image_ipfs_hash=question.image_ipfs_hash,
+                category_ids=tuple(category.category_id for category in question.categories)
+            )
+            for question in questions
+        )
+
+        return TaskSnapshot(
+            # counted in the shared cache, so versions are unique across workers
+            version=shared_cache.incr('task_snapshot_version'),
+            task_id=task.task_id,
+            title=task.title,
+            description=task.description,
+            network=task.network,
+            contract_address=task.contract_address,
+            questions=question_snapshots,
+            questions_by_id={question.question_id: question for question in question_snapshots},
+            categories={
+                category.category_id: CategorySnapshot(category.category_id, category.name, category.opposite_category_id)
+                for category in categories
+            },
+            clusters={
+                cluster.name: ClusterSnapshot(cluster.cluster_id, cluster.name, cluster.image_ipfs_hash)
+                for cluster in clusters
+            },
+            page_meta_tags=tuple(
+                get_question_meta_tags(task_id, page_num, question)
+                for page_num, question in enumerate(question_snapshots)
+            )
+        )
+
+    def get(self, db_session: Session, task_id: int):
+        """
+        Returns the task's snapshot, or None if there is no such task.
+        """
+        snapshot = self.snapshots.get(task_id)
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        # only one request builds a missing snapshot, the others wait for it
+        with self.build_lock:
+            snapshot = self.snapshots.get(task_id)
+            if snapshot is None:
+                # another worker may have built it already
+                record = shared_cache.get(snapshot_key(task_id))
+                if record is not None:
+                    self.shared_hits += 1
+                    snapshot = snapshot_from_record(record)
+                    self.snapshots[task_id] = snapshot
+                else:
+                    snapshot = self.load(db_session, task_id)
+        return snapshot
+
+    def peek(self, task_id: int):
+        """
+        Returns the task's snapshot if it is already built, without touching the database.
+        """
+        return self.snapshots.get(task_id)
+
+    def load(self, db_session: Session, task_id: int):
+        # builds the snapshot and shares it, without telling the other workers to drop theirs
+        snapshot = self.build(db_session, task_id)
+        if snapshot is None:
+            self.snapshots.pop(task_id, None)
+            shared_cache.delete(snapshot_key(task_id))
+            return None
+        self.snapshots[task_id] = snapshot
+        shared_cache.set(snapshot_key(task_id), snapshot_record(snapshot))
+        logger.info('Built snapshot version {} of task {} with {} questions'.format(
+            snapshot.version, task_id, len(snapshot.questions)))
+        return snapshot
+
+    def refresh(self, db_session: Session, task_id: int):
+        """
+        Rebuilds a task's snapshot from the database and swaps it in, here and in every other worker,
+        call this after changing a task.
+        """
+        snapshot = self.load(db_session, task_id)
+        shared_cache.publish({'task_id': task_id, 'version': snapshot.version if snapshot is not None else None})
+        return snapshot
+
+    def invalidate(self, task_id: Optional[int] = None):
+        """
+        Drops one task's snapshot, or all of them, here and in every other worker, so they are rebuilt on next use.
+        """
+        message = {'task_id': task_id, 'version': None}
+        # dropped here right away, the other workers drop theirs when the message reaches them
+        self.on_invalidate(message)
+        shared_cache.publish(message)
+
+    def on_invalidate(self, message):
+        # a worker, maybe this one, refreshed or invalidated a task; a snapshot of the version it built is kept
+        if message['task_id'] is None:
+            task_ids = list(self.snapshots)
+        else:
+            task_ids = [message['task_id']]
+        for task_id in task_ids:
+            snapshot = self.snapshots.get(task_id)
+            if snapshot is not None and snapshot.version == message['version']:
+                continue
+            self.snapshots.pop(task_id, None)
+            if message['version'] is None:
+                shared_cache.delete(snapshot_key(task_id))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'tasks': {task_id: snapshot.version for task_id, snapshot in self.snapshots.items()},
+            'hits': self.hits,
+            'misses': self.misses,
+            # misses another worker had already built the snapshot for
+            'shared_hits': self.shared_hits,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+task_cache = TaskCache()
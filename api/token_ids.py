@@ -0,0 +1,188 @@
+from sqlalchemy import select, update, delete, case
+from sqlalchemy.orm import Session
+from api.models import engine, SessionLocal, Base, Task, TokenCounter, Completion
+from api.aggregates import upsert_dialects
+from api.external.chain import collection_size
+from api.metrics import stage_timer
+import asyncio
+import logging
+import os
+from time import time
+
+# Configure the logging with time
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# How old the collection size served by /stats/collection-size may be
+collection_size_max_age = float(os.environ.get('COLLECTION_SIZE_MAX_AGE', 60))
+# How often the counters are reconciled with chain in the background
+token_sync_interval = float(os.environ.get('TOKEN_SYNC_INTERVAL', 300))
+
+
+def ensure_token_table(bind=engine):
+    Base.metadata.create_all(bind, tables=[TokenCounter.__table__])
+
+
+def counter_filter(task):
+    return (TokenCounter.network == task.network) & (TokenCounter.contract_address == task.contract_address)
+
+
+class TokenAllocator:
+    """
+    Hands out token ids per contract from a counter in the database, seeded from chain the first time
+    a contract is seen. The increment is a single UPDATE ... RETURNING, so concurrent finishers,
+    in this process or any other, never get the same id.
+    """
+
+    def __init__(self, read_chain_size=collection_size):
+        self.read_chain_size = read_chain_size
+        self.seeded = set()  # { (network, contract_address) } known to have a counter
+
+    def seed(self, task):
+        """
+        Creates the contract's counter from chain, unless it already exists. Runs in its own transaction,
+        so the chain read never happens while the caller holds a write lock.
+        """
+        with engine.connect() as connection:
+            exists = connection.execute(select(TokenCounter.last_token_id).where(counter_filter(task))).first()
+        if exists is not None:
+            # another process seeded it, chain isn't read on the way to a frame
+            self.seeded.add((task.network, task.contract_address))
+            return
+        with stage_timer('collection_size'):
+            size = int(self.read_chain_size(task))
+        insert = upsert_dialects[engine.dialect.name]
+        with engine.begin() as connection:
+            connection.execute(insert(TokenCounter.__table__).values(
+                network=task.network,
+                contract_address=task.contract_address,
+                last_token_id=size,
+                chain_size=size,
+                synced_at=time()
+            ).on_conflict_do_nothing())
+        self.seeded.add((task.network, task.contract_address))
+        logger.info('Seeded token ids of {} on {} at {}'.format(task.contract_address, task.network, size))
+
+    def allocate(self, db_session: Session, task):
+        """
+        Returns the next token id of the task's contract. The increment is part of the session's transaction,
+        so the id is only used up if the caller commits.
+        """
+        if (task.network, task.contract_address) not in self.seeded:
+            self.seed(task)
+        stmt = update(TokenCounter) \
+            .where(counter_filter(task)) \
+            .values(last_token_id=TokenCounter.last_token_id + 1) \
+            .returning(TokenCounter.last_token_id)
+        token_id = db_session.execute(stmt).scalar()
+        if token_id is None:
+            # the counter was invalidated since this process seeded it
+            self.seed(task)
+            token_id = db_session.execute(stmt).scalar()
+        return token_id
+
+    def sync(self, db_session: Session, task):
+        """
+        Reads the contract's size from chain and stores it. The counter only ever moves forward: ids allocated
+        for mints that haven't landed yet are ahead of chain, but tokens minted outside this allocator move it up.
+        Ids that drifted from chain anyway are put back in step by reconcile as their mints are confirmed.
+        """
+        if (task.network, task.contract_address) not in self.seeded:
+            self.seed(task)
+        with stage_timer('collection_size'):
+            size = int(self.read_chain_size(task))
+        db_session.execute(
+            update(TokenCounter)
+            .where(counter_filter(task))
+            .values(
+                chain_size=size,
+                synced_at=time(),
+                last_token_id=case((TokenCounter.last_token_id < size, size), else_=TokenCounter.last_token_id)
+            )
+        )
+        db_session.commit()
+        return size
+
+    def reconcile(self, db_session: Session, task, allocated_token_id, minted_token_id):
+        """
+        Shifts the ids expected for the contract's unminted completions, and its counter, by how far a mint landed
+        from the id allocated for it, e.g. after an earlier mint reverted or a token was minted elsewhere.
+        Part of the session's transaction, like allocate.
+        """
+        drift = minted_token_id - allocated_token_id
+        if drift == 0:
+            return
+        logger.warning('Token {} of {} on {} was minted as {}, shifting the pending ids by {}'.format(
+            allocated_token_id, task.contract_address, task.network, minted_token_id, drift))
+        # the session's own requeued completions have to be in the database for the update to see them
+        db_session.flush()
+        # the counter first: its row lock waits for the allocations in flight, whose completions the next update sees
+        db_session.execute(
+            update(TokenCounter)
+            .where(counter_filter(task))
+            .values(last_token_id=TokenCounter.last_token_id + drift)
+        )
+        contract_tasks = select(Task.task_id).where(Task.network == task.network,
+                                                    Task.contract_address == task.contract_address)
+        db_session.execute(
+            update(Completion)
+            .where(Completion.task_id.in_(contract_tasks),
+                   Completion.mint_status.in_(['queued', 'pinning', 'submitted']),
+                   Completion.allocated_token_id > allocated_token_id)
+            .values(allocated_token_id=Completion.allocated_token_id + drift)
+            .execution_options(synchronize_session='fetch')
+        )
+
+    def chain_size(self, db_session: Session, task, max_age=collection_size_max_age):
+        """
+        The contract's size as of at most max_age seconds ago, read from chain only when the stored one is older.
+        """
+        counter = db_session.execute(select(TokenCounter.chain_size, TokenCounter.synced_at)
+                                     .where(counter_filter(task))).first()
+        if counter is not None and time() - counter.synced_at <= max_age:
+            return counter.chain_size
+        return self.sync(db_session, task)
+
+    def invalidate(self, db_session: Session, task):
+        """
+        Drops the contract's counter, so the next allocation seeds it from chain again.
+        Only safe when no mints are pending, otherwise their ids would be handed out twice.
+        """
+        db_session.execute(delete(TokenCounter).where(counter_filter(task)))
+        db_session.commit()
+        self.seeded.discard((task.network, task.contract_address))
+
+    def sync_all(self):
+        with SessionLocal() as db_session:
+            for task in db_session.query(Task).all():
+                try:
+                    self.sync(db_session, task)
+                except Exception as e:
+                    db_session.rollback()
+                    logger.error('Could not sync token ids of task {}: {!r}'.format(task.task_id, e))
+
+    async def sync_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(token_sync_interval)
+            await loop.run_in_executor(None, self.sync_all)
+
+
+token_allocator = TokenAllocator()
+
+sync_task = None
+
+
+def start_token_sync():
+    global sync_task
+    if sync_task is None:
+        sync_task = asyncio.ensure_future(token_allocator.sync_forever())
+
+
+def stop_token_sync():
+    global sync_task
+    if sync_task is not None:
+        sync_task.cancel()
+    sync_task = None
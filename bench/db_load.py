@@ -0,0 +1,73 @@
+# Runs the hot frame queries from concurrent worker processes (like uvicorn --workers), each with
+# its own engine and pooled per-tap sessions, to show how throughput scales with the number of workers.
+# python -m bench.db_load --workers 1 2 4 8
+# DATABASE_URL=postgresql+psycopg2://... python -m bench.db_load to load an existing database instead of a scratch one
+import argparse
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from random import randrange
+from time import perf_counter
+from sqlalchemy.orm import sessionmaker
+from api.models import make_engine, Base, Task, Question, Response, Completion
+
+
+def seed(engine, num_users, num_questions):
+    session = sessionmaker(bind=engine)()
+    session.add(Task(task_id=1, title='bench', description='bench', network='mumbai', contract_address='0x0'))
+    session.add_all([
+        Question(question_id=i, task_id=1, sequence_num=i, text='question {}'.format(i), image_ipfs_hash='')
+        for i in range(1, num_questions + 1)
+    ])
+    session.bulk_insert_mappings(Response, [
+        {'question_id': q, 'task_id': 1, 'user_fid': fid, 'username': 'user{}'.format(fid), 'value': 1}
+        for fid in range(num_users)
+        for q in range(1, num_questions + 1)
+    ])
+    session.commit()
+    session.close()
+
+
+def tap_many(url, num_taps, num_users, num_questions):
+    # the reads a question page does for one tap, each tap with a fresh session from the pool
+    Session = sessionmaker(bind=make_engine(url))
+    for _ in range(num_taps):
+        with Session() as session:
+            fid = randrange(num_users)
+            session.query(Task).filter_by(task_id=1).first()
+            session.query(Completion).filter_by(user_fid=fid, task_id=1).first()
+            session.query(Response).filter_by(user_fid=fid, question_id=randrange(1, num_questions + 1)).first()
+
+
+def run(url, workers, num_taps, num_users, num_questions):
+    t0 = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(tap_many, url, num_taps // workers, num_users, num_questions)
+            for _ in range(workers)
+        ]
+        for future in futures:
+            future.result()
+    return perf_counter() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--taps', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--questions', type=int, default=12)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = os.environ.get('DATABASE_URL')
+        if url is None:
+            url = 'sqlite:///{}/bench.db'.format(directory)
+            engine = make_engine(url)
+            Base.metadata.create_all(engine)
+            seed(engine, args.users, args.questions)
+            engine.dispose()
+
+        for workers in args.workers:
+            elapsed = run(url, workers, args.taps, args.users, args.questions)
+            print('{:>3} workers: {} taps in {:.2f}s, {:.0f} taps/s'.format(workers, args.taps, elapsed, args.taps / elapsed))
@@ -0,0 +1,222 @@
+# Load test of the frame flow and the /stats endpoints, run against the app in-process with the hub, IPFS and
+# chain stubbed out. Seeds a scratch database (or uses DATABASE_URL), then
+#   1. runs start -> N answers -> mint for --flows new users, --concurrency at a time
+#   2. hits each /stats endpoint --stats-requests times, --stats-concurrency at a time
+# and reports throughput and p50/p95/p99 per endpoint. Results are saved to bench/results for comparison:
+# python -m bench.frame_flow --users 100000 --questions 12 --flows 500 --concurrency 50
+# python -m bench.frame_flow --compare bench/results/<earlier run>.json
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from random import randrange, Random
+from time import perf_counter, strftime
+
+# the app reads its settings at import time, so the scratch database has to be chosen before importing it
+scratch_dir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///{}/bench.db'.format(scratch_dir))
+os.environ.setdefault('INFURA_API_KEY', 'bench')
+os.environ.setdefault('IPFS_PIN_CACHE', '')
+
+import httpx
+import numpy as np
+from sqlalchemy import select, func
+from api import models
+from api.models import Response
+from api.bulk_import import bulk_import
+
+results_dir = os.path.join(os.path.dirname(__file__), 'results')
+quiz = json.load(open('./json/quiz.json', 'r'))
+
+
+def seed(engine, num_tasks, num_questions, num_users, seed_value=0):
+    """
+    Creates tasks like first_quiz.py's with num_questions questions, each with num_users users who answered
+    and completed. Fids run from 1 up across the tasks, so users answer one task each like they do in production.
+    """
+    random = Random(seed_value)
+    questions = [
+        dict(quiz[i % len(quiz)], question='{} ({})'.format(quiz[i % len(quiz)]['question'], i))
+        for i in range(num_questions)
+    ]
+    for i in range(num_tasks):
+        bulk_import(quiz=questions, num_users=num_users, title='bench', description='bench', network='mumbai',
+                    contract_address='0x{:040x}'.format(random.randrange(2 ** 160)), seed=seed_value + i,
+                    defer_indexes=True, bind=engine)
+
+
+def stub_dependencies(app_modules, hub_latency):
+    hub_api, frames, token_ids = app_modules
+
+    async def validate(message_bytes):
+        # message bytes are 'fid:button' in the benchmark
+        fid, button = message_bytes.split(':')[:2]
+        if hub_latency:
+            await asyncio.sleep(hub_latency)
+        return {
+            'valid': True,
+            'action': {
+                'interactor': {'fid': int(fid), 'username': 'user{}'.format(fid),
+                               'verified_addresses': {'eth_addresses': ['0x{:040x}'.format(int(fid))]}},
+                'tapped_button': {'index': int(button)}
+            }
+        }
+
+    hub_api.validate_message_async = validate
+    # no minting, and no chain reads
+    frames.queue_mint = lambda: None
+    token_ids.token_allocator.read_chain_size = lambda task: 0
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # { endpoint: [seconds] }
+        self.errors = {}  # { endpoint: count }
+
+    async def request(self, client, endpoint, method, url, **kwargs):
+        t0 = perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies.setdefault(endpoint, []).append(perf_counter() - t0)
+        if response.status_code >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    def summary(self, elapsed):
+        summary = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = np.array(latencies)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            summary[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors.get(endpoint, 0),
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': 1000 * p50,
+                'p95_ms': 1000 * p95,
+                'p99_ms': 1000 * p99
+            }
+        return summary
+
+
+async def run_flows(client, task_id, num_questions, num_flows, concurrency, first_fid):
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def flow(fid):
+        async with semaphore:
+            await recorder.request(client, 'GET /task/{task_id}', 'GET', '/task/{}'.format(task_id))
+            # answers are posted to pages 1 to N - 1 and the post to page N mints, as the frame buttons do
+            for page_num in range(1, num_questions):
+                await recorder.request(client, 'POST /task/{task_id}/{page_num}', 'POST',
+                                       '/task/{}/{}'.format(task_id, page_num),
+                                       json={'trustedData': {'messageBytes': '{}:{}'.format(fid, randrange(1, 5))}})
+            await recorder.request(client, 'POST /task/{task_id}/{page_num} (mint)', 'POST',
+                                   '/task/{}/{}'.format(task_id, num_questions),
+                                   json={'trustedData': {'messageBytes': '{}:1'.format(fid)}})
+
+    t0 = perf_counter()
+    await asyncio.gather(*[flow(first_fid + i) for i in range(num_flows)])
+    return recorder.summary(perf_counter() - t0)
+
+
+async def run_stats(client, task_id, num_users, num_requests, concurrency):
+    endpoints = {
+        '/stats/survey-stats/{task_id}': lambda: '/stats/survey-stats/{}'.format(task_id),
+        '/stats/responses-by-cluster/{task_id}': lambda: '/stats/responses-by-cluster/{}'.format(task_id),
+        '/stats/all-users/{task_id}': lambda: '/stats/all-users/{}'.format(task_id),
+        '/stats/individual-responses/{task_id}/{username}':
+            lambda: '/stats/individual-responses/{}/user{}'.format(task_id, randrange(1, num_users + 1)),
+    }
+    summary = {}
+    for endpoint, url in endpoints.items():
+        recorder = Recorder()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await recorder.request(client, 'GET ' + endpoint, 'GET', url())
+
+        t0 = perf_counter()
+        await asyncio.gather(*[one() for _ in range(num_requests)])
+        summary.update(recorder.summary(perf_counter() - t0))
+    return summary
+
+
+async def run(args):
+    from api.server import app
+    from api.external import hub_api
+    from api.routes import frames
+    from api import token_ids
+    stub_dependencies((hub_api, frames, token_ids), args.hub_latency)
+
+    await app.router.startup()
+    try:
+        # app errors come back as 500s and are counted, rather than aborting the run
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            # new users start above every seeded fid
+            first_fid = args.tasks * args.users + 1
+            results = await run_flows(client, 1, args.questions, args.flows, args.concurrency, first_fid)
+            results.update(await run_stats(client, 1, args.users, args.stats_requests, args.stats_concurrency))
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print('{:<55} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'errors', 'req/s', 'p50 ms',
+                                                               'p95 ms', 'p99 ms'))
+    for endpoint, r in results.items():
+        line = '{:<55} {:>8} {:>6} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            endpoint, r['requests'], r['errors'], r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms'])
+        if baseline is not None and endpoint in baseline:
+            b = baseline[endpoint]
+            line += '   p95 {:+.0%}, req/s {:+.0%}'.format(r['p95_ms'] / b['p95_ms'] - 1,
+                                                           r['throughput'] / b['throughput'] - 1)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1)
+    parser.add_argument('--questions', type=int, default=12)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--flows', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--stats-requests', type=int, default=200)
+    parser.add_argument('--stats-concurrency', type=int, default=20)
+    parser.add_argument('--hub-latency', type=float, default=0.0, help='seconds the stubbed hub takes per validation')
+    parser.add_argument('--no-seed', action='store_true', help='use the database in DATABASE_URL as it is')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    parser.add_argument('--name', default='frame_flow')
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        t0 = perf_counter()
+        seed(models.engine, args.tasks, args.questions, args.users)
+        with models.engine.connect() as connection:
+            num_responses = connection.execute(select(func.count()).select_from(Response)).scalar()
+        print('Seeded {} responses in {:.1f}s'.format(num_responses, perf_counter() - t0), file=sys.stderr)
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, '{}-{}.json'.format(args.name, strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump({'commit': git_commit(), 'args': vars(args), 'results': results}, f, indent=4)
+    print('Saved results to {}'.format(path), file=sys.stderr)
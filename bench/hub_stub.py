@@ -0,0 +1,39 @@
+# Local stand-in for the Neynar frame validation endpoint, used for benchmarking.
+# Run with: HUB_STUB_LATENCY=0.2 uvicorn bench.hub_stub:app --port 8001
+# and point the server at it with NEYNAR_API_URL=http://localhost:8001
+from fastapi import FastAPI, Request
+import asyncio
+import hashlib
+import os
+
+latency = float(os.environ.get('HUB_STUB_LATENCY', 0.2))
+
+app = FastAPI()
+
+
+def fake_message(message_bytes):
+    # Derive a stable fake user from the message so repeated bytes look like the same tap
+    digest = hashlib.sha256(message_bytes.encode()).digest()
+    fid = int.from_bytes(digest[:3], 'big')
+    return {
+        'valid': True,
+        'action': {
+            'interactor': {
+                'fid': fid,
+                'username': 'user{}'.format(fid),
+                'verified_addresses': {
+                    'eth_addresses': ['0x{}'.format(digest[:20].hex())]
+                }
+            },
+            'tapped_button': {
+                'index': digest[3] % 4 + 1
+            }
+        }
+    }
+
+
+@app.post('/v2/farcaster/frame/validate')
+async def validate(request: Request):
+    payload = await request.json()
+    await asyncio.sleep(latency)
+    return fake_message(payload['message_bytes_in_hex'])
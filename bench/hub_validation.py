@@ -0,0 +1,50 @@
+# Compares blocking and async frame validation against the local hub stub.
+# Start the stub first (see bench/hub_stub.py), then run:
+# NEYNAR_API_URL=http://localhost:8001 python -m bench.hub_validation --requests 500 --threads 40
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from api.external import hub_api
+
+
+def message_bytes(i):
+    return '{:064x}'.format(i)
+
+
+def run_blocking(num_requests, num_threads):
+    t0 = perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        results = list(pool.map(hub_api.validate_message, [message_bytes(i) for i in range(num_requests)]))
+    return perf_counter() - t0, results
+
+
+async def run_async(num_requests):
+    t0 = perf_counter()
+    results = await asyncio.gather(*[
+        hub_api.validate_message_async(message_bytes(i))
+        for i in range(num_requests)
+    ])
+    elapsed = perf_counter() - t0
+    await hub_api.close_async_client()
+    return elapsed, results
+
+
+def report(name, num_requests, elapsed, results):
+    failed = sum(1 for result in results if result is None)
+    print('{:>8}: {} requests in {:.2f}s, {:.0f} req/s, {} failed'.format(
+        name, num_requests, elapsed, num_requests / elapsed, failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    # uvicorn's default threadpool has 40 workers
+    parser.add_argument('--threads', type=int, default=40)
+    args = parser.parse_args()
+
+    elapsed, results = run_blocking(args.requests, args.threads)
+    report('blocking', args.requests, elapsed, results)
+
+    elapsed, results = asyncio.run(run_async(args.requests))
+    report('async', args.requests, elapsed, results)
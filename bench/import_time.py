@@ -0,0 +1,89 @@
+# Import time of the server, which is what a cold start or a --reload cycle waits on before serving frames.
+# Fails if importing it loads any of the libraries it only needs on first use (ape, pandas, numpy, PIL, ...),
+# or if the median of --repeat imports, each in a fresh interpreter, takes more than --budget seconds in total.
+# tests/test_import_time.py runs both checks under pytest. The budget is what the frame-serving path should start
+# in, well under a second. It is a known failure: fastapi alone (its pydantic openapi models) takes about 0.85s to
+# import on the machine it was measured on and sqlalchemy another 0.4s, so the server takes about 1.3s.
+# Runs without INFURA_API_KEY, which the server mustn't need to start:
+# python -m bench.import_time
+# python -m bench.import_time --budget 1.0 --repeat 9 --top 20
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+lazy_modules = ['ape', 'pandas', 'pyarrow', 'celery', 'kombu', 'adbc_driver_manager', 'numpy', 'PIL', 'requests',
+                'redis', 'httpx']
+
+# seconds the median import of the server may take
+import_budget = 0.5
+
+# prints how long the import took and which of the lazy modules it loaded
+timed_import = '''
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - t0, 'loaded': [m for m in {lazy} if m in sys.modules]}}))
+'''
+
+
+def run_import(module, importtime=False):
+    """
+    Imports the module in a fresh interpreter. Returns { 'seconds': ..., 'loaded': [lazy modules it loaded] },
+    plus the -X importtime report when asked for.
+    """
+    env = dict(os.environ)
+    env.pop('INFURA_API_KEY', None)
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        ['-c', timed_import.format(module=module, lazy=lazy_modules)]
+    result = subprocess.run(args, capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, result.stderr))
+    run = json.loads(result.stdout.strip().splitlines()[-1])
+    run['report'] = result.stderr
+    return run
+
+
+def self_times(report):
+    """
+    { module: seconds spent importing the module itself } from an -X importtime report.
+    """
+    times = {}
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us) / 1e6
+    return times
+
+
+def median_import(module, repeat):
+    return statistics.median(run_import(module)['seconds'] for _ in range(repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='api.server')
+    parser.add_argument('--budget', type=float, default=import_budget, help='seconds the median import may take in total')
+    parser.add_argument('--repeat', type=int, default=5, help='the median of this many imports is checked')
+    parser.add_argument('--top', type=int, default=10, help='show this many of the slowest modules')
+    args = parser.parse_args()
+
+    profiled = run_import(args.module, importtime=True)
+    seconds = median_import(args.module, args.repeat)
+
+    print('{:<40} {:>8.3f}s median of {}, budget {:.3f}s'.format(args.module, seconds, args.repeat, args.budget))
+    print('slowest modules by their own import time:')
+    for name, self_seconds in sorted(self_times(profiled['report']).items(), key=lambda item: -item[1])[:args.top]:
+        print('    {:<50} {:>8.3f}s'.format(name, self_seconds))
+
+    failed = False
+    if profiled['loaded']:
+        print('! imports {}, which should only be imported on first use'.format(', '.join(profiled['loaded'])))
+        failed = True
+    if seconds > args.budget:
+        print('! takes {:.3f}s, more than the {:.3f}s budget'.format(seconds, args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,59 @@
+# Compares pinning files one at a time with the concurrent batch client, against the local Pinata stand-in.
+# Start the stand-in first (see bench/pinata_stub.py), then run:
+# PINATA_API_URL=http://localhost:8002 IPFS_PIN_CACHE= python -m bench.ipfs_pinning --files 100
+import argparse
+import os
+import requests
+from time import perf_counter
+from api.external import ipfs
+
+
+def make_files(num_files, tag):
+    # distinct content per run, so nothing is served from an earlier run's cache
+    return [('{}.json'.format(i), '{{"run": "{}", "i": {}}}'.format(tag, i).encode(), 'text/plain')
+            for i in range(num_files)]
+
+
+def run_sequential(files):
+    t0 = perf_counter()
+    for filename, content, content_type in files:
+        ipfs.pin_bytes(filename, content, content_type)
+    return perf_counter() - t0
+
+
+def run_batch(files):
+    t0 = perf_counter()
+    hashes = ipfs.run_pin_batch(files)
+    elapsed = perf_counter() - t0
+    failed = sum(1 for ipfs_hash in hashes if isinstance(ipfs_hash, Exception))
+    return elapsed, failed
+
+
+def uploads():
+    return requests.get('{}/uploads'.format(ipfs.pinata_api_url)).json()['uploads']
+
+
+def report(name, num_files, elapsed, uploaded):
+    print('{:>10}: {} files in {:.2f}s, {:.0f} files/s, {} uploaded'.format(
+        name, num_files, elapsed, num_files / elapsed, uploaded))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100)
+    args = parser.parse_args()
+    tag = os.urandom(4).hex()
+
+    before = uploads()
+    elapsed = run_sequential(make_files(args.files, tag + 'a'))
+    report('sequential', args.files, elapsed, uploads() - before)
+
+    before = uploads()
+    files = make_files(args.files, tag + 'b')
+    elapsed, failed = run_batch(files)
+    report('batch', args.files, elapsed, uploads() - before)
+
+    # the same content again, all of it is answered from the pin cache
+    before = uploads()
+    elapsed, failed = run_batch(files)
+    report('cached', args.files, elapsed, uploads() - before)
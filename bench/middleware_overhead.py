@@ -0,0 +1,109 @@
+# Per-request overhead of the request middleware, against the BaseHTTPMiddleware pair it replaced and against
+# no middleware at all. Calls a minimal app straight through ASGI, so the numbers are the middleware's and the
+# router's, with no server or client in the way:
+# python -m bench.middleware_overhead
+# python -m bench.middleware_overhead --requests 50000 --body-chunks 10
+import argparse
+import asyncio
+import os
+import time
+from time import perf_counter
+
+os.environ.setdefault('INFURA_API_KEY', 'bench')
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from api.metrics import observe_request
+from api.middleware import RequestMiddleware
+
+
+class LogResponseTime(BaseHTTPMiddleware):
+    # as server.py had it
+    async def dispatch(self, request, call_next):
+        start_time = time.perf_counter()
+        response = await call_next(request)
+        process_time = time.perf_counter() - start_time
+        route = request.scope.get('route')
+        observe_request(request.method, route.path if route is not None else 'unmatched', response.status_code,
+                        process_time)
+        return response
+
+
+class CacheControlMiddleware(BaseHTTPMiddleware):
+    # as server.py had it
+    async def dispatch(self, request: Request, call_next):
+        response = await call_next(request)
+        response.headers.setdefault("Cache-Control", "max-age=10")
+        return response
+
+
+def make_app(middleware, body_chunks):
+    app = FastAPI()
+
+    @app.get('/bench/{item_id}')
+    async def get_item(item_id: int):
+        return PlainTextResponse('ok')
+
+    @app.get('/bench/{item_id}/stream')
+    async def stream_item(item_id: int):
+        return StreamingResponse(iter([b'x' * 1024] * body_chunks))
+
+    for cls in middleware:
+        app.add_middleware(cls)
+    return app
+
+
+stacks = {
+    'none': [],
+    'BaseHTTPMiddleware pair': [LogResponseTime, CacheControlMiddleware],
+    'RequestMiddleware': [RequestMiddleware],
+}
+
+
+async def call(app, path):
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'headers': [],
+             'client': ('127.0.0.1', 1234), 'server': ('bench', 80)}
+
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    done = asyncio.Event()
+
+    async def receive():
+        if len(messages) > 0:
+            return messages.pop()
+        # like uvicorn, disconnect is only reported once the response is complete
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+            done.set()
+
+    await app(scope, receive, send)
+
+
+async def run(app, path, num_requests):
+    # warm up, then time sequential requests so only per-request cost is measured
+    for i in range(100):
+        await call(app, path)
+    t0 = perf_counter()
+    for i in range(num_requests):
+        await call(app, path)
+    return (perf_counter() - t0) / num_requests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--body-chunks', type=int, default=10, help='chunks of the streamed response')
+    args = parser.parse_args()
+
+    for name, path in [('plain response', '/bench/1'), ('streamed response', '/bench/1/stream')]:
+        baseline = None
+        print(name)
+        for stack, middleware in stacks.items():
+            seconds = asyncio.run(run(make_app(middleware, args.body_chunks), path, args.requests))
+            baseline = seconds if baseline is None else baseline
+            print('    {:<25} {:>8.1f} us per request, {:>+7.1f} us over none'.format(
+                stack, seconds * 1e6, (seconds - baseline) * 1e6))
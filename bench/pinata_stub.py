@@ -0,0 +1,41 @@
+# Local stand-in for Pinata's pinFileToIPFS endpoint, used for benchmarking.
+# Run with: PINATA_STUB_LATENCY=0.3 uvicorn bench.pinata_stub:app --port 8002
+# and point the client at it with PINATA_API_URL=http://localhost:8002
+from fastapi import FastAPI, Request
+import asyncio
+import hashlib
+import os
+
+latency = float(os.environ.get('PINATA_STUB_LATENCY', 0.3))
+
+app = FastAPI()
+uploads = 0
+
+
+def file_content(content_type, body):
+    # just enough multipart parsing for one file field, without needing python-multipart
+    boundary = content_type.split('boundary=')[1].encode()
+    for part in body.split(b'--' + boundary):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        if b'name="file"' in headers:
+            return content[:-2]
+    return b''
+
+
+@app.post('/pinning/pinFileToIPFS')
+async def pin_file(request: Request):
+    global uploads
+    content = file_content(request.headers['content-type'], await request.body())
+    await asyncio.sleep(latency)
+    uploads += 1
+    # not a real CID, but stable for the same content like one
+    return {
+        'IpfsHash': 'Qm{}'.format(hashlib.sha256(content).hexdigest()[:44]),
+        'PinSize': len(content),
+        'Timestamp': '2024-01-01T00:00:00.000Z'
+    }
+
+
+@app.get('/uploads')
+async def get_uploads():
+    return {'uploads': uploads}
@@ -0,0 +1,116 @@
+# Checks with EXPLAIN QUERY PLAN that each hot query is served by its index, so index coverage doesn't regress
+# when the models or queries change. Exits non-zero if any plan is missing its index, scans a table or sorts
+# where it shouldn't. tests/test_query_plans.py runs the same checks under pytest. Runs against an empty scratch
+# sqlite database by default, or a migrated copy of a real one:
+# python -m bench.query_plans
+# python -m bench.query_plans --database-url sqlite:///./remote.db
+import argparse
+import sys
+from sqlalchemy import select, func, tuple_, text
+from api.models import make_engine, Base, Response, Completion, Question, Cluster
+from api.aggregates import cluster_counts_query
+
+# name: (statement, index it must use, whether sorting in a temp b-tree is expected)
+hot_queries = {
+    'already completed (frames)': (
+        select(Completion.completion_id).where(Completion.user_fid == 1, Completion.task_id == 1).limit(1),
+        'ix_completion_user_task', False
+    ),
+    'latest clusters (aggregates)': (
+        select(Completion.task_id, Completion.user_fid, Completion.cluster_id)
+        .where(Completion.user_fid.in_([1, 2, 3])).order_by(Completion.completion_id),
+        'ix_completion_user_task', True
+    ),
+    'existing responses (aggregates)': (
+        select(Response.user_fid, Response.question_id, Response.value)
+        .where(Response.user_fid.in_([1, 2]))
+        .where(tuple_(Response.user_fid, Response.question_id).in_([(1, 1), (2, 2)])),
+        'ix_response_user_question', False
+    ),
+    'responses of a user by fid (aggregates)': (
+        select(Response.task_id, Response.question_id, Response.value).where(Response.user_fid == 1),
+        'ix_response_user_question', False
+    ),
+    'responses of a user by username (frames, stats)': (
+        select(Response.question_id, Response.value).where(Response.task_id == 1, Response.username == 'user1')
+        .order_by(Response.response_id),
+        'ix_response_task_username', False
+    ),
+    'page of a user\'s responses (export)': (
+        select(Response.response_id).where(Response.task_id == 1, Response.username == 'user1',
+                                           Response.response_id > 0)
+        .order_by(Response.response_id).limit(1000),
+        'ix_response_task_username', False
+    ),
+    'page of a task\'s users (export)': (
+        select(Response.user_fid, func.min(Response.username))
+        .where(Response.task_id == 1, Response.user_fid.is_not(None), Response.user_fid > 0)
+        .group_by(Response.user_fid).order_by(Response.user_fid).limit(1000),
+        'ix_response_task_user', False
+    ),
+    'responses by cluster of a task (rebuild_counts)': (
+        cluster_counts_query(1),
+        'ix_response_task_user', True
+    ),
+    'new responses of a task (analytics)': (
+        select(Response.__table__).where(Response.task_id == 1, Response.response_id > 0)
+        .order_by(Response.response_id),
+        'ix_response_task_id', False
+    ),
+    'replaced responses of a task (analytics)': (
+        select(Response.__table__).where(Response.task_id == 1, Response.updated_at > 0)
+        .order_by(Response.response_id),
+        'ix_response_task_updated', True
+    ),
+    'questions of a task (task cache)': (
+        select(Question.question_id).where(Question.task_id == 1).order_by(Question.sequence_num, Question.question_id),
+        'ix_question_task_sequence', False
+    ),
+    'cluster by name (scoring)': (
+        select(Cluster.cluster_id).where(Cluster.task_id == 1, Cluster.name == 'Creative Collectivist'),
+        'ix_cluster_task_name', False
+    ),
+}
+
+
+def query_plan(connection, stmt):
+    sql = stmt.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    return [row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN {}'.format(sql)))]
+
+
+def check_plan(plan, index, sorts):
+    """
+    Returns what is wrong with the plan, if anything.
+    """
+    problems = []
+    if not any(index in step for step in plan):
+        problems.append('does not use {}'.format(index))
+    for step in plan:
+        # scanning the constant rows of an IN list or a materialized subquery is fine, scanning a table isn't
+        if step.startswith('SCAN ') and 'INDEX' not in step and 'CONSTANT ROWS' not in step \
+                and not step.startswith('SCAN anon_'):
+            problems.append('scans: {}'.format(step))
+        if 'TEMP B-TREE' in step and not sorts:
+            problems.append('sorts: {}'.format(step))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url', default='sqlite://', help='sqlite database to check, defaults to a scratch one')
+    args = parser.parse_args()
+
+    engine = make_engine(args.database_url)
+    Base.metadata.create_all(engine)
+    failed = 0
+    with engine.connect() as connection:
+        for name, (stmt, index, sorts) in hot_queries.items():
+            plan = query_plan(connection, stmt)
+            problems = check_plan(plan, index, sorts)
+            failed += len(problems) > 0
+            print('{:<50} {}'.format(name, 'FAIL' if problems else 'ok'))
+            for step in plan:
+                print('    {}'.format(step))
+            for problem in problems:
+                print('    ! {}'.format(problem))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,69 @@
+# Times rendering the question images of a large task: reloading the assets per image as
+# preprocessing used to, the shared-asset template in one process, and the process pool.
+# python -m bench.question_images --questions 500 --workers 4
+import argparse
+import os
+import tempfile
+import textwrap
+from time import perf_counter
+from PIL import Image, ImageDraw, ImageFont
+from api.image_render import QuestionTemplate, render_many
+
+
+def reload_per_image(text, filename):
+    # the old preprocessing.text_to_png, which reopened the background and font every time
+    height = 400
+    width = height
+    image = Image.open('./img/frame3.png')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype("./font/Cinzel-Regular.ttf", 40)
+    for i, line in enumerate(textwrap.wrap(text, width=24)):
+        draw.text((4.5 * width / 10, (i + 1) * (height / 12) + (height * 0.8)), line, fill=(0, 0, 0), font=font,
+                  align='center')
+    image.save(filename)
+
+
+def jobs(num_questions, dir):
+    return [('Question {}: I believe collective goals are best achieved through shared norms.'.format(i),
+             os.path.join(dir, '{}.png'.format(i)))
+            for i in range(num_questions)]
+
+
+def report(name, num_questions, elapsed):
+    print('{:>14}: {} images in {:.2f}s, {:.1f} ms/image'.format(name, num_questions, elapsed,
+                                                                  1000 * elapsed / num_questions))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir:
+        os.makedirs(os.path.join(dir, 'a'))
+        t0 = perf_counter()
+        for text, filename in jobs(args.questions, os.path.join(dir, 'a')):
+            reload_per_image(text, filename)
+        report('reload assets', args.questions, perf_counter() - t0)
+
+        os.makedirs(os.path.join(dir, 'b'))
+        template = QuestionTemplate()
+        t0 = perf_counter()
+        for text, filename in jobs(args.questions, os.path.join(dir, 'b')):
+            template.save(text, filename)
+        report('shared assets', args.questions, perf_counter() - t0)
+
+        os.makedirs(os.path.join(dir, 'c'))
+        t0 = perf_counter()
+        render_many(jobs(args.questions, os.path.join(dir, 'c')), workers=args.workers)
+        report('pool x{}'.format(args.workers), args.questions, perf_counter() - t0)
+
+        t0 = perf_counter()
+        rendered = render_many(jobs(args.questions, os.path.join(dir, 'c')), workers=args.workers)
+        report('up to date', args.questions, perf_counter() - t0)
+        assert rendered == 0
+
+        # same pixels as before, only the render key was added
+        text, filename = jobs(1, os.path.join(dir, 'a'))[0]
+        assert Image.open(filename).tobytes() == Image.open(jobs(1, os.path.join(dir, 'c'))[0][1]).tobytes()
@@ -0,0 +1,63 @@
+# Compares committing every tap against the write-behind response buffer on a scratch sqlite database.
+# python -m bench.response_ingest --users 2000 --questions 12
+import argparse
+import os
+import tempfile
+from random import choice
+from time import perf_counter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from api.models import Base, Response
+from api.response_buffer import ResponseBuffer
+
+
+def scratch_engine(directory, name):
+    return create_engine('sqlite:///{}'.format(os.path.join(directory, name)))
+
+
+def taps(num_users, num_questions):
+    for user_fid in range(num_users):
+        for question_id in range(1, num_questions + 1):
+            yield user_fid, question_id, choice([-2, -1, 1, 2])
+
+
+def commit_per_tap(engine, num_users, num_questions):
+    session = sessionmaker(bind=engine)()
+    for user_fid, question_id, value in taps(num_users, num_questions):
+        existing = session.query(Response).filter_by(user_fid=user_fid, question_id=question_id).first()
+        if existing:
+            existing.value = value
+        else:
+            session.add(Response(question_id=question_id, task_id=1, user_fid=user_fid,
+                                 username='user{}'.format(user_fid), value=value))
+        session.commit()
+    session.close()
+
+
+def buffered(engine, num_users, num_questions, flush_size):
+    buffer = ResponseBuffer(engine, flush_size, 1.0)
+    for user_fid, question_id, value in taps(num_users, num_questions):
+        if buffer.add(question_id, 1, user_fid, 'user{}'.format(user_fid), value):
+            buffer.flush()
+    buffer.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--questions', type=int, default=12)
+    parser.add_argument('--flush-size', type=int, default=500)
+    args = parser.parse_args()
+    num_taps = args.users * args.questions
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, run in [
+            ('commit per tap', lambda engine: commit_per_tap(engine, args.users, args.questions)),
+            ('buffered', lambda engine: buffered(engine, args.users, args.questions, args.flush_size))
+        ]:
+            engine = scratch_engine(directory, name.replace(' ', '_') + '.db')
+            Base.metadata.create_all(engine)
+            t0 = perf_counter()
+            run(engine)
+            elapsed = perf_counter() - t0
+            print('{:>15}: {} taps in {:.2f}s, {:.0f} taps/s'.format(name, num_taps, elapsed, num_taps / elapsed))
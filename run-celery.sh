@@ -1 +1 @@
-celery -A api.external.minter worker --loglevel=INFO
\ No newline at end of file
+celery -A api.external.minter worker --beat --loglevel=INFO
\ No newline at end of file
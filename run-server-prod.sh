@@ -0,0 +1,8 @@
+# Several workers, one per core unless WEB_CONCURRENCY says otherwise, sharing task snapshots and stats through
+# the Redis at CACHE_URL. The database is prepared once here rather than by every worker as it starts. Taps are
+# written to the database as they come rather than buffered, since a user's next tap may go to another worker
+export CACHE_URL=${CACHE_URL:-redis://localhost:6379/0}
+export PREPARE_DATABASE=0
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/survey-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+python -m api.server && exec uvicorn api.server:app --host 0.0.0.0 --port ${PORT:-8000} --workers ${WEB_CONCURRENCY:-$(nproc)}
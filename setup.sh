@@ -5,4 +5,8 @@ ape compile ./contracts
 
 sudo apt install rabbitmq-server
 sudo systemctl start rabbitmq-server
-sudo systemctl enable rabbitmq-server
\ No newline at end of file
+sudo systemctl enable rabbitmq-server
+
+sudo apt install redis-server
+sudo systemctl start redis-server
+sudo systemctl enable redis-server
\ No newline at end of file
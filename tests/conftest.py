@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# the api reads its json and templates relative to the repository root, which is where the server runs from
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
+
+# a scratch database, so tests never touch the working tree's test.db
+os.environ.setdefault('DATABASE_URL', 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'test.db')))
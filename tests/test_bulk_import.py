@@ -0,0 +1,41 @@
+import json
+from sqlalchemy import select, func
+from api.models import engine, Response, Completion
+from api.bulk_import import bulk_import
+
+quiz = json.load(open('./json/quiz.json'))[:6]
+
+
+def write_csv(path, rows):
+    with open(path, 'w') as f:
+        f.write('user_fid,username,question,value\n')
+        for row in rows:
+            f.write('{},{},{},{}\n'.format(*row))
+
+
+def count(table, task_id):
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(table).where(table.c.task_id == task_id)).scalar()
+
+
+def test_reimporting_responses_replaces_answers_and_skips_completed_users(tmp_path):
+    task_id = bulk_import(quiz=quiz)
+    # user 1 answers every question the frame asks, user 2 only some
+    rows = [(1, 'one', question, 1) for question in range(2, len(quiz) + 1)] + [(2, 'two', 2, -1), (2, 'two', 3, 2)]
+    write_csv(tmp_path / 'responses.csv', rows)
+    bulk_import(task_id=task_id, responses_path=str(tmp_path / 'responses.csv'))
+    assert count(Response.__table__, task_id) == len(rows)
+    assert count(Completion.__table__, task_id) == 1
+
+    # user 2 changes an answer and finishes, user 1's rows are left alone since they completed the task
+    rows = [(1, 'one', 2, -2)] + [(2, 'two', question, -2) for question in range(2, len(quiz) + 1)]
+    write_csv(tmp_path / 'responses.csv', rows)
+    bulk_import(task_id=task_id, responses_path=str(tmp_path / 'responses.csv'))
+    assert count(Response.__table__, task_id) == 2 * (len(quiz) - 1)
+    assert count(Completion.__table__, task_id) == 2
+    with engine.connect() as connection:
+        values = dict(connection.execute(select(Response.user_fid, Response.value)
+                                         .where(Response.task_id == task_id, Response.question_id ==
+                                                select(func.min(Response.question_id))
+                                                .where(Response.task_id == task_id).scalar_subquery())).all())
+    assert values == {1: 1, 2: -2}
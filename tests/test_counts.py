@@ -0,0 +1,63 @@
+import json
+import random
+import pytest
+from sqlalchemy import select
+from api.aggregates import apply_completion_deltas, ensure_counts, rebuild_counts
+from api.bulk_import import bulk_import
+from api.models import SessionLocal, engine, Completion, ResponseCount, ClusterResponseCount
+from api.response_buffer import ResponseBuffer
+from api.routes.frames import button_scores
+from api.task_cache import task_cache
+
+quiz = json.load(open('./json/quiz.json'))
+
+
+@pytest.fixture
+def task():
+    task_id = bulk_import(quiz=quiz, contract_address='0x' + '4' * 40)
+    ensure_counts()
+    with SessionLocal() as db_session:
+        return task_cache.get(db_session, task_id)
+
+
+def counts(task_id):
+    # rows a delta brought back to zero are the same as missing ones
+    with engine.connect() as connection:
+        return (
+            {row[:-1]: row[-1] for row in connection.execute(
+                select(ResponseCount.question_id, ResponseCount.value, ResponseCount.count)
+                .where(ResponseCount.task_id == task_id)) if row[-1] != 0},
+            {row[:-1]: row[-1] for row in connection.execute(
+                select(ClusterResponseCount.cluster_id, ClusterResponseCount.question_id,
+                       ClusterResponseCount.value, ClusterResponseCount.count)
+                .where(ClusterResponseCount.task_id == task_id)) if row[-1] != 0}
+        )
+
+
+def test_counts_after_buffer_flushes_equal_rebuilt_counts(task):
+    rng = random.Random(11)
+    buffer = ResponseBuffer(engine, max_size=10 ** 6, interval=1.0)
+    question_ids = [question.question_id for question in task.questions]
+    cluster_ids = [cluster.cluster_id for cluster in task.clusters.values()]
+    user_fids = list(range(1000, 1040))
+
+    for _ in range(20):
+        # taps of several users, some of them changing answers they already gave, flushed as one batch
+        for _ in range(rng.randint(1, 60)):
+            user_fid = rng.choice(user_fids)
+            buffer.add(rng.choice(question_ids), task.task_id, user_fid, 'u{}'.format(user_fid),
+                       rng.choice(button_scores))
+        buffer.flush()
+        # completions, including users completing again, which moves them to another cluster
+        for user_fid in rng.sample(user_fids, 3):
+            cluster_id = rng.choice(cluster_ids)
+            with SessionLocal() as db_session:
+                apply_completion_deltas(db_session.connection(), task.task_id, user_fid, cluster_id)
+                db_session.add(Completion(task_id=task.task_id, user_fid=user_fid, cluster_id=cluster_id))
+                db_session.commit()
+
+    maintained = counts(task.task_id)
+    assert maintained[0] and maintained[1]
+    with engine.begin() as connection:
+        rebuild_counts(connection, task.task_id)
+    assert counts(task.task_id) == maintained
@@ -0,0 +1,80 @@
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from api import export
+from api.bulk_import import bulk_import
+from api.models import SessionLocal, engine, Response
+from api.response_buffer import upsert_responses
+from api.routes.stats import stats_router
+from api.task_cache import task_cache
+
+quiz = json.load(open('./json/quiz.json'))
+# a multiple of the page size below, so the last page is full and the one after it empty
+num_users = 21
+page_size = 7
+
+
+@pytest.fixture
+def task():
+    task_id = bulk_import(quiz=quiz, contract_address='0x' + '2' * 40)
+    with SessionLocal() as db_session:
+        task = task_cache.get(db_session, task_id)
+    rows = [
+        {'question_id': question.question_id, 'task_id': task_id, 'user_fid': 2000 + user,
+         'username': 'export{}'.format(user), 'value': 2}
+        for user in range(num_users)
+        for question in task.questions
+    ]
+    with engine.begin() as connection:
+        upsert_responses(connection, rows)
+    return task
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(stats_router)
+    return TestClient(app)
+
+
+def pages(client, path, limit):
+    after = None
+    while True:
+        params = {'limit': limit} if after is None else {'limit': limit, 'after': after}
+        body = client.get(path, params=params).json()
+        yield body['items']
+        after = body['next']
+        if after is None:
+            return
+
+
+def test_user_pages_and_export_cover_every_user_once(task, client, monkeypatch):
+    expected = [2000 + user for user in range(num_users)]
+    paged = [record['user_fid'] for items in pages(client, '/stats/all-users/{}/page'.format(task.task_id), page_size)
+             for record in items]
+    assert paged == expected
+
+    monkeypatch.setattr(export, 'export_page_size', page_size)
+    lines = client.get('/stats/all-users/{}/export'.format(task.task_id)).text.splitlines()
+    assert [json.loads(line)['user_fid'] for line in lines] == expected
+    rows = client.get('/stats/all-users/{}/export'.format(task.task_id), params={'format': 'csv'}).text.splitlines()
+    assert rows[0] == ','.join(export.user_columns)
+    assert len(rows) == num_users + 1
+
+
+def test_response_pages_and_export_cover_every_response_once(task, client, monkeypatch):
+    with SessionLocal() as db_session:
+        expected = db_session.execute(
+            select(Response.response_id).where(Response.task_id == task.task_id, Response.username == 'export3')
+            .order_by(Response.response_id)).scalars().all()
+    assert len(expected) == len(task.questions)
+
+    path = '/stats/individual-responses/{}/export3'.format(task.task_id)
+    paged = [record['response_id'] for items in pages(client, path + '/page', 5) for record in items]
+    assert paged == expected
+
+    monkeypatch.setattr(export, 'export_page_size', 5)
+    lines = client.get(path + '/export').text.splitlines()
+    assert [json.loads(line)['response_id'] for line in lines] == expected
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from blake3 import blake3
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from fastapi.testclient import TestClient
+from api.external import frame_verify
+
+fid = 1234
+interactor = {'fid': fid, 'username': 'tester', 'verified_addresses': {'eth_addresses': []}}
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, value):
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def signed_message(key, button_index):
+    body = field(1, b'https://example.com/task/1/1') + field(2, button_index)
+    data = field(1, frame_verify.MESSAGE_TYPE_FRAME_ACTION) + field(2, fid) + field(3, 1) + \
+        field(4, frame_verify.FARCASTER_NETWORK_MAINNET) + field(16, body)
+    hash = blake3(data).digest(length=20)
+    signer = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    message = field(1, data) + field(2, hash) + field(3, frame_verify.HASH_SCHEME_BLAKE3) + \
+        field(4, key.sign(hash)) + field(5, frame_verify.SIGNATURE_SCHEME_ED25519) + field(6, signer)
+    return message.hex()
+
+
+@pytest.fixture
+def key(monkeypatch):
+    key = Ed25519PrivateKey.generate()
+    signer = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    monkeypatch.setitem(frame_verify.signer_table, fid, {
+        'signers': {signer}, 'interactor': interactor, 'refreshed_at': frame_verify.monotonic()
+    })
+    return key
+
+
+def test_known_signer_is_verified_locally(key):
+    message = asyncio.run(frame_verify.validate_message_local(signed_message(key, 3)))
+    assert message['action']['tapped_button']['index'] == 3
+    assert message['action']['interactor'] == interactor
+
+
+@pytest.mark.parametrize('button_index', [0, 5])
+def test_button_index_out_of_range_is_rejected(key, button_index):
+    assert asyncio.run(frame_verify.validate_message_local(signed_message(key, button_index))) is None
+
+
+@pytest.mark.parametrize('button_index', [0, 5])
+def test_button_index_out_of_range_is_a_bad_request(key, monkeypatch, button_index):
+    from api.routes.frames import frames_router
+    from fastapi import FastAPI
+    monkeypatch.setattr(frame_verify, 'validation_mode', 'local')
+    app = FastAPI()
+    app.include_router(frames_router)
+    messageBytes = signed_message(key, button_index)
+    response = TestClient(app).post('/task/1/1', json={'trustedData': {'messageBytes': messageBytes}})
+    assert response.status_code == 400
@@ -0,0 +1,24 @@
+import pytest
+from api.models import make_engine, Base
+from bench.query_plans import hot_queries, query_plan, check_plan
+
+
+@pytest.fixture(scope='module')
+def connection():
+    engine = make_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        yield connection
+
+
+@pytest.mark.parametrize('name', list(hot_queries))
+def test_hot_query_uses_its_index(connection, name):
+    stmt, index, sorts = hot_queries[name]
+    plan = query_plan(connection, stmt)
+    assert check_plan(plan, index, sorts) == [], '\n'.join(plan)
+
+
+def test_check_plan_catches_table_scans():
+    assert check_plan(['SCAN response'], 'ix_response_task_id', False) == [
+        'does not use ix_response_task_id', 'scans: SCAN response'
+    ]
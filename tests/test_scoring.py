@@ -0,0 +1,65 @@
+import json
+import random
+from types import SimpleNamespace
+import pytest
+from api.bulk_import import bulk_import
+from api.models import SessionLocal, Question
+from api.routes.frames import button_scores
+from api.scoring import TaskScorer, RunningScore, get_quiz_result, record_answer, running_name
+from api.task_cache import task_cache
+
+quiz = json.load(open('./json/quiz.json'))
+
+
+@pytest.fixture
+def task():
+    task_id = bulk_import(quiz=quiz, contract_address='0x' + '8' * 40)
+    with SessionLocal() as db_session:
+        return task_cache.get(db_session, task_id)
+
+
+def random_answers(rng, question_ids):
+    # any subset of the questions in any order, with some answers given again
+    answers = [(question_id, rng.choice(button_scores))
+               for question_id in rng.sample(question_ids, rng.randint(1, len(question_ids)))]
+    for _ in range(rng.randint(0, 2)):
+        answers.append((rng.choice(answers)[0], rng.choice(button_scores)))
+    return answers
+
+
+def latest(answers):
+    # a replaced answer keeps the place of the first one, like its upserted response row
+    values = {}
+    for question_id, value in answers:
+        values[question_id] = value
+    return list(values.items())
+
+
+def test_scorer_matches_get_quiz_result_on_random_answers(task):
+    rng = random.Random(8)
+    scorer = TaskScorer(task)
+    question_ids = [question.question_id for question in task.questions]
+    answers_by_user = {user: random_answers(rng, question_ids) for user in range(500)}
+
+    with SessionLocal() as db_session:
+        questions = {question.question_id: question
+                     for question in db_session.query(Question).filter_by(task_id=task.task_id)}
+        expected = {}
+        for user, answers in answers_by_user.items():
+            result = get_quiz_result([SimpleNamespace(question=questions[question_id], value=value)
+                                      for question_id, value in latest(answers)])
+            expected[user] = (result['name'], {category.name: score for category, score in result['scores'].items()})
+
+    users, values, ranks = scorer.values_matrix({user: latest(answers) for user, answers in answers_by_user.items()})
+    names, _ = scorer.score(values, ranks)
+    for user, name in zip(users, names):
+        assert name == expected[user][0]
+
+    for user, answers in answers_by_user.items():
+        result = scorer.score_user(latest(answers))
+        assert (result['name'], result['scores']) == expected[user]
+
+        running = RunningScore(scorer)
+        for question_id, value in answers:
+            record_answer(scorer, running, question_id, value)
+        assert running_name(scorer, running) == expected[user][0]
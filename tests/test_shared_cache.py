@@ -0,0 +1,82 @@
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from api import shared_cache as shared_cache_module
+from api import task_cache as task_cache_module
+from api.bulk_import import bulk_import
+from api.models import SessionLocal
+from api.routes.stats import stats_router
+from api.shared_cache import RedisCache
+from api.task_cache import TaskCache, snapshot_from_record, snapshot_record
+
+quiz = json.load(open('./json/quiz.json'))[:3]
+
+
+class Client:
+    """
+    Stands in for redis.Redis, keeping the bytes it is given like Redis would.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, px=None):
+        self.values[key] = value if isinstance(value, bytes) else value.encode()
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, b'0')) + 1).encode()
+        return int(self.values[key])
+
+    def publish(self, channel, message):
+        pass
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    cache = RedisCache('redis://localhost:6379/0')
+    cache.client = Client()
+    monkeypatch.setattr(shared_cache_module, 'shared_cache', cache)
+    monkeypatch.setattr(task_cache_module, 'shared_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def task_id():
+    return bulk_import(quiz=quiz, contract_address='0x' + '5' * 40)
+
+
+def test_snapshot_survives_a_json_round_trip(task_id):
+    with SessionLocal() as db_session:
+        snapshot = TaskCache().build(db_session, task_id)
+    assert snapshot_from_record(json.loads(json.dumps(snapshot_record(snapshot)))) == snapshot
+
+
+def test_redis_cache_stores_json_and_other_workers_read_the_same_snapshot(redis_cache, task_id):
+    with SessionLocal() as db_session:
+        loaded = TaskCache().get(db_session, task_id)
+        # another worker, finding the snapshot in Redis rather than building it
+        shared = TaskCache().get(db_session, task_id)
+    assert shared == loaded
+    assert redis_cache.hits == 1
+    for value in redis_cache.client.values.values():
+        json.loads(value)
+
+
+def test_cached_stats_are_stored_as_json(redis_cache, task_id):
+    app = FastAPI()
+    app.include_router(stats_router)
+    client = TestClient(app)
+    for path in ['/stats/survey-stats/{}', '/stats/all-users/{}', '/stats/responses-by-cluster/{}']:
+        first = client.get(path.format(task_id))
+        assert first.status_code == 200
+        # the second answer comes out of the cache
+        assert client.get(path.format(task_id)).json() == first.json()
+    for value in redis_cache.client.values.values():
+        json.loads(value)
@@ -0,0 +1,81 @@
+import json
+import pytest
+from itertools import count
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from api.models import SessionLocal, Completion
+from api.bulk_import import bulk_import
+from api.task_cache import task_cache
+from api.token_ids import TokenAllocator, ensure_token_table
+
+quiz = json.load(open('./json/quiz.json'))[:3]
+contracts = count(1)
+
+
+class Chain:
+    def __init__(self, size):
+        self.size = size
+        self.reads = 0
+
+    def __call__(self, task):
+        self.reads += 1
+        return self.size
+
+
+@pytest.fixture
+def task():
+    ensure_token_table()
+    # a contract of its own, so each test starts without a counter
+    task_id = bulk_import(quiz=quiz, contract_address='0x{:040x}'.format(next(contracts)))
+    with SessionLocal() as db_session:
+        return task_cache.get(db_session, task_id)
+
+
+def test_allocated_ids_follow_chain_and_are_only_used_up_on_commit(task):
+    allocator = TokenAllocator(read_chain_size=Chain(10))
+    with SessionLocal() as db_session:
+        assert allocator.allocate(db_session, task) == 11
+        db_session.rollback()
+        assert allocator.allocate(db_session, task) == 11
+        assert allocator.allocate(db_session, task) == 12
+        db_session.commit()
+        assert allocator.allocate(db_session, task) == 13
+
+
+def test_seeded_counter_is_not_read_from_chain_again(task):
+    TokenAllocator(read_chain_size=Chain(10)).seed(task)
+    # another worker, starting without knowing the counter exists
+    chain = Chain(10)
+    allocator = TokenAllocator(read_chain_size=chain)
+    with SessionLocal() as db_session:
+        assert allocator.allocate(db_session, task) == 11
+    assert chain.reads == 0
+
+
+def test_reconcile_shifts_pending_ids_and_the_counter(task):
+    allocator = TokenAllocator(read_chain_size=Chain(0))
+    with SessionLocal() as db_session:
+        for _ in range(3):
+            token_id = allocator.allocate(db_session, task)
+            db_session.add(Completion(task_id=task.task_id, allocated_token_id=token_id, mint_status='queued'))
+        db_session.commit()
+        first = db_session.scalars(select(Completion).where(Completion.task_id == task.task_id)
+                                   .order_by(Completion.allocated_token_id)).first()
+        # the first mint landed as token 5, e.g. after tokens were minted elsewhere
+        first.mint_status = 'minted'
+        allocator.reconcile(db_session, task, first.allocated_token_id, 5)
+        db_session.commit()
+        pending = db_session.scalars(select(Completion.allocated_token_id)
+                                     .where(Completion.task_id == task.task_id, Completion.mint_status == 'queued')
+                                     .order_by(Completion.allocated_token_id)).all()
+        assert pending == [6, 7]
+        assert allocator.allocate(db_session, task) == 8
+        db_session.rollback()
+
+
+def test_collection_size_of_an_unknown_task_is_not_found():
+    from api.routes import stats
+    app = FastAPI()
+    app.include_router(stats.stats_router)
+    assert TestClient(app).get('/stats/collection-size/999999').status_code == 404